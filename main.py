@@ -8,16 +8,32 @@ except ImportError:
     import pickle
 import logging
 import collections
+import threading
+import datetime
+import time
 import typing
 
 LOGGING_FORMAT = '%(asctime)s|%(levelname)s|%(message)s'
 logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
 
-from recode.helpers import NUM_THREADS, which, get_suffix, open_with_dir, ensuredir, confirm_yesno
+from recode.helpers import get_suffix, open_with_dir, ensuredir, confirm_yesno, get_memory_limit, parse_size, get_device_name
 from recode.tasks import Executor
 from recode.media.parsers import PARSERS, ALL_PARSERS, UPCAST
 from recode.media.base import UnknownFile, BadParameters, MediaEntry
-from recode.locked_state import LockedState
+from recode.task_store import TaskStore, NewBatch, TaskStatus, LegacyStateError
+from recode.spool import Spool
+from recode.capabilities import CAPABILITIES
+from recode.accounting import USAGE_LOG, MEMORY_HISTORY, THROUGHPUT_HISTORY
+from recode.arbiter import Arbiter
+from recode.trace import TraceWriter
+from recode.planner import SpeedPlanner
+from recode.control import get_socket_path, send_command, ControlError
+from recode.encoder.predict import predict_encode, describe_prediction
+from recode.watcher import LibraryWatcher
+from recode.catalog import get_default_path as get_default_catalog
+from recode.encoder.base_tasks import RecordResultTask, TranscodingFailure
+from recode.encoder.vp9crf import Vp9CrfEncode2PassTask
+from recode.encoder.mkvcrf import merge_same_source
 
 def parse_fentry(fentry: typing.Tuple[str, str], suffix: str, forced_parser: MediaEntry=None, forced_params: dict=None, target_quality: str='') -> MediaEntry:
     fname, fpath = fentry
@@ -53,7 +69,320 @@ def get_files(src_list):
     lst = STUB if sys.platform == 'win32' else src_list
     return tuple((os.path.basename(fname), fname) for fname in lst)
 
+def parse_entries(inp: typing.Sequence[typing.Tuple[str, str]], forced_parser: MediaEntry, forced_params: dict, force_params: str,
+                  target_quality: str, suffix_sources: typing.Sequence[typing.Tuple[str, str]]=None) -> typing.List[MediaEntry]:
+    '''
+    Parses (name, path) pairs into media entries, detecting common suffix
+    among suffix_sources (defaults to inp) if media type wants it stripped
+    '''
+    suffix = ''
+    entries = []
+    entry_types = set()
+
+    for fentry in inp:
+        got = parse_fentry(fentry, suffix, forced_parser, forced_params, target_quality)
+        logging.debug('Parsed entry "%s"' % got[0].full_name)
+        entries.extend(got)
+        entry_types |= set(type(entry) for entry in got)
+
+    need_reparse = False
+    if not forced_parser and force_params:
+        if len(entry_types) != 1:
+            raise BadParameters('Cannot force params when multiple media types found')
+        forced_parser = list(entry_types)[0]
+        try:
+            forced_params = forced_parser.parse_parameters(force_params, targets_multiple_sources=len(inp) > 1)
+        except BadParameters as err:
+            raise BadParameters('Incorrect parameters for "%s" media type: %s' % (forced_parser.FORCE_NAME, err.msg))
+        # re-parse entries
+        logging.debug('Re-parsing entries as forced params detected')
+        need_reparse = True
+
+    suffix_sources = inp if suffix_sources is None else suffix_sources
+    if len(entry_types) == 1 and list(entry_types)[0].STRIP_SUFFIX:
+        suffix = get_suffix(suffix_sources)
+        logging.info('Detected suffix as "%s", re-parsing entries' % suffix)
+        need_reparse = True
+
+    if need_reparse:
+        entries = []
+
+        for fentry in inp:
+            got = parse_fentry(fentry, suffix, forced_parser, forced_params, target_quality)
+            logging.debug('Parsed entry "%s"' % got[0].full_name)
+            entries.extend(got)
+
+    entries.sort(key=lambda fe: fe.comparing_key)
+    return entries
+
+def make_batches(entries: typing.List[MediaEntry], args: argparse.Namespace, logpath: str) -> list:
+    catalog = None if args.no_catalog else os.path.abspath(args.catalog or get_default_catalog())
+    publish = args.publish_bwlimit * 1048576 if args.publish or args.publish_bwlimit else None
+    new_tasks = []
+    for entry in entries:
+        tasks = entry.make_encode_tasks(os.path.abspath(args.dest), logpath or None, args.drop_video, catalog, publish, args.fused_audio)
+        record = [task for task in tasks if isinstance(task, RecordResultTask)]
+        if record and record[0].reuse_known():
+            logging.info('Skipping "%s" as it was already encoded the same way' % entry.full_name)
+            continue
+        new_tasks.append(tasks)
+    if args.predict or args.max_size_ratio:
+        new_tasks = predict_batches(new_tasks, args.max_size_ratio, args.interactive)
+    return merge_same_source(new_tasks)
+
+def run_daemon(args: argparse.Namespace, state: TaskStore, spool: Spool, forced_parser: MediaEntry, forced_params: dict, logpath: str):
+    watcher = LibraryWatcher(args.watch, state.path + '.library.json', exclude=[args.dest], settle_time=args.settle_time)
+    first_run = not watcher.is_initialized
+    logging.info('Scanning library roots: %s' % ', '.join(watcher.roots))
+    watcher.scan(mark_seen=first_run and args.skip_existing)
+
+    executor, executor_thread = None, None
+    if not args.nostart:
+        executor = Executor(state, spool=spool, persistent=True, max_preempt=args.max_preempt, arbiter=make_arbiter(args), tracer=make_tracer(args), memory_budget=args.memory_budget, control_path=get_socket_path(state.path), planner=make_planner(args), device_limits=parse_io_limits(args.io_limit))
+        executor_thread = threading.Thread(target=executor.execute, name='executor')
+        executor_thread.daemon = True
+        executor_thread.start()
+        Executor.install_signal_handlers()
+    try:
+        watch_library(args, watcher, spool, forced_parser, forced_params, logpath, executor_thread)
+    finally:
+        if executor is not None:
+            executor.stop_all()
+
+def watch_library(args: argparse.Namespace, watcher: LibraryWatcher, spool: Spool, forced_parser: MediaEntry, forced_params: dict, logpath: str,
+                  executor_thread: threading.Thread):
+    logging.info('Watching library for new files')
+    while executor_thread is None or executor_thread.is_alive():
+        for path in watcher.poll():
+            siblings = get_files(watcher.get_siblings(path))
+            try:
+                entries = parse_entries(get_files([path]), forced_parser, forced_params, args.force_params, args.target_quality, siblings)
+                batches = make_batches(entries, args, logpath)
+            except (BadParameters, UnknownFile) as err:
+                logging.error('Cannot enqueue "%s": %s' % (path, getattr(err, 'msg', err)))
+            except (ValueError, OSError) as err:
+                # mkvmerge fails on files still being copied, try again later
+                logging.error('Cannot enqueue "%s", retrying in %d seconds: %s' % (path, watcher.RETRY_DELAY, err))
+                watcher.postpone(path, watcher.RETRY_DELAY)
+                continue
+            else:
+                if batches:
+                    spool.put([make_batch(tasks, args.priority, args.deadline) for tasks in batches])
+                    logging.info('Enqueued %d batch(es) for "%s"' % (len(batches), path))
+            watcher.mark_done(path)
+
+def predict_batches(batches: list, max_ratio: float, interactive: bool) -> list:
+    result = []
+    for batch in batches:
+        encoder = batch[0].encoder
+        try:
+            prediction = predict_encode(encoder)
+        except (TranscodingFailure, ValueError, OSError) as err:
+            logging.warning('Cannot predict encoding of "%s", queueing it as is: %s' % (encoder.media.full_name, err))
+            prediction = None
+        encoder.prediction = prediction
+        if prediction is not None:
+            ratio = float(prediction.size) / max(prediction.source_size, 1)
+            if max_ratio and ratio > max_ratio:
+                logging.warning('Rejecting "%s": predicted size is %.0f%% of source' % (encoder.media.full_name, ratio * 100))
+                continue
+            if interactive and not confirm_yesno('Queue "%s" (%s)?' % (encoder.media.full_name, describe_prediction(prediction))):
+                continue
+        result.append(batch)
+    return result
+
+def make_arbiter(args: argparse.Namespace) -> Arbiter:
+    if args.arbiter is None:
+        return None
+    return Arbiter(args.arbiter or None)
+
+def make_tracer(args: argparse.Namespace) -> TraceWriter:
+    return TraceWriter(os.path.abspath(args.trace)) if args.trace else None
+
+def make_planner(args: argparse.Namespace) -> SpeedPlanner:
+    return SpeedPlanner() if args.plan_speed else None
+
+def make_batch(tasks: list, priority: int=0, deadline: float=None) -> NewBatch:
+    # batch may hold tasks of several encoders of the same source, see merge_same_source()
+    encoders = []
+    for task in tasks:
+        if not any(task.encoder is known for known in encoders):
+            encoders.append(task.encoder)
+    predicted = [encoder.prediction for encoder in encoders if encoder.prediction]
+    note = '; '.join(describe_prediction(prediction) for prediction in predicted)
+    estimate = sum(prediction.encode_time or 0 for prediction in predicted) if predicted else None
+    names = []
+    for encoder in encoders:
+        if encoder.media.full_name not in names:
+            names.append(encoder.media.full_name)
+    title = ' + '.join(names)
+    return NewBatch(tasks=tasks, title=title, note=note, priority=priority, deadline=deadline, estimate=estimate)
+
+def parse_deadline(value: str) -> float:
+    ''' Accepts "+N" with "m", "h" or "d" suffix, "HH:MM" (next time it comes), "YYYY-MM-DD" or "YYYY-MM-DD HH:MM" '''
+    value = value.strip()
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    if value.startswith('+') and value[-1:] in units:
+        try:
+            return time.time() + float(value[1:-1]) * units[value[-1]]
+        except ValueError:
+            pass
+    for fmt in ('%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt == '%H:%M':
+            now = datetime.datetime.now()
+            parsed = now.replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+            if parsed <= now:
+                parsed += datetime.timedelta(days=1)
+        return time.mktime(parsed.timetuple())
+    raise argparse.ArgumentTypeError('cannot parse deadline "%s"' % value)
+
+AUTO_MEMORY_SHARE = 0.9 # of cgroup limit or physical memory, the rest is left for the system and page cache
+
+def parse_io_limits(values: typing.List[str]) -> typing.Dict[str, int]:
+    result = {}
+    for value in values:
+        path, sep, limit = value.rpartition('=')
+        if not sep or not path or not limit.isdigit():
+            sys.exit('Bad IO limit "%s", should be PATH=N' % value)
+        result[get_device_name(path)] = int(limit)
+    return result
+
+def parse_memory_budget(value: str) -> int:
+    ''' Accepts "auto", "0" (no limit) or a size like "24G" '''
+    if value.strip().lower() == 'auto':
+        return int(get_memory_limit() * AUTO_MEMORY_SHARE)
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('cannot parse memory size "%s"' % value)
+
+def describe_deadline(deadline: float, eta: float) -> str:
+    result = 'deadline %s' % time.strftime('%Y-%m-%d %H:%M', time.localtime(deadline))
+    if deadline < time.time():
+        return result + ', overdue'
+    if eta is None:
+        return result + ', no estimate (use --predict)'
+    return result + ', %s, expected by %s' % ('on track' if eta <= deadline else 'at risk', time.strftime('%Y-%m-%d %H:%M', time.localtime(eta)))
+
+def get_etas(batches: list) -> dict:
+    '''
+    Roughly estimates when each batch is done going through batches in the order executor picks them,
+    assuming as many of them are encoded at once as there are second pass slots
+    '''
+    result, total = {}, 0
+    now = time.time()
+    for batch in sorted(batches, key=lambda batch: (-batch.priority, batch.deadline or float('inf'), batch.batch_id)):
+        total += batch.estimate or 0
+        result[batch.batch_id] = now + total / Vp9CrfEncode2PassTask.static_limit if batch.estimate else None
+    return result
+
+def show_status(state: TaskStore, spool: Spool):
+    batches = state.get_status()
+    spooled = spool.pending_count()
+    if spooled:
+        print('%d batch file(s) are waiting in spool "%s"' % (spooled, spool.path))
+    if not batches:
+        print('Nothing is queued in "%s"' % state.path)
+        return
+    etas = get_etas(batches)
+    for batch in batches:
+        print('% 4d. %s%s: %d task(s) left - %s' % (batch.batch_id, '[failed] ' if batch.status == TaskStatus.FAILED else '',
+                                                  batch.title, len(batch.pending_tasks), ', '.join(batch.pending_tasks)))
+        if batch.note:
+            print('      %s' % batch.note)
+        if batch.error:
+            print('      %s' % batch.error)
+        urgency = []
+        if batch.priority:
+            urgency.append('priority %d' % batch.priority)
+        if batch.deadline:
+            urgency.append(describe_deadline(batch.deadline, etas[batch.batch_id]))
+        if urgency:
+            print('      %s' % ', '.join(urgency))
+
+def describe_control_status(status: dict) -> str:
+    lines = ['Starting new tasks: %s' % ('draining' if status['draining'] else 'yes' if status['admitting'] else 'paused')]
+    budgets = []
+    if status['cpu_budget']:
+        budgets.append('cpu %d cores' % status['cpu_budget'])
+    if status['memory_budget']:
+        budgets.append('memory %.1f of %.1f GiB reserved' % (status['memory_reserved'] / 1073741824., status['memory_budget'] / 1073741824.))
+    if budgets:
+        lines.append('Budgets: %s' % ', '.join(budgets))
+    if status['limits']:
+        lines.append('Limits: %s' % ', '.join('%s=%d' % pair for pair in sorted(status['limits'].items())))
+    if status.get('device_limits'):
+        lines.append('Device limits: %s' % ', '.join('%s=%d' % pair for pair in sorted(status['device_limits'].items())))
+    for title, tasks in (('Running', status['running']), ('Paused', status['paused'])):
+        for task in tasks:
+            lines.append('%s: %s [batch %s, %s, %d core(s), %.1f GiB]' % (title, task['task'], task['batch'], task['resource'],
+                                                                          task['cores'], task['memory'] / 1073741824.))
+    if status['waiting_for_retry']:
+        lines.append('Waiting for retry: %d task(s)' % status['waiting_for_retry'])
+    for batch in status['batches']:
+        lines.append('% 4d. priority %d%s: %d task(s) queued, %d unfinished' % (batch['batch'], batch['priority'],
+                     ', deadline %s' % time.strftime('%Y-%m-%d %H:%M', time.localtime(batch['deadline'])) if batch['deadline'] else '',
+                     batch['queued'], batch['unfinished']))
+    return '\n'.join(lines)
+
+def run_ctl(argv: typing.List[str]):
+    parser = argparse.ArgumentParser(prog='main.py ctl', description='Control running executor')
+    parser.add_argument('--dest', metavar='DEST_PATH', type=str, default='', help='Target directory the executor was started with')
+    parser.add_argument('--state', metavar='STATE_FILENAME', type=str, default='', help='State file the executor was started with')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help='Show running tasks, queued batches, limits and budgets')
+    commands.add_parser('pause', help='Stop starting new tasks, running ones continue')
+    commands.add_parser('resume', help='Start new tasks again')
+    commands.add_parser('drain', help='Stop starting new tasks and exit when running ones finish')
+    limit = commands.add_parser('limit', help='Override how many tasks of a kind (like Vp9CrfEncode2Pass) may run at once')
+    limit.add_argument('kind', type=str)
+    limit.add_argument('limit', type=str, help='Number or "default" to drop the override')
+    io_limit = commands.add_parser('io-limit', help='Override how many IO tasks may use a device at once')
+    io_limit.add_argument('device', type=str, help='Device name as shown in status, or any path on it')
+    io_limit.add_argument('limit', type=str, help='Number or "default" to drop the override')
+    budget = commands.add_parser('budget', help='Change budgets of starting new tasks')
+    budget.add_argument('--cpu', type=int, default=None, help='Cores all running CPU tasks may use (0 for no limit)')
+    budget.add_argument('--memory', type=parse_memory_budget, default=None, help='Total estimated peak memory of running tasks ("auto", 0 for no limit)')
+    priority = commands.add_parser('priority', help='Change priority and deadline of a batch')
+    priority.add_argument('batch', type=int)
+    priority.add_argument('priority', type=int)
+    priority.add_argument('--deadline', type=parse_deadline, default=None)
+    cancel = commands.add_parser('cancel', help='Drop a batch, its running tasks are stopped')
+    cancel.add_argument('batch', type=int)
+    args = parser.parse_args(argv)
+
+    if not args.command or not (args.dest or args.state):
+        parser.print_help()
+        sys.exit('Please specify a command and either --dest or --state')
+    state_path = os.path.abspath(args.state or os.path.join(args.dest, 'tasks.sqlite'))
+    request = {'command': args.command}
+    if args.command == 'limit':
+        request.update(kind=args.kind, limit=None if args.limit == 'default' else int(args.limit))
+    elif args.command == 'io-limit':
+        request.update(device=get_device_name(args.device) if os.path.exists(args.device) else args.device,
+                       limit=None if args.limit == 'default' else int(args.limit))
+    elif args.command == 'budget':
+        request.update(cpu=args.cpu, memory=args.memory)
+    elif args.command == 'priority':
+        request.update(batch=args.batch, priority=args.priority)
+        if args.deadline:
+            request.update(deadline=args.deadline)
+    elif args.command == 'cancel':
+        request.update(batch=args.batch)
+    try:
+        result = send_command(get_socket_path(state_path), request)
+    except ControlError as err:
+        sys.exit(str(err))
+    print(describe_control_status(result) if args.command == 'status' else 'Done')
+
 def main():
+    if sys.argv[1:2] == ['ctl']:
+        run_ctl(sys.argv[2:])
+        return
     upcast_choices = set()
     for val in UPCAST.values():
         upcast_choices |= set(val)
@@ -73,6 +402,28 @@ def main():
     parser.add_argument('--force-type', choices=[media_parser.FORCE_NAME for media_parser in ALL_PARSERS], help='Force media type')
     parser.add_argument('--force-params', type=str, default='', help='Additional parameters for forced media type')
     parser.add_argument('--list-params', action='store_true', help='Show parameters accepted by each media type')
+    parser.add_argument('--predict', action='store_true', help='Encode a few short samples of each item to predict output size and encode time before queueing')
+    parser.add_argument('--max-size-ratio', type=float, default=0, help='Reject items predicted to be bigger than this share of the source (implies --predict)')
+    parser.add_argument('--status', action='store_true', help='Show queued work and exit')
+    parser.add_argument('--retry-failed', action='store_true', help='Put batches quarantined after failures back to the queue, tasks already done are not redone')
+    parser.add_argument('--report', action='store_true', help='Show resources used by finished tasks and exit')
+    parser.add_argument('--publish', action='store_true', help='Write outputs to local temporary directory first and move them to DEST_PATH in background, verified and atomically')
+    parser.add_argument('--publish-bwlimit', metavar='MIB_PER_SEC', type=float, default=0, help='Limit bandwidth of moving outputs to DEST_PATH (implies --publish, 0 means no limit)')
+    parser.add_argument('--fused-audio', action='store_true', help='Normalize stereo tracks with ffmpeg loudnorm filter right from the source in one task per track, without a lossy downmixed intermediate file and ffmpeg-normalize')
+    parser.add_argument('--catalog', metavar='CATALOG_FILENAME', type=str, default='', help='Path to catalog of encoded results used to skip sources already encoded the same way')
+    parser.add_argument('--no-catalog', action='store_true', help='Neither look up nor record results in the catalog')
+    parser.add_argument('--watch', metavar='LIBRARY_ROOT', action='append', default=[], help='Run as a daemon watching given library root (can be repeated) for new files, enqueue and encode them')
+    parser.add_argument('--settle-time', type=float, default=60, help='Seconds a new file should stay unchanged before it is enqueued in --watch mode')
+    parser.add_argument('--skip-existing', action='store_true', help='When watching a library for the first time, only enqueue files appearing after the initial scan')
+    parser.add_argument('--priority', type=int, default=0, help='Priority of enqueued items, batches with bigger priority get free slots first')
+    parser.add_argument('--deadline', type=parse_deadline, default=None, help='When enqueued items are needed: "+N" with "m", "h" or "d" suffix, "HH:MM" or "YYYY-MM-DD[ HH:MM]"; among same priority batches earlier deadline goes first')
+    parser.add_argument('--plan-speed', action='store_true', help='Speed up encoding settings of queued batches as much as needed to meet their deadlines, based on measured encoding throughput')
+    parser.add_argument('--arbiter', metavar='ARBITER_DIR', nargs='?', const='', default=None, help='Lease CPU and IO slots from a host-wide token pool shared with other executors using the same directory (default: /run/vp9ify)')
+    parser.add_argument('--trace', metavar='TRACE_FILENAME', type=str, default='', help='Write timeline of executor activity (tasks per slot, slot usage, queue depth, state lock waits) to a file loadable in chrome://tracing or Perfetto')
+    parser.add_argument('--memory-budget', metavar='SIZE', type=parse_memory_budget, default='auto', help='Do not start tasks whose estimated peak memory would exceed this total, like "24G"; "auto" (default) is 90%% of cgroup memory limit or physical memory, 0 disables')
+    parser.add_argument('--io-limit', metavar='PATH=N', action='append', default=[], help='Allow at most N IO tasks (extracting, remuxing, publishing and such) at once on the device holding PATH, like "/mnt/nas=1" (can be repeated); by default 4 IO tasks may use a device at once')
+    parser.add_argument('--max-preempt', metavar='N', type=int, default=0, help='Allow pausing up to N running lower priority tasks when higher priority ones are waiting (0 disables)')
+    parser.add_argument('--spool', action='store_true', help='Enqueue by dropping a batch file to spool directory next to the state, running executor picks it up immediately')
     args = parser.parse_args()
 
     if args.list_params:
@@ -109,10 +460,29 @@ def main():
         if not args.dest:
             parser.print_help()
             sys.exit("Please specify either dest path or --state")
-        resume_file = os.path.abspath(os.path.join(args.dest, 'tasks.pickle'))
+        resume_file = os.path.abspath(os.path.join(args.dest, 'tasks.sqlite'))
+        legacy_file = os.path.abspath(os.path.join(args.dest, 'tasks.pickle'))
     else:
         resume_file = os.path.abspath(args.state)
-    state = LockedState(resume_file)
+        legacy_file = None
+    try:
+        state = TaskStore(resume_file)
+        if legacy_file and os.path.exists(legacy_file):
+            state.import_legacy(legacy_file)
+    except LegacyStateError as err:
+        sys.exit(str(err))
+    spool = Spool(resume_file + '.spool')
+    USAGE_LOG.path = resume_file + '.usage.jsonl'
+    MEMORY_HISTORY.path = resume_file + '.memory.json'
+    THROUGHPUT_HISTORY.path = resume_file + '.throughput.json'
+    if args.status:
+        show_status(state, spool)
+        return
+    if args.report:
+        print(USAGE_LOG.describe())
+        return
+    if args.retry_failed:
+        logging.info('Requeued %d failed batch(es)' % state.requeue_failed())
 
     if args.log or args.dest:
         logpath = os.path.abspath(args.log or os.path.join(args.dest, 'recode.log'))
@@ -123,78 +493,49 @@ def main():
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
+    if args.watch:
+        if not args.dest:
+            parser.print_help()
+            sys.exit('You must specify DEST_PATH when watching library')
+        run_daemon(args, state, spool, forced_parser, forced_params, logpath)
+        return
+
     if not args.resume:
         if not args.source or not args.dest:
             parser.print_help()
             sys.exit('You must specify at least one source item and DEST_PATH when running without --resume')
         inp = get_files([os.path.abspath(f) for f in args.source])
         logging.info('Found %d items' % len(inp))
-        suffix = ''
-
-        entries = []
-        entry_types = set()
-
-        for fentry in inp:
-            got = parse_fentry(fentry, suffix, forced_parser, forced_params, args.target_quality)
-            logging.debug('Parsed entry "%s"' % got[0].full_name)
-            entries.extend(got)
-            entry_types |= set(type(entry) for entry in got)
-
-        need_reparse = False
-        if not forced_parser and args.force_params:
-            if len(entry_types) != 1:
-                sys.exit('Cannot force params when multiple media types found')
-            forced_parser = list(entry_types)[0]
-            try:
-                forced_params = forced_parser.parse_parameters(args.force_params, targets_multiple_sources=len(args.source) > 1)
-            except BadParameters as err:
-                sys.exit('Incorrect parameters for "%s" media type: %s' % (forced_parser.FORCE_NAME, err.msg))
-            # re-parse entries
-            logging.debug('Re-parsing entries as forced params detected')
-            need_reparse = True
-        
-        if len(entry_types) == 1 and list(entry_types)[0].STRIP_SUFFIX:
-            suffix = get_suffix(inp)
-            logging.info('Detected suffix as "%s", re-parsing entries' % suffix)
-            need_reparse = True
-
-        if need_reparse:
-            entries = []
-
-            for fentry in inp:
-                got = parse_fentry(fentry, suffix, forced_parser, forced_params, args.target_quality)
-                logging.debug('Parsed entry "%s"' % got[0].full_name)
-                entries.extend(got)
-
-        entries.sort(key=lambda fe: fe.comparing_key)
+        try:
+            entries = parse_entries(inp, forced_parser, forced_params, args.force_params, args.target_quality)
+        except BadParameters as err:
+            sys.exit(err.msg)
         if args.interactive:
             for entry in entries:
                 entry.interact()
 
-        new_tasks = [entry.make_encode_tasks(os.path.abspath(args.dest), logpath or None, args.drop_video) for entry in entries]
-        with state:
-            try:
-                tasks = state.read()
-            except IOError:
-                tasks = []
-                logging.info('Resume file "%s" does not exist, starting from scratch' % resume_file)
-                state_existed = False
-            else:
-                logging.info('Resume file "%s" exists, appending' % resume_file)
-                state_existed = True
-            tasks.extend(new_tasks)
-            state.write(tasks)
+        new_tasks = make_batches(entries, args, logpath)
+        state_existed = state.has_pending()
+        if state_existed:
+            logging.info('Resume file "%s" has unfinished work, appending' % resume_file)
+        else:
+            logging.info('Resume file "%s" has no unfinished work, starting from scratch' % resume_file)
+        if args.spool:
+            logging.info('Spooled new batches to "%s"' % spool.put([make_batch(tasks, args.priority, args.deadline) for tasks in new_tasks]))
+        else:
+            state.add_batches([make_batch(tasks, args.priority, args.deadline) for tasks in new_tasks])
 
     if args.scriptize:
         logging.info('Scriptizing started')
-        Executor(state, scriptize=True).execute()
+        Executor(state, scriptize=True, spool=spool).execute()
         logging.info('Scriptizing stopped')
     elif not args.nostart:
         if not args.resume and state_existed and not confirm_yesno('State file already exists, are you sure encoding is not running in the background', False):
             logging.info('State file already exists, probably recoding is running in the background. Appended new tasks, now exiting')
             return
         logging.info('Recoding started')
-        Executor(state).execute()
+        logging.debug('Capabilities: %s' % CAPABILITIES.describe())
+        Executor(state, spool=spool, max_preempt=args.max_preempt, arbiter=make_arbiter(args), tracer=make_tracer(args), memory_budget=args.memory_budget, control_path=get_socket_path(state.path), planner=make_planner(args), device_limits=parse_io_limits(args.io_limit)).execute()
         logging.info('Recoding stopped')
 
 if __name__ == '__main__':
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import signal
+import subprocess
+import threading
+import collections
+import logging
+import typing
+
+from .helpers import ensuredir
+
+Usage = collections.namedtuple('Usage', 'wall paused user sys max_rss voluntary_switches involuntary_switches read_bytes write_bytes')
+
+LOW_PARALLELISM = 0.5 # tasks using less than this share of cores allocated to them are reported
+
+def _read_io(pid: int) -> typing.Tuple[int, int]:
+    # bytes which went to storage, unlike rchar/wchar these do not count page cache hits or pipes
+    try:
+        with open('/proc/%d/io' % pid) as inp:
+            fields = dict(line.split(':', 1) for line in inp if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return 0, 0
+
+def _get_tree(pid: int) -> typing.List[int]:
+    ''' Lists the process and its living descendants via children of its threads '''
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        try:
+            threads = os.listdir('/proc/%d/task' % current)
+        except OSError:
+            continue
+        for tid in threads:
+            try:
+                with open('/proc/%d/task/%s/children' % (current, tid)) as inp:
+                    stack.extend(int(child) for child in inp.read().split())
+            except (IOError, OSError, ValueError):
+                continue
+    return pids
+
+class MonitoredProcess(object):
+    '''
+    Runs a command in its own process group, samples IO counters of its process tree while
+    it runs and collects its rusage at exit. Counters of finished descendants are folded
+    into their parents by the kernel, so maximum of sampled group sums is a good total.
+    '''
+    SAMPLE_PERIOD = 1.0
+
+    def __init__(self, cmd: typing.List[str], watchdog: typing.Callable[[], str]=None, **kw):
+        self.watchdog = watchdog # called every sample, process group is terminated if it returns a reason
+        self.aborted = None
+        self.popen = subprocess.Popen(cmd, start_new_session=True, **kw)
+        self.started = time.time()
+        self.paused_at, self.paused = None, 0
+        self.io = (0, 0)
+        self.usage = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    @property
+    def pid(self) -> int:
+        return self.popen.pid
+
+    def signal_group(self, signum) -> bool:
+        with self.lock:
+            if self.popen.returncode is not None:
+                return False
+            try:
+                os.killpg(self.pid, signum)
+            except OSError as err:
+                logging.debug('Cannot send signal %s to process group %s: %s' % (signum, self.pid, err))
+                return False
+            if signum == signal.SIGSTOP and self.paused_at is None:
+                self.paused_at = time.time()
+            elif signum == signal.SIGCONT and self.paused_at is not None:
+                self.paused += time.time() - self.paused_at
+                self.paused_at = None
+            return True
+
+    def __sample(self):
+        totals = [0, 0]
+        for pid in _get_tree(self.pid):
+            for idx, value in enumerate(_read_io(pid)):
+                totals[idx] += value
+        self.io = tuple(max(old, new) for old, new in zip(self.io, totals))
+
+    def __check(self):
+        if self.watchdog is None or self.aborted is not None or self.paused_at is not None:
+            return
+        try:
+            reason = self.watchdog()
+        except Exception:
+            logging.exception('Watchdog of process %s failed' % self.pid)
+            return
+        if reason:
+            self.aborted = reason
+            if self.signal_group(signal.SIGTERM):
+                self.signal_group(signal.SIGCONT)
+
+    def __sample_loop(self):
+        while not self.done.wait(self.SAMPLE_PERIOD):
+            self.__sample()
+            self.__check()
+
+    def wait(self) -> int:
+        sampler = threading.Thread(target=self.__sample_loop, name='sampler-%d' % self.pid)
+        sampler.daemon = True
+        sampler.start()
+        try:
+            # wait for exit without reaping, so the counters of the zombie can still be read
+            os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+            self.__sample()
+        finally:
+            self.done.set()
+        with self.lock:
+            _, status, rusage = os.wait4(self.pid, 0)
+            self.popen.returncode = os.waitstatus_to_exitcode(status)
+        self.usage = Usage(wall=time.time() - self.started, paused=self.paused,
+                           user=rusage.ru_utime, sys=rusage.ru_stime, max_rss=rusage.ru_maxrss * 1024,
+                           voluntary_switches=rusage.ru_nvcsw, involuntary_switches=rusage.ru_nivcsw,
+                           read_bytes=self.io[0], write_bytes=self.io[1])
+        return self.popen.returncode
+
+def get_parallelism(usage: Usage) -> float:
+    running = usage.wall - usage.paused
+    return (usage.user + usage.sys) / running if running > 0 else 0
+
+def is_underused(usage: Usage, cores: int) -> bool:
+    return cores > 1 and get_parallelism(usage) < cores * LOW_PARALLELISM
+
+def _human_size(value: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024:
+            break
+        value /= 1024.
+    return '%.1f %s' % (value, unit)
+
+def describe_usage(usage: Usage, cores: int) -> str:
+    return 'wall %.1fs (paused %.1fs), cpu %.1fs user + %.1fs sys, %.2f of %d cores, max rss %s, ' \
+           'read %s, written %s, context switches %d voluntary + %d involuntary' % (
+            usage.wall, usage.paused, usage.user, usage.sys, get_parallelism(usage), cores,
+            _human_size(usage.max_rss), _human_size(usage.read_bytes), _human_size(usage.write_bytes),
+            usage.voluntary_switches, usage.involuntary_switches)
+
+class UsageLog(object):
+    '''Appends one JSON record per finished command, path is not set unless accounting is wanted'''
+    def __init__(self, path: str=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, task: str, media: str, tool: str, cores: int, returncode: int, usage: Usage):
+        if not self.path:
+            return
+        entry = dict(usage._asdict(), time=time.time(), task=task, media=media, tool=tool, cores=cores,
+                     returncode=returncode, parallelism=get_parallelism(usage))
+        with self.lock:
+            try:
+                ensuredir(os.path.dirname(self.path))
+                with open(self.path, 'a') as out:
+                    out.write(json.dumps(entry, sort_keys=True) + '\n')
+            except (IOError, OSError) as err:
+                logging.warning('Cannot record usage to "%s": %s' % (self.path, err))
+
+    def read(self) -> typing.List[dict]:
+        entries = []
+        try:
+            with open(self.path) as inp:
+                for line in inp:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except (IOError, OSError):
+            pass
+        return entries
+
+    def describe(self) -> str:
+        entries = self.read()
+        if not entries:
+            return 'No usage recorded in "%s"' % self.path
+        lines = []
+        for entry in entries:
+            usage = Usage(**{field: entry[field] for field in Usage._fields})
+            lines.append('%s%s (%s): %s' % ('[underused] ' if is_underused(usage, entry['cores']) else '',
+                                           entry['task'], entry['media'], describe_usage(usage, entry['cores'])))
+        underused = sum(1 for line in lines if line.startswith('[underused]'))
+        if underused:
+            lines.append('%d of %d tasks used less than %d%% of cores allocated to them' % (underused, len(lines), LOW_PARALLELISM * 100))
+        return '\n'.join(lines)
+
+USAGE_LOG = UsageLog()
+
+class MemoryHistory(object):
+    '''
+    Learns how peak memory of tasks relates to their static estimates: keeps a ratio per task kind
+    which jumps up right away when a task used more than expected and slowly goes down otherwise.
+    Stored as JSON, path is not set unless learning is wanted.
+    '''
+    DECAY = 0.3 # weight of a new observation below current ratio
+    HEADROOM = 1.1
+    MIN_RATIO = 0.25 # short or broken runs should not make estimates meaningless
+
+    def __init__(self, path: str=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ratios = None
+
+    def __load(self) -> dict:
+        if self.ratios is None:
+            try:
+                with open(self.path) as inp:
+                    self.ratios = {key: float(value) for key, value in json.load(inp).items()}
+            except (IOError, OSError, ValueError, TypeError, AttributeError):
+                self.ratios = {}
+        return self.ratios
+
+    def estimate(self, kind: str, static: int) -> int:
+        if not self.path:
+            return static
+        with self.lock:
+            ratio = self.__load().get(kind)
+        return int(static * max(ratio, self.MIN_RATIO) * self.HEADROOM) if ratio else static
+
+    def record(self, kind: str, static: int, max_rss: int):
+        if not self.path or not static or not max_rss:
+            return
+        with self.lock:
+            ratios = self.__load()
+            observed = float(max_rss) / static
+            old = ratios.get(kind)
+            ratios[kind] = observed if old is None or observed > old else old + (observed - old) * self.DECAY
+            try:
+                ensuredir(os.path.dirname(self.path))
+                tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as out:
+                    json.dump(ratios, out, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except (IOError, OSError) as err:
+                logging.warning('Cannot record memory usage to "%s": %s' % (self.path, err))
+
+MEMORY_HISTORY = MemoryHistory()
+
+class ThroughputHistory(object):
+    '''
+    Keeps measured speed of encoders per task kind and speed setting, in pixel-seconds
+    of source encoded per second of (not paused) run time, as JSON. Path is not set unless it is wanted.
+    '''
+    WEIGHT = 0.3 # of a new measurement
+
+    def __init__(self, path: str=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.rates = None
+
+    def __load(self) -> dict:
+        if self.rates is None:
+            try:
+                with open(self.path) as inp:
+                    self.rates = {kind: {str(value): float(rate) for value, rate in values.items()}
+                                  for kind, values in json.load(inp).items()}
+            except (IOError, OSError, ValueError, TypeError, AttributeError):
+                self.rates = {}
+        return self.rates
+
+    def get(self, kind: str) -> typing.Dict[str, float]:
+        ''' Returns known rates of given task kind by setting (as a string) '''
+        if not self.path:
+            return {}
+        with self.lock:
+            return dict(self.__load().get(kind, {}))
+
+    def record(self, kind: str, setting, work: float, seconds: float):
+        if not self.path or work <= 0 or seconds <= 0:
+            return
+        with self.lock:
+            values = self.__load().setdefault(kind, {})
+            rate, old = work / seconds, values.get(str(setting))
+            values[str(setting)] = rate if old is None else old + (rate - old) * self.WEIGHT
+            try:
+                ensuredir(os.path.dirname(self.path))
+                tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as out:
+                    json.dump(self.rates, out, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except (IOError, OSError) as err:
+                logging.warning('Cannot record throughput to "%s": %s' % (self.path, err))
+
+THROUGHPUT_HISTORY = ThroughputHistory()
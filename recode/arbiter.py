@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import math
+import errno
+import tempfile
+import logging
+import typing
+
+from .helpers import ensuredir, get_num_threads
+from .tasks import ResourceKind
+
+if sys.platform != 'win32':
+    import fcntl #pylint: disable=import-error
+
+def get_default_path() -> str:
+    for base in ('/run', os.environ.get('XDG_RUNTIME_DIR')):
+        if base and os.access(base, os.W_OK):
+            return os.path.join(base, 'vp9ify')
+    return os.path.join(tempfile.gettempdir(), 'vp9ify-%d' % os.getuid())
+
+def _try_lock(path: str):
+    ''' Returns open file holding exclusive lock on path or None if it is locked by someone else '''
+    handle = open(path, 'a')
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as err:
+        handle.close()
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return handle
+
+class Lease(object):
+    __slots__ = ('kind', 'handles')
+    def __init__(self, kind: str, handles: list):
+        self.kind = kind
+        self.handles = handles
+
+    @property
+    def amount(self) -> int:
+        return len(self.handles)
+
+    def release(self):
+        for handle in self.handles:
+            handle.close()
+        self.handles = []
+
+class Arbiter(object):
+    '''
+    Host-wide pool of CPU and IO tokens shared by all executors which use the same directory.
+    A token is a file, holding it means holding a flock on it, so tokens of a crashed executor are
+    released by the kernel. Every executor registers its queue by locking a file of its own;
+    a queue holding at least its fair share of tokens (capacity divided by amount of live queues)
+    cannot lease more while other queues are waiting for tokens of the same kind.
+    Capacities are read from "pool.json" in the directory which is created with defaults if missing.
+    '''
+    DEFAULT_IO_TOKENS = 4
+
+    def __init__(self, path: str=None):
+        self.path = os.path.abspath(path or get_default_path())
+        self.queues = os.path.join(self.path, 'queues')
+        ensuredir(self.queues)
+        self.name = '%d-%x' % (os.getpid(), id(self))
+        self.held = {}
+        self.queue_handle = None
+        if sys.platform != 'win32':
+            self.queue_handle = _try_lock(self.__queue_path(self.name))
+        self.capacity = self.__read_capacity()
+        logging.info('Using resource arbiter at "%s" with capacity %s' % (self.path,
+                     ', '.join('%s=%d' % pair for pair in sorted(self.capacity.items()))))
+
+    def __queue_path(self, name: str, suffix: str='.queue') -> str:
+        return os.path.join(self.queues, name + suffix)
+
+    def __read_capacity(self) -> typing.Dict[str, int]:
+        config = os.path.join(self.path, 'pool.json')
+        defaults = {ResourceKind.CPU: get_num_threads(), ResourceKind.IO: self.DEFAULT_IO_TOKENS}
+        try:
+            with open(config) as inp:
+                capacity = json.load(inp)
+        except (IOError, OSError, ValueError):
+            capacity = {}
+            tmp_path = '%s.%s.tmp' % (config, self.name)
+            try:
+                with open(tmp_path, 'w') as out:
+                    json.dump(defaults, out, indent=1, sort_keys=True)
+                # do not overwrite pool.json if someone has just created it
+                os.link(tmp_path, config)
+            except OSError:
+                pass
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        return {kind: max(1, int(capacity.get(kind, value))) for kind, value in defaults.items()}
+
+    def __get_queues(self) -> typing.List[str]:
+        ''' Lists live queues removing ones left by dead executors '''
+        result = []
+        for fname in os.listdir(self.queues):
+            if not fname.endswith('.queue'):
+                continue
+            name = fname[:-len('.queue')]
+            if name != self.name:
+                handle = _try_lock(self.__queue_path(name))
+                if handle is not None:
+                    # nobody holds it, so its owner is gone
+                    for stale in [fname] + [other for other in os.listdir(self.queues) if other.startswith(name + '.waiting-')]:
+                        try:
+                            os.unlink(os.path.join(self.queues, stale))
+                        except OSError:
+                            pass
+                    handle.close()
+                    continue
+            result.append(name)
+        return result
+
+    def mark_waiting(self, kind: str, waiting: bool):
+        if self.queue_handle is None:
+            return
+        path = self.__queue_path(self.name, '.waiting-%s' % kind.replace('/', ''))
+        if waiting:
+            open(path, 'a').close()
+        elif os.path.exists(path):
+            os.unlink(path)
+
+    def __is_waiting(self, name: str, kind: str) -> bool:
+        return os.path.exists(self.__queue_path(name, '.waiting-%s' % kind.replace('/', '')))
+
+    def acquire(self, kind: str, amount: int=1) -> Lease:
+        ''' Returns a lease for given amount of tokens of given kind or None if they cannot be given now '''
+        if self.queue_handle is None:
+            return Lease(kind, [])
+        capacity = self.capacity[kind]
+        amount = max(1, min(amount, capacity))
+        held = self.held.get(kind, 0)
+        queues = self.__get_queues()
+        share = int(math.ceil(float(capacity) / max(1, len(queues))))
+        if held and held + amount > share and any(self.__is_waiting(name, kind) for name in queues if name != self.name):
+            logging.debug('Over fair share of %d %s token(s) while other queues wait' % (share, kind))
+            return None
+        handles = []
+        prefix = os.path.join(self.path, kind.replace('/', ''))
+        for idx in range(capacity):
+            handle = _try_lock('%s.%d.token' % (prefix, idx))
+            if handle is not None:
+                handles.append(handle)
+                if len(handles) == amount:
+                    break
+        if len(handles) < amount:
+            for handle in handles:
+                handle.close()
+            self.mark_waiting(kind, True)
+            return None
+        self.mark_waiting(kind, False)
+        self.held[kind] = held + amount
+        return Lease(kind, handles)
+
+    def release(self, lease: Lease):
+        if lease.handles:
+            self.held[lease.kind] = self.held.get(lease.kind, 0) - lease.amount
+        lease.release()
+
+    def close(self):
+        if self.queue_handle is not None:
+            for kind in self.capacity:
+                self.mark_waiting(kind, False)
+            try:
+                os.unlink(self.__queue_path(self.name))
+            except OSError:
+                pass
+            self.queue_handle.close()
+            self.queue_handle = None
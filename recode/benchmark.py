@@ -0,0 +1,203 @@
+'''
+Microbenchmarks of the orchestrator alone: executor scheduling and task state storage
+measured on synthetic queues of stub tasks, no media tools are run.
+
+    python -m recode.benchmark --sizes 10,1000,50000 --output bench.json [--baseline old.json]
+
+Exits with code 1 when a metric got worse than the baseline by more than the threshold.
+'''
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import logging
+import typing
+
+from .tasks import IParallelTask, Executor, Resource, ResourceKind
+from .task_store import TaskStore, NewBatch
+
+class FakeTask(IParallelTask):
+    ''' Task which sleeps or spins for given time, limits and blockers mimic ones of a real batch '''
+    __slots__ = ('batch', 'name', 'resource', 'limit', 'blockers', 'duration', 'spin')
+    def __init__(self, batch: int, name: str, resource: Resource, limit: int, blockers=(), duration=0.0, spin=False):
+        self.batch, self.name, self.resource, self.limit = batch, name, resource, limit
+        self.blockers, self.duration, self.spin = tuple(blockers), duration, spin
+
+    def get_limit(self, candidate_tasks, running_tasks) -> int:
+        return self.limit
+
+    def can_run(self, batch_tasks) -> bool:
+        return not any(isinstance(task, FakeTask) and task.name in self.blockers for task in batch_tasks)
+
+    def __call__(self):
+        if self.spin:
+            until = time.time() + self.duration
+            while time.time() < until:
+                pass
+        elif self.duration:
+            time.sleep(self.duration)
+
+    def scriptize(self):
+        pass
+
+    def __str__(self):
+        return '%s (fake %d)' % (self.name, self.batch)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and (self.batch, self.name) == (other.batch, other.name)
+
+    __hash__ = object.__hash__
+
+def make_batch_tasks(batch: int, audio_tracks: int=2, duration: float=0.0, spin: bool=False) -> typing.List[FakeTask]:
+    ''' Same shape as a VP9 batch: two video passes, extract and normalize per audio track, then remux and cleanup '''
+    def task(name, kind, priority, limit, blockers=()):
+        return FakeTask(batch, name, Resource(kind, priority), limit, blockers, duration, spin)
+    audio = []
+    for track in range(audio_tracks):
+        audio.append(task('Extract-%d' % track, ResourceKind.IO, 1, 4))
+        audio.append(task('Normalize-%d' % track, ResourceKind.CPU, 2, 4, ['Extract-%d' % track]))
+    produced = ['Pass1', 'Pass2'] + [t.name for t in audio]
+    return [task('RemoveScript', ResourceKind.IO, 0, 30),
+            task('Pass1', ResourceKind.CPU, 1, 5),
+            task('Pass2', ResourceKind.CPU, 0, 2, ['Pass1'])] + audio + \
+           [task('Remux', ResourceKind.IO, 0, 2, produced),
+            task('Cleanup', ResourceKind.IO, 2, 10, produced + ['Remux'])]
+
+def _percentile(values: typing.List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+def _state_size(path: str) -> int:
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+def bench_store(path: str, size: int, samples: int) -> dict:
+    store = TaskStore(path)
+    batches = [NewBatch(tasks=make_batch_tasks(idx), title='fake %d' % idx, note='') for idx in range(size)]
+    started = time.time()
+    batch_ids = store.add_batches(batches)
+    enqueue = time.time() - started
+
+    latencies = []
+    for batch_id in batch_ids[:samples]:
+        started = time.time()
+        store.mark_done(batch_id, 0)
+        latencies.append(time.time() - started)
+
+    started = time.time()
+    TaskStore(path).read_pending()
+    load = time.time() - started
+    return {'enqueue_per_batch_ms': enqueue / size * 1000, 'mark_done_ms': sum(latencies) / len(latencies) * 1000,
+            'mark_done_p99_ms': _percentile(latencies, 0.99) * 1000, 'state_bytes_per_batch': _state_size(path) / size,
+            'resume_load_s': load}
+
+DECISIONS_TIME_LIMIT = 30 # seconds, huge queues get fewer decisions timed
+
+def bench_executor(path: str, decisions: int) -> dict:
+    ''' Times scheduling decisions of an executor over the state, running tasks "finish" instantly '''
+    gc.collect()
+    tracemalloc.start()
+    started = time.time()
+    executor = Executor(TaskStore(path))
+    startup = time.time() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pop = executor._Executor__pop_next_task
+    holds = []
+    while len(holds) < decisions and sum(holds) < DECISIONS_TIME_LIMIT:
+        started = time.time()
+        list_idx, task_idx, task, _ = pop() # it holds the executor lock for the whole call
+        holds.append(time.time() - started)
+        if task is None:
+            break
+        executor.running.remove(task)
+        executor.unfinished[list_idx][task_idx] = None
+    return {'startup_s': startup, 'startup_peak_bytes': peak, 'decisions_per_s': len(holds) / sum(holds),
+            'lock_hold_ms': sum(holds) / len(holds) * 1000, 'lock_hold_p99_ms': _percentile(holds, 0.99) * 1000,
+            'lock_hold_max_ms': max(holds) * 1000}
+
+def bench_end_to_end(path: str, size: int, duration: float, spin: bool) -> dict:
+    ''' Runs a small queue of sleeping or spinning tasks through the real executor loop '''
+    store = TaskStore(path)
+    store.add_batches([NewBatch(tasks=make_batch_tasks(idx, duration=duration, spin=spin), title='fake %d' % idx, note='')
+                       for idx in range(size)])
+    total = size * len(make_batch_tasks(0))
+    started = time.time()
+    Executor(store).execute()
+    elapsed = time.time() - started
+    return {'tasks_per_s': total / elapsed, 'busy_share': total * duration / elapsed}
+
+# metrics where bigger value is better, all others are better when smaller
+HIGHER_IS_BETTER = {'decisions_per_s', 'tasks_per_s', 'busy_share'}
+
+def run(sizes: typing.List[int], decisions: int, samples: int, end_to_end: int, duration: float, spin: bool) -> dict:
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='vp9ify-bench-')
+    try:
+        for size in sizes:
+            path = os.path.join(workdir, 'state-%d.sqlite' % size)
+            result = bench_store(path, size, samples)
+            result.update(bench_executor(path, decisions))
+            results[str(size)] = result
+        if end_to_end:
+            results['end-to-end-%d' % end_to_end] = bench_end_to_end(os.path.join(workdir, 'state-e2e.sqlite'), end_to_end, duration, spin)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {'created': time.time(), 'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+
+def compare(current: dict, baseline: dict, threshold: float) -> typing.List[str]:
+    regressions = []
+    for name, metrics in sorted(current['results'].items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get('results', {}).get(name, {}).get(metric)
+            if not old or not value:
+                continue
+            worse = old / value if metric in HIGHER_IS_BETTER else value / old
+            if worse > threshold:
+                regressions.append('%s %s: %.4g -> %.4g (%.2fx worse)' % (name, metric, old, value, worse))
+    return regressions
+
+def describe(report: dict) -> str:
+    lines = []
+    for name, metrics in sorted(report['results'].items(), key=lambda item: (not item[0].isdigit(), int(item[0]) if item[0].isdigit() else 0, item[0])):
+        lines.append('%s:' % name)
+        for metric, value in sorted(metrics.items()):
+            lines.append('    %s = %.4g' % (metric, value))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark task executor and state storage with fake tasks')
+    parser.add_argument('--sizes', type=str, default='10,1000,10000,50000', help='Comma-separated amounts of batches in synthetic queues')
+    parser.add_argument('--decisions', type=int, default=200, help='Scheduling decisions to time per queue')
+    parser.add_argument('--samples', type=int, default=200, help='State writes to time per queue')
+    parser.add_argument('--end-to-end', metavar='N', type=int, default=0, help='Also run N batches of sleeping tasks through the real executor loop')
+    parser.add_argument('--duration', type=float, default=0.05, help='Seconds each task of the end to end run takes')
+    parser.add_argument('--spin', action='store_true', help='Spin instead of sleeping in end to end tasks')
+    parser.add_argument('--output', metavar='RESULT_FILENAME', type=str, default='', help='Save results as JSON')
+    parser.add_argument('--baseline', metavar='BASELINE_FILENAME', type=str, default='', help='Compare with results saved earlier')
+    parser.add_argument('--threshold', type=float, default=1.25, help='How many times worse than baseline a metric may get')
+    args = parser.parse_args()
+    # executor reports every task it starts, keep only problems
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s|%(levelname)s|%(message)s')
+
+    report = run([int(size) for size in args.sizes.split(',') if size], args.decisions, args.samples, args.end_to_end, args.duration, args.spin)
+    print(describe(report))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as inp:
+            regressions = compare(report, json.load(inp), args.threshold)
+        for line in regressions:
+            print('REGRESSION: %s' % line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import errno
+import subprocess
+import threading
+import logging
+import typing
+
+from .helpers import which, ensuredir
+
+def _get_cache_path() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'vp9ify', 'capabilities.json')
+
+class Capabilities(object):
+    '''
+    Lazily finds tool paths, their versions and encoders available in ffmpeg.
+    Probing results are cached on disk keyed by tool path and refreshed when the binary changes
+    (its mtime or size differs), so processes after the first one do not spawn anything.
+    '''
+    KNOWN_ENCODERS = ('libvpx-vp9', 'libx265', 'libsvtav1', 'libfdk_aac', 'libvorbis', 'libopus')
+
+    def __init__(self, cache_path: str=None):
+        self.cache_path = cache_path or _get_cache_path()
+        self.lock = threading.Lock()
+        self.cache = None
+
+    def tool(self, name: str, env_name: str=None) -> str:
+        return which(name, env_name)
+
+    def __load(self) -> dict:
+        if self.cache is None:
+            try:
+                with open(self.cache_path) as inp:
+                    self.cache = json.load(inp)
+            except (IOError, OSError, ValueError):
+                self.cache = {}
+        return self.cache
+
+    def __save(self):
+        tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+        try:
+            ensuredir(os.path.dirname(self.cache_path))
+            with open(tmp_path, 'w') as out:
+                json.dump(self.cache, out, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as err:
+            logging.debug('Cannot save capabilities cache "%s": %s' % (self.cache_path, err))
+
+    @staticmethod
+    def __get_stamp(path: str) -> list:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_mtime, stat.st_size]
+
+    @staticmethod
+    def __run(cmd: typing.List[str]) -> str:
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode('utf8', 'replace')
+
+    def __probe(self, path: str, key: str, prober: typing.Callable[[str], typing.Any]):
+        with self.lock:
+            cache = self.__load()
+            stamp = self.__get_stamp(path)
+            entry = cache.get(path)
+            if entry is None or entry.get('stamp') != stamp:
+                entry = cache[path] = {'stamp': stamp}
+            if key not in entry:
+                logging.debug('Probing %s of "%s"' % (key, path))
+                entry[key] = prober(path)
+                self.__save()
+            return entry[key]
+
+    def __probe_version(self, path: str) -> str:
+        for flag in ('-version', '--version'):
+            try:
+                out = self.__run([path, flag])
+            except (subprocess.CalledProcessError, OSError):
+                continue
+            lines = out.strip().splitlines()
+            if lines:
+                return lines[0].strip()
+        return 'unknown'
+
+    def __probe_encoders(self, path: str) -> typing.List[str]:
+        try:
+            out = self.__run([path, '-hide_banner', '-encoders'])
+        except (subprocess.CalledProcessError, OSError) as err:
+            raise RuntimeError('Cannot get ffmpeg encoders: %s' % err)
+        result = []
+        for line in out.splitlines():
+            parts = line.split()
+            # encoder lines look like " V....D libvpx-vp9  libvpx VP9 (codec vp9)"
+            if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in 'VAS':
+                result.append(parts[1])
+        return sorted(result)
+
+    def version(self, name: str, env_name: str=None) -> str:
+        return self.__probe(self.tool(name, env_name), 'version', self.__probe_version)
+
+    def encoders(self) -> typing.FrozenSet[str]:
+        if sys.platform == 'win32':
+            # stubbed testing mode
+            return frozenset(self.KNOWN_ENCODERS)
+        return frozenset(self.__probe(self.tool('ffmpeg', 'FFMPEG_PATH'), 'encoders', self.__probe_encoders))
+
+    def has_encoder(self, name: str) -> bool:
+        return name in self.encoders()
+
+    def describe(self) -> str:
+        encoders = self.encoders()
+        return 'ffmpeg: %s; encoders: %s' % (self.version('ffmpeg', 'FFMPEG_PATH'),
+                                             ', '.join('%s=%s' % (enc, 'yes' if enc in encoders else 'no') for enc in self.KNOWN_ENCODERS))
+
+CAPABILITIES = Capabilities()
+
+class Tool(object):
+    ''' Class attribute resolving path to a tool on first access instead of import time '''
+    def __init__(self, name: str, env_name: str=None):
+        self.name = name
+        self.env_name = env_name
+
+    def __get__(self, obj, owner) -> str:
+        return CAPABILITIES.tool(self.name, self.env_name)
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import collections
+import logging
+import typing
+
+from .helpers import ensuredir
+
+CatalogEntry = collections.namedtuple('CatalogEntry', 'key fingerprint profile source outputs encode_time timings created')
+
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 65536
+
+_fingerprints = {}
+
+def fingerprint(path: str) -> str:
+    '''
+    Fast content fingerprint of a file: hash of its size and a few evenly spaced blocks,
+    so it survives renames and moves without reading the whole file
+    '''
+    stat = os.stat(path)
+    cache_key = (path, stat.st_size, stat.st_mtime)
+    try:
+        return _fingerprints[cache_key]
+    except KeyError:
+        pass
+    digest = hashlib.sha256(b'%d:' % stat.st_size)
+    with open(path, 'rb') as inp:
+        if stat.st_size <= FINGERPRINT_BLOCKS * FINGERPRINT_BLOCK_SIZE:
+            digest.update(inp.read())
+        else:
+            step = (stat.st_size - FINGERPRINT_BLOCK_SIZE) // (FINGERPRINT_BLOCKS - 1)
+            for idx in range(FINGERPRINT_BLOCKS):
+                inp.seek(idx * step)
+                digest.update(inp.read(FINGERPRINT_BLOCK_SIZE))
+    result = _fingerprints[cache_key] = digest.hexdigest()
+    return result
+
+def get_default_path() -> str:
+    base = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(base, 'vp9ify', 'catalog.sqlite')
+
+class ResultCatalog(object):
+    '''
+    Persistent catalog of encoding results keyed by source content fingerprint and encoding profile
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            profile TEXT NOT NULL,
+            source TEXT NOT NULL,
+            outputs TEXT NOT NULL,
+            encode_time REAL,
+            timings TEXT NOT NULL DEFAULT '{}',
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS results_fingerprint ON results (fingerprint);
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        ensuredir(os.path.dirname(path))
+        conn = self._connect()
+        try:
+            conn.executescript(self.SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    @staticmethod
+    def make_key(fingerprint: str, profile: str) -> str:
+        return hashlib.sha256(('%s|%s' % (fingerprint, profile)).encode('utf8')).hexdigest()
+
+    def lookup(self, key: str) -> typing.Optional[CatalogEntry]:
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT key, fingerprint, profile, source, outputs, encode_time, timings, created FROM results WHERE key = ?',
+                               (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        key, fprint, profile, source, outputs, encode_time, timings, created = row
+        return CatalogEntry(key=key, fingerprint=fprint, profile=profile, source=source,
+                            outputs=[tuple(out) for out in json.loads(outputs)], encode_time=encode_time,
+                            timings=json.loads(timings), created=created)
+
+    def record(self, key: str, fingerprint: str, profile: str, source: str,
+               outputs: typing.List[typing.Tuple[str, int]], timings: typing.Dict[str, float]):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO results (key, fingerprint, profile, source, outputs, encode_time, timings, created) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (key, fingerprint, profile, source, json.dumps(outputs),
+                          sum(timings.values()) if timings else None, json.dumps(timings), time.time()))
+        finally:
+            conn.close()
+        logging.debug('Recorded results for "%s" in catalog "%s"' % (source, self.path))
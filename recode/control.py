@@ -0,0 +1,110 @@
+import os
+import json
+import socket
+import hashlib
+import tempfile
+import threading
+import logging
+import typing
+
+MAX_SOCKET_PATH = 100 # sun_path is about 108 bytes
+
+class ControlError(Exception):
+    pass
+
+def get_socket_path(state_path: str) -> str:
+    path = state_path + '.ctl'
+    if len(path.encode('utf8')) > MAX_SOCKET_PATH:
+        path = os.path.join(tempfile.gettempdir(), 'vp9ify-%s.ctl' % hashlib.sha1(state_path.encode('utf8')).hexdigest()[:12])
+    return path
+
+class ControlServer(object):
+    '''
+    Serves local JSON requests over a Unix socket: every connection sends one JSON object
+    with "command" key on a line and gets {"ok": true, "result": ...} or {"ok": false, "error": ...} back.
+    '''
+    def __init__(self, path: str, handler: typing.Callable[[dict], typing.Any]):
+        self.path = path
+        self.handler = handler
+        self.sock = None
+        self.thread = None
+
+    def start(self) -> bool:
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # left by a dead executor
+                os.unlink(self.path)
+            else:
+                logging.warning('Control socket "%s" is served by another executor, not serving it' % self.path)
+                return False
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(4)
+        self.thread = threading.Thread(target=self.__serve, name='control')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('Accepting control commands at "%s"' % self.path)
+        return True
+
+    def __serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                # closed
+                return
+            try:
+                self.__handle(conn)
+            except Exception:
+                logging.exception('Error serving control connection')
+            finally:
+                conn.close()
+
+    def __handle(self, conn: socket.socket):
+        conn.settimeout(10)
+        with conn.makefile('rb') as inp:
+            line = inp.readline()
+        try:
+            request = json.loads(line.decode('utf8'))
+            if not isinstance(request, dict):
+                raise ControlError('request should be a JSON object')
+            logging.info('Control command: %s' % json.dumps(request, sort_keys=True))
+            reply = {'ok': True, 'result': self.handler(request)}
+        except (ControlError, ValueError, TypeError, KeyError) as err:
+            reply = {'ok': False, 'error': str(err)}
+        conn.sendall(json.dumps(reply, sort_keys=True).encode('utf8') + b'\n')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+def send_command(path: str, request: dict, timeout: float=30) -> typing.Any:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(path)
+        except OSError as err:
+            raise ControlError('Cannot connect to executor at "%s": %s' % (path, err))
+        sock.sendall(json.dumps(request).encode('utf8') + b'\n')
+        with sock.makefile('rb') as inp:
+            reply = json.loads(inp.readline().decode('utf8'))
+    finally:
+        sock.close()
+    if not reply.get('ok'):
+        raise ControlError(reply.get('error') or 'unknown error')
+    return reply.get('result')
@@ -1,40 +1,105 @@
 import os
 import tempfile
+import glob
+import errno
 
-from ..helpers import which, chop_tail, ensuredir
+from ..helpers import chop_tail, ensuredir, set_slots_state
+from ..capabilities import Tool
 from ..media.info import MediaInfo
 from ..media.base import MediaEntry
 
 
 class AbstractEncoder(object):
-    FFMPEG = which('ffmpeg', 'FFMPEG_PATH')
-    FFMPEG_NORM = which('ffmpeg-normalize', 'FFMPEG_NORM_PATH')
-    MKVEXTRACT = which('mkvextract')
+    __slots__ = ('media', 'tempfiles', 'patterns', 'dest', 'stdout', 'drop_video', 'tmpdir', 'tmp_tag', 'prediction', 'catalog', 'timings', 'publish', 'fuse_audio')
+    FFMPEG = Tool('ffmpeg', 'FFMPEG_PATH')
+    FFMPEG_NORM = Tool('ffmpeg-normalize', 'FFMPEG_NORM_PATH')
+    MKVEXTRACT = Tool('mkvextract')
     SUFFIX = ''
 
-    def __init__(self, media: MediaEntry, dest: str, stdout: str=None, drop_video: bool=False):
+    def __init__(self, media: MediaEntry, dest: str, stdout: str=None, drop_video: bool=False, catalog: str=None, publish: float=None,
+                 fuse_audio: bool=False):
         self.media = media
-        self.src = media.src
-        self.info = MediaInfo.parse(self.src)
         self.tempfiles = []
         self.patterns = []
         self.dest = dest
         self.stdout = stdout or None
         self.drop_video = drop_video
+        self.tmpdir = tempfile.gettempdir()
+        self.tmp_tag = ''
+        self.prediction = None
+        self.catalog = catalog
+        self.timings = {}
+        self.publish = publish # None to write outputs right to dest, otherwise bandwidth limit (0 for none) of moving them there from scratch
+        self.fuse_audio = fuse_audio # whether stereo tracks are normalized with ffmpeg loudnorm right from the source
+
+    def __setstate__(self, state):
+        # encoders of legacy pickled states lack slots added later
+        set_slots_state(self, state, dict(drop_video=False, tmpdir=tempfile.gettempdir(), tmp_tag='', prediction=None, catalog=None,
+                                          timings={}, publish=None, fuse_audio=False))
+
+    @property
+    def src(self) -> str:
+        return self.media.src
+
+    @property
+    def info(self) -> MediaInfo:
+        return self.media.info
+
+    def get_profile_key(self) -> str:
+        ''' Describes everything about the way this encoder transforms its source '''
+        return '%s|%s|%r|%s|%s%s' % (self.__class__.__name__, self.SUFFIX, self.media.extra_options,
+                                     self.drop_video, sorted(self.media.ignored_audio_tracks), '|fused-audio' if self.fuse_audio else '')
 
     def _get_tmp_prefix(self):
-        return chop_tail(self.__class__.__name__, 'Encoder').lower()
+        prefix = chop_tail(self.__class__.__name__, 'Encoder').lower()
+        if self.tmp_tag:
+            prefix = '%s-%s' % (prefix, self.tmp_tag)
+        return prefix
 
     def make_tempfile(self, suffix: str='', ext: str='mkv', glob_suffix: str=None) -> str:
-        tmpdir = tempfile.gettempdir()
-        ensuredir(tmpdir)
+        ensuredir(self.tmpdir)
         if self.SUFFIX:
             suffix = '%s[%s]' % (suffix, self.SUFFIX)
-        path = os.path.join(tmpdir, '%s-%s.%s.%s' % (self._get_tmp_prefix(), self.media.unique_name, suffix, ext))
+        path = os.path.join(self.tmpdir, '%s-%s.%s.%s' % (self._get_tmp_prefix(), self.media.unique_name, suffix, ext))
         if path not in self.tempfiles:
             self.tempfiles.append(path)
         if glob_suffix:
             pattern = path + glob_suffix
             if pattern not in self.patterns:
                 self.patterns.append(pattern)
-        return path
\ No newline at end of file
+        return path
+
+    def get_passthrough_flag(self) -> str:
+        ''' Existence of this file means encoding was found unprofitable and source video is to be kept '''
+        return self.make_tempfile('video-passthrough', 'flag')
+
+    def get_progress_path(self) -> str:
+        ''' Where final video encode writes ffmpeg -progress output '''
+        return self.make_tempfile('progress', 'txt')
+
+    def is_video_passthrough(self) -> bool:
+        return os.path.exists(self.get_passthrough_flag())
+
+    def remove_tempfile(self, path: str):
+        ''' Removes a temporary file early along with files matching patterns made for it '''
+        files = [path]
+        for pattern in self.patterns:
+            if pattern.startswith(path):
+                files.extend(glob.glob(pattern))
+        for fname in files:
+            try:
+                os.unlink(fname)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def remove_tempfiles(self):
+        files = list(self.tempfiles)
+        for pattern in self.patterns:
+            files.extend(glob.glob(pattern))
+        for fname in files:
+            try:
+                os.unlink(fname)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
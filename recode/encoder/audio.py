@@ -1,13 +1,18 @@
+import os
+import re
+import json
+import time
 import collections
 import subprocess
 
 AudioCodecOptions = collections.namedtuple('AudioCodecOptions', 'name bitrate extra')
 
 from ..tasks import IParallelTask, Resource, ResourceKind
-from .base_tasks import EncoderTask
+from .base_tasks import EncoderTask, DeviceResource
 from .abstract_encoder import AbstractEncoder
 
 class AudioBaseTask(EncoderTask):
+    __slots__ = ('track_id',)
     def __init__(self, encoder: AbstractEncoder, track_id: int):
         EncoderTask.__init__(self, encoder)
         self.track_id = track_id
@@ -23,7 +28,8 @@ class AudioBaseTask(EncoderTask):
         return '%s-track=%d' % (self._get_name(), self.track_id)
 
 class ExtractStereoAudioTask(AudioBaseTask):
-    resource = Resource(kind=ResourceKind.IO, priority=1)
+    __slots__ = ()
+    resource = DeviceResource(priority=1)
     static_limit = 2
     def __init__(self, encoder: AbstractEncoder, track_id: int):
         AudioBaseTask.__init__(self, encoder, track_id)
@@ -32,7 +38,22 @@ class ExtractStereoAudioTask(AudioBaseTask):
 
     @property
     def produced_files(self):
-        return [self.encoder.make_tempfile('audio-%d-2ch' % self.track_id)]
+        return [self.encoder.make_tempfile('audio-%d-2ch-src' % self.track_id)]
+
+    def _make_command(self):
+        return [self.encoder.FFMPEG, '-i', self.media.src,
+                '-map', '0:%d:0' % self.track_id, '-c:a', 'copy', '-vn',
+                '-y'] + self.produced_files
+
+class CopyAudioTask(AudioBaseTask):
+    ''' Keeps audio track which is already in a codec suitable for target as is '''
+    __slots__ = ()
+    resource = DeviceResource(priority=1)
+    static_limit = 2
+
+    @property
+    def produced_files(self):
+        return [self.encoder.make_tempfile('audio-%d' % self.track_id)]
 
     def _make_command(self):
         return [self.encoder.FFMPEG, '-i', self.media.src,
@@ -43,8 +64,10 @@ class DownmixToStereoTask(AudioBaseTask):
     ''' Extract non-stereo audio tracks with downmixing to stereo for normalizing, so that we have all tracks
     that are normalized (normalizing a properly designed 5.1 audio means destroying its quality, but
     having each instance of original audio as normalized stereo helps when watching on simple, non-5.1-enabled hardware) '''
+    __slots__ = ()
     resource = Resource(kind=ResourceKind.CPU, priority=2)
     static_limit = 6
+    PAN_FILTER = 'pan=stereo|FL < 1.0*FL + 0.707*FC + 0.707*BL|FR < 1.0*FR + 0.707*FC + 0.707*BR'
     def __init__(self, encoder: AbstractEncoder, track_id: int):
         AudioBaseTask.__init__(self, encoder, track_id)
         # this only works with non-stereo
@@ -52,15 +75,16 @@ class DownmixToStereoTask(AudioBaseTask):
 
     @property
     def produced_files(self):
-        return [self.encoder.make_tempfile('audio-%d-2ch' % self.track_id)]
+        return [self.encoder.make_tempfile('audio-%d-2ch-src' % self.track_id)]
 
     def _make_command(self):
         return [self.encoder.FFMPEG, '-i', self.media.src,
                 '-map', '0:%d:0' % self.track_id, '-c:a', 'aac', '-b:a', '512k',
-                '-ac', 2, '-af', 'pan=stereo|FL < 1.0*FL + 0.707*FC + 0.707*BL|FR < 1.0*FR + 0.707*FC + 0.707*BR',
+                '-ac', 2, '-af', self.PAN_FILTER,
                 '-vn', '-y'] + self.produced_files
 
 class NormalizeStereoTask(AudioBaseTask):
+    __slots__ = ()
     resource = Resource(kind=ResourceKind.CPU, priority=2)
     static_limit = 6
     def __init__(self, encoder: AbstractEncoder, track_id: int, parent_task: AudioBaseTask):
@@ -71,16 +95,80 @@ class NormalizeStereoTask(AudioBaseTask):
     def produced_files(self):
         return [self.encoder.make_tempfile('audio-%d-2ch' % self.track_id)]
 
+    @property
+    def consumed_files(self):
+        # written by ExtractStereoAudioTask or DownmixToStereoTask
+        return [self.encoder.make_tempfile('audio-%d-2ch-src' % self.track_id)]
+
     def _make_command(self):
         options = self._get_codec_options()
         bitrate = ['-b:a', options.bitrate] if options.bitrate else []
         extra = ['-e=%s' % subprocess.list2cmdline(str(x) for x in options.extra)] if options.extra else []
-        return [self.encoder.FFMPEG_NORM, self.produced_files[0],
+        return [self.encoder.FFMPEG_NORM, self.consumed_files[0],
                 '-c:a', options.name, '--progress'] + bitrate + extra + ['--dual-mono',
                 '-t', self.media.LUFS_LEVEL, '-f', '-ar', self.media.AUDIO_FREQ,
                 '-vn', '-o'] + self.produced_files
 
+class LoudnormStereoTask(AudioBaseTask):
+    '''
+    Does what ExtractStereoAudioTask or DownmixToStereoTask followed by NormalizeStereoTask do in one task
+    without an intermediate file: ffmpeg loudnorm filter is run right on the (downmixed) source track twice,
+    first pass measures loudness, second one applies it in linear mode and encodes the result.
+    Loudnorm needs the whole track measured before the first sample is written, so the source is decoded twice
+    instead of streaming one decode, which is still cheaper than encoding and decoding a lossy intermediate.
+    '''
+    __slots__ = ()
+    resource = Resource(kind=ResourceKind.CPU, priority=2)
+    static_limit = 6
+    TRUE_PEAK = -2.0 # same as ffmpeg-normalize defaults
+    LOUDNESS_RANGE = 7.0
+    MEASURED = (('measured_I', 'input_i'), ('measured_TP', 'input_tp'), ('measured_LRA', 'input_lra'),
+                ('measured_thresh', 'input_thresh'), ('offset', 'target_offset'))
+
+    @property
+    def produced_files(self):
+        return [self.encoder.make_tempfile('audio-%d-2ch' % self.track_id)]
+
+    def _get_stats_path(self) -> str:
+        return self.encoder.make_tempfile('audio-%d-loudness' % self.track_id, 'log')
+
+    def _get_filters(self, params: list) -> str:
+        loudnorm = [('I', self.media.LUFS_LEVEL), ('TP', self.TRUE_PEAK), ('LRA', self.LOUDNESS_RANGE), ('dual_mono', 'true')] + params
+        filters = [DownmixToStereoTask.PAN_FILTER] if self.info.get_audio_channels()[self.track_id] > 2 else []
+        return ','.join(filters + ['loudnorm=' + ':'.join('%s=%s' % pair for pair in loudnorm)])
+
+    def _make_measure_command(self):
+        return [self.encoder.FFMPEG, '-i', self.media.src, '-map', '0:%d:0' % self.track_id, '-vn',
+                '-af', self._get_filters([('print_format', 'json')]), '-f', 'null', '-']
+
+    def _read_stats(self, path: str) -> list:
+        with open(path, 'rb') as inp:
+            text = inp.read().decode('utf8', 'replace')
+        match = re.search(r'\{[^{}]*"input_i"[^{}]*\}', text)
+        if not match:
+            raise ValueError('No loudness measurements in "%s"' % path)
+        stats = json.loads(match.group(0))
+        return [(param, stats[key]) for param, key in self.MEASURED] + [('linear', 'true')]
+
+    def _make_command(self, measured: list=None):
+        # without measurements (in scripts) loudnorm works in single pass dynamic mode
+        options = self._get_codec_options()
+        bitrate = ['-b:a', options.bitrate] if options.bitrate else []
+        extra = list(options.extra) if options.extra else []
+        return [self.encoder.FFMPEG, '-i', self.media.src, '-map', '0:%d:0' % self.track_id, '-vn',
+                '-af', self._get_filters(measured or []), '-ar', self.media.AUDIO_FREQ,
+                '-c:a', options.name] + bitrate + extra + ['-y'] + self.produced_files
+
+    def __call__(self):
+        started = time.time()
+        stats = self._get_stats_path()
+        self._run_command(self._make_measure_command(), log=stats)
+        measured = self._read_stats(stats) if os.path.exists(stats) else None
+        self._run_command(self._make_command(measured))
+        self.encoder.timings[self.name] = time.time() - started
+
 class AudioEncodeTask(AudioBaseTask):
+    __slots__ = ()
     resource = Resource(kind=ResourceKind.CPU, priority=2)
     static_limit = 6
     def __init__(self, encoder: AbstractEncoder, track_id: int):
@@ -0,0 +1,86 @@
+import collections
+
+# audio_bitrate: Opus bitrate per channel in kbit/s
+# min_saving: percent the video should be smaller than the source by, otherwise source video is kept (0 disables)
+Av1CrfOptions = collections.namedtuple('Av1CrfOptions', 'target_1080_crf preset audio_bitrate min_saving', defaults=(10,))
+
+from ..helpers import get_num_threads
+from ..tasks import Resource, ResourceKind
+from .base_tasks import VideoEncodeTask
+from .audio import NormalizeStereoTask, LoudnormStereoTask, AudioEncodeTask, AudioCodecOptions
+from .base_encoder import BaseEncoder
+
+class OpusNormalize(NormalizeStereoTask):
+    __slots__ = ()
+    def _get_codec_options(self):
+        return AudioCodecOptions(name='libopus', bitrate='%dk' % (self.media.extra_options.audio_bitrate * 2), extra=())
+
+class OpusLoudnorm(LoudnormStereoTask):
+    __slots__ = ()
+    _get_codec_options = OpusNormalize._get_codec_options
+
+class OpusEncode(AudioEncodeTask):
+    __slots__ = ()
+    def _get_codec_options(self):
+        channels = self.info.get_audio_channels()[self.track_id]
+        # mapping family 1 makes libopus accept surround layouts up to 7.1
+        return AudioCodecOptions(name='libopus', bitrate='%dk' % (self.media.extra_options.audio_bitrate * channels),
+                                 extra=('-mapping_family', 1))
+
+class Av1EncodeTask(VideoEncodeTask):
+    __slots__ = ()
+    resource = Resource(kind=ResourceKind.CPU, priority=0)
+    static_limit = 1 # a single SVT-AV1 process keeps all cores busy
+    MEMORY_PER_PIXEL = 1000
+    SPEED_OPTION = 'preset'
+    SPEED_CHOICES = (2, 3, 4, 5, 6, 7, 8, 9, 10)
+
+    @property
+    def cores(self):
+        return get_num_threads()
+
+    @property
+    def produced_files(self):
+        return [self.encoder.make_tempfile('av1-audio=no')]
+
+    def _make_command(self):
+        crf = (self.encoder.CRF_PROP * self.info.get_video_diagonal() ** self.encoder.CRF_POW) * \
+                self.media.extra_options.target_1080_crf / self.encoder.CRF_AV1_1080P
+        crf = max(self.encoder.MIN_CRF, min(self.encoder.MAX_CRF, crf))
+        return [self.encoder.FFMPEG] + self._get_input() + ['-g', 240,
+               '-map', '0:v', '-c:v', 'libsvtav1', '-an', '-crf', int(crf), '-preset', self.media.extra_options.preset,
+               '-pix_fmt', 'yuv420p10le', '-svtav1-params', 'tune=0:enable-overlays=1:scd=1',
+               '-y'] + self.produced_files
+
+class AV1CRFEncoder(BaseEncoder):
+    '''
+    SVT-AV1 in CRF mode, single pass. Unlike libvpx-vp9, which does not go much beyond 3-4 cores
+    per process, SVT-AV1 splits a frame into many segments and keeps all cores busy itself,
+    so only one encode is run at a time.
+
+    CRF-from-diagonal follows the same power curve as VP9 one (see VP9CRFEncoder),
+    scaled so that 1080p gets CRF 35 which is about where SVT-AV1 1080p visually matches VP9 CRF 31:
+    >>> a*(math.hypot(1920,1080)**b)
+    35.0
+
+    Current approach of encoding the file:
+        $FFMPEG_PATH -i "$1" -g 240 -map 0:v -c:v libsvtav1 -an -crf 32 -preset 6 -pix_fmt yuv420p10le -svtav1-params tune=0:enable-overlays=1:scd=1 -y "$TARGET_NOEXT-av1-audio=no.mkv"
+    '''
+    __slots__ = ()
+
+    CRF_PROP = 86.49838416812865
+    CRF_POW = -0.11754124960465037
+    CRF_AV1_1080P = 35.0
+    # CRF = (CRF_PROP * video_diagonal ** CRF_POW) / (CRF_AV1_1080P / TARGET_1080_QUALITY)
+    MIN_CRF, MAX_CRF = 1, 63
+
+    NormalizeStereo = OpusNormalize
+    LoudnormStereo = OpusLoudnorm
+    AudioEncode = OpusEncode
+
+    COPY_VIDEO_CODECS = ('AV1',)
+    COPY_AUDIO_CODECS = ('Opus', 'Vorbis')
+    COPY_MAX_1080P_BITRATE = 4000000
+
+    def _make_video_tasks(self):
+        return [Av1EncodeTask(self)]
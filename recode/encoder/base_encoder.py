@@ -1,5 +1,6 @@
 import tempfile
 import os
+import math
 import logging
 import typing
 
@@ -7,15 +8,23 @@ from ..media.info import MediaInfo, AudioInfo
 from ..media.base import MediaEntry
 
 from .abstract_encoder import AbstractEncoder
-from .base_tasks import EncoderTask, RemoveScriptTask, RemuxTask, ExtractSubtitlesTask, CleanupTempfiles
-from .audio import AudioBaseTask, ExtractStereoAudioTask, DownmixToStereoTask, NormalizeStereoTask, AudioEncodeTask
+from .base_tasks import EncoderTask, RemoveScriptTask, RemuxTask, ExtractSubtitlesTask, CleanupTempfiles, RecordResultTask, CopyVideoTask, PublishTask
+from .audio import AudioBaseTask, ExtractStereoAudioTask, DownmixToStereoTask, NormalizeStereoTask, LoudnormStereoTask, AudioEncodeTask, CopyAudioTask
 
 class BaseEncoder(AbstractEncoder):
+    __slots__ = ()
     NormalizeStereo = NormalizeStereoTask
+    LoudnormStereo = LoudnormStereoTask
     AudioEncode = AudioEncodeTask
     ExtractSubtitles = ExtractSubtitlesTask
     Remux = RemuxTask
 
+    # substrings of mkvmerge codec names which target container accepts and which are kept as is when sensible
+    COPY_VIDEO_CODECS = ()
+    COPY_AUDIO_CODECS = ()
+    COPY_MAX_1080P_BITRATE = 0 # video above this bitrate (scaled by frame diagonal) is re-encoded
+    COPY_MAX_CHANNEL_BITRATE = 128000 # audio above this bitrate per channel is re-encoded
+
     def __eq__(self, other):
         if not isinstance(other, BaseEncoder):
             return False
@@ -27,16 +36,53 @@ class BaseEncoder(AbstractEncoder):
     def _make_video_tasks(self) -> typing.List[EncoderTask]:
         raise NotImplementedError()
 
+    @staticmethod
+    def _is_codec_in(codec: str, accepted: typing.Sequence[str]) -> bool:
+        codec = (codec or '').upper()
+        return any(name.upper() in codec for name in accepted)
+
+    def _can_copy_video(self) -> bool:
+        track = self.info.get_video_track()
+        if track is None or not self._is_codec_in(track.codec, self.COPY_VIDEO_CODECS):
+            return False
+        try:
+            bitrate = track.bitrate or self.info.get_overall_bitrate()
+            diagonal = self.info.get_video_diagonal()
+        except (ValueError, ZeroDivisionError):
+            # container has no duration (or video no dimensions), bitrate cannot be checked so encode it
+            return False
+        return bitrate <= self.COPY_MAX_1080P_BITRATE * diagonal / math.hypot(1920, 1080)
+
+    def _can_copy_audio(self, audio_info: AudioInfo) -> bool:
+        if not self._is_codec_in(audio_info.codec, self.COPY_AUDIO_CODECS):
+            return False
+        return not audio_info.bitrate or audio_info.bitrate <= self.COPY_MAX_CHANNEL_BITRATE * audio_info.channels
+
+    def _plan_video_tasks(self) -> typing.List[EncoderTask]:
+        if self.drop_video:
+            return []
+        if self._can_copy_video():
+            logging.info('Keeping %s video of "%s" as is' % (self.info.get_video_codec(), self.media.friendly_name))
+            return [CopyVideoTask(self)]
+        return self._make_video_tasks()
+
     def _make_audio_track_tasks(self, audio_info: AudioInfo) -> typing.Tuple[typing.List[AudioBaseTask], typing.List[AudioBaseTask]]:
         intermediate, output = [], []
-        if audio_info.channels <= 2:
-            prepare_2ch_task = ExtractStereoAudioTask(self, audio_info.track_id)
+        keep = self._can_copy_audio(audio_info)
+        if keep and audio_info.channels <= 2:
+            logging.info('Keeping %s audio track %d of "%s" as is' % (audio_info.codec, audio_info.track_id, self.media.friendly_name))
+            return intermediate, [CopyAudioTask(self, audio_info.track_id)]
+        if self.fuse_audio:
+            output.append(self.LoudnormStereo(self, audio_info.track_id))
         else:
-            prepare_2ch_task = DownmixToStereoTask(self, audio_info.track_id)
-        output.append(self.NormalizeStereo(self, audio_info.track_id, prepare_2ch_task))
+            if audio_info.channels <= 2:
+                prepare_2ch_task = ExtractStereoAudioTask(self, audio_info.track_id)
+            else:
+                prepare_2ch_task = DownmixToStereoTask(self, audio_info.track_id)
+            output.append(self.NormalizeStereo(self, audio_info.track_id, prepare_2ch_task))
+            intermediate.append(prepare_2ch_task)
         if audio_info.channels > 2 and self.AudioEncode:
-            output.append(self.AudioEncode(self, audio_info.track_id))
-        intermediate.append(prepare_2ch_task)
+            output.append(CopyAudioTask(self, audio_info.track_id) if keep else self.AudioEncode(self, audio_info.track_id))
         return intermediate, output
 
     def _make_audio_tasks(self) -> typing.Tuple[typing.List[AudioBaseTask], typing.List[AudioBaseTask]]:
@@ -51,9 +97,14 @@ class BaseEncoder(AbstractEncoder):
         return intermediate, output
 
     def make_tasks(self) -> typing.List[EncoderTask]:
-        video_tasks = self._make_video_tasks() if not self.drop_video else []
+        video_tasks = self._plan_video_tasks()
+        # files final video encode makes while running are registered now, so cleanup knows them after resume too
+        self.get_passthrough_flag()
+        self.get_progress_path()
         audio_tasks_intermediate, audio_tasks_output = self._make_audio_tasks()
         remux_task = self.Remux(self, video_tasks, audio_tasks_output)
         extract_subs = [self.ExtractSubtitles(self)] if self.ExtractSubtitles else []
+        publish = [PublishTask(self, [remux_task] + extract_subs)] if self.publish is not None else []
+        record = [RecordResultTask(self, self.catalog, publish or [remux_task] + extract_subs)] if self.catalog else []
         return [RemoveScriptTask(self)] + video_tasks + audio_tasks_intermediate + \
-                audio_tasks_output + [remux_task] + extract_subs + [CleanupTempfiles(self, remux_task)]
+                audio_tasks_output + [remux_task] + extract_subs + publish + record + [CleanupTempfiles(self, (publish or [remux_task])[:1] + record)]
@@ -5,12 +5,16 @@ import subprocess
 import sys
 import stat
 import errno
-import glob
+import signal
+import time
 import typing
 
-from ..helpers import open_with_dir, ensuredir, chop_tail
-from ..tasks import IParallelTask, Resource, ResourceKind
+from ..helpers import open_with_dir, ensuredir, chop_tail, get_device_name, get_slots_state, set_slots_state
+from ..tasks import IParallelTask, Resource, ResourceKind, make_io_kind
 from ..flock import FLock
+from ..accounting import MonitoredProcess, USAGE_LOG, MEMORY_HISTORY, THROUGHPUT_HISTORY, describe_usage, get_parallelism, is_underused
+from ..catalog import ResultCatalog, fingerprint
+from ..publish import publish_file, get_part_path
 
 from .abstract_encoder import AbstractEncoder
 
@@ -19,19 +23,76 @@ class TranscodingFailure(Exception):
         Exception.__init__(self)
         self.err = err
 
+    def __str__(self):
+        return 'return code %s' % self.err.returncode
+
+class DeviceResource(object):
+    '''
+    IO resource of a task keyed by devices its files are on (see EncoderTask.io_paths),
+    so tasks working with different disks or network shares do not take slots from each other
+    '''
+    __slots__ = ('priority',)
+    def __init__(self, priority: int):
+        self.priority = priority
+
+    def __get__(self, task, owner):
+        if task is None:
+            return Resource(kind=ResourceKind.IO, priority=self.priority)
+        kind = getattr(task, 'io_kind', None)
+        if kind is None:
+            # devices of task files do not change, look them up once
+            try:
+                kind = make_io_kind(get_device_name(path) for path in task.io_paths)
+            except (IOError, OSError, ValueError):
+                kind = ResourceKind.IO
+            task.io_kind = kind
+        return Resource(kind=kind, priority=self.priority)
+
 class EncoderTask(IParallelTask):
+    __slots__ = ('encoder', 'blockers', 'process', 'io_kind')
     BLOCKERS = ()
     static_limit = 1
+    preemptible = True
+    MEMORY_BASE = 150 * 1048576 # peak RSS not depending on frame size, bytes
+    MEMORY_PER_PIXEL = 0 # peak RSS per pixel of source frame (frames buffered times bytes per pixel), bytes
+    TRANSIENT_ERRNOS = (errno.EIO, errno.ENOSPC, errno.ENOMEM, errno.EAGAIN, errno.EBUSY, errno.ETIMEDOUT, errno.ESTALE)
+    TRANSIENT_MESSAGES = (b'Input/output error', b'No space left on device', b'Cannot allocate memory',
+                          b'Resource temporarily unavailable', b'Stale file handle')
 
     def __init__(self, encoder: AbstractEncoder):
         self.encoder = encoder
-        self.media = encoder.media
-        self.info = encoder.info
-        self.stdout = encoder.stdout or None
-        self.tmpdir = tempfile.gettempdir()
-        self.dest = encoder.dest
         self.blockers = list(self.BLOCKERS)
-    
+        self.process = None
+        self.io_kind = None
+
+    def __getstate__(self):
+        # running process and looked up devices belong to this run only, devices are looked up anew after loading
+        return get_slots_state(self, transient=('process', 'io_kind'))
+
+    def __setstate__(self, state):
+        # tasks of legacy pickled states lack slots added later
+        set_slots_state(self, state, dict(process=None, io_kind=None, sample=None))
+
+    @property
+    def media(self):
+        return self.encoder.media
+
+    @property
+    def info(self):
+        return self.encoder.info
+
+    @property
+    def stdout(self) -> str:
+        return self.encoder.stdout
+
+    @property
+    def tmpdir(self) -> str:
+        return self.encoder.tmpdir
+
+    @property
+    def dest(self) -> str:
+        return self.encoder.dest
+
     def _get_compare_attrs(self):
         return [self.encoder, self.media, self.stdout, self.blockers, self.dest]
 
@@ -54,8 +115,16 @@ class EncoderTask(IParallelTask):
     def __str__(self):
         return '%s (%s)' % (self.name, self.media.friendly_name)
 
+    @property
+    def encoders(self) -> typing.List[AbstractEncoder]:
+        ''' Encoders this task works for, blockers are looked up among their tasks only '''
+        return [self.encoder]
+
     def can_run(self, batch_tasks: typing.Sequence) -> bool:
-        blockers = [t for t in batch_tasks if isinstance(t, EncoderTask) and t.name in self.blockers]
+        # task names are unique within an encoder only, a merged batch holds tasks of several ones
+        own = self.encoders
+        blockers = [t for t in batch_tasks if isinstance(t, EncoderTask) and t.name in self.blockers and
+                    any(encoder is mine for encoder in t.encoders for mine in own)]
         return not blockers
 
     def _get_stdout(self) -> str:
@@ -64,33 +133,117 @@ class EncoderTask(IParallelTask):
             return '%s-%s-%s%s' % (path, self.name.lower(), self.media.unique_name, ext)
         return None
 
-    def _run_command(self, cmd: list):
+    def _estimate_memory(self) -> int:
+        if not self.MEMORY_PER_PIXEL:
+            return self.MEMORY_BASE
+        try:
+            width, height = self.info.get_video_dimensions()
+        except ValueError:
+            return self.MEMORY_BASE
+        return self.MEMORY_BASE + self.MEMORY_PER_PIXEL * width * height
+
+    @property
+    def memory(self) -> int:
+        return MEMORY_HISTORY.estimate(self._get_name(), self._estimate_memory())
+
+    def _record_throughput(self, seconds: float):
+        pass
+
+    def _get_scratch_path(self, path: str) -> str:
+        ''' Where an output is written before it is published to its place in the library '''
+        if getattr(self.encoder, 'publish', None) is None:
+            return path
+        return self.encoder.make_tempfile('publish', ext=os.path.basename(path))
+
+    def _check_progress(self) -> str:
+        ''' Called periodically while a command runs, returning a reason aborts the command '''
+        return None
+
+    def _run_command(self, cmd: list, log: str=None) -> str:
+        ''' Runs the command writing its output to the task log, or overwriting given log file if there is one '''
         cmd = [str(x) for x in cmd]
-        stdout = self._get_stdout()
+        stdout = log or self._get_stdout()
 
         logging.debug("running command: %s (logs to: %s)" % (subprocess.list2cmdline(cmd), stdout))
         if sys.platform != 'win32':
-            if self.stdout is not None:
-                stdout = open_with_dir(stdout, 'a')
+            if log is not None or self.stdout is not None:
+                stdout = open_with_dir(stdout, 'w' if log is not None else 'a')
             env = dict(os.environ)
             env['FFMPEG_PATH'] = self.encoder.FFMPEG
             env['TMP'] = env['TEMP'] = env['TMPDIR'] = self.tmpdir # for ffmpeg-normalize if run in "--resume" mode without TMP set for vp9ify
             try:
-                subprocess.check_call(cmd, stdout=stdout, stderr=subprocess.STDOUT if stdout is not None else None, env=env)
-            except subprocess.CalledProcessError as err:
-                logging.error('Cannot run transcode, return code: %s' % err.returncode)
-                raise TranscodingFailure(err)
+                # own process group so the whole tree can be paused or stopped at once
+                self.process = MonitoredProcess(cmd, watchdog=self._check_progress, env=env,
+                                                stdout=stdout, stderr=subprocess.STDOUT if stdout is not None else None)
+                returncode = self.process.wait()
+                usage, aborted = self.process.usage, self.process.aborted
             finally:
-                if self.stdout is not None:
+                self.process = None
+                if log is not None or self.stdout is not None:
                     stdout.close()
+            logging.info('%s used: %s' % (self, describe_usage(usage, self.cores)))
+            if is_underused(usage, self.cores):
+                logging.warning('%s used only %.2f of %d cores allocated to it' % (self, get_parallelism(usage), self.cores))
+            USAGE_LOG.record(self.name, self.media.friendly_name, os.path.basename(cmd[0]), self.cores, returncode, usage)
+            if not returncode and not aborted:
+                MEMORY_HISTORY.record(self._get_name(), self._estimate_memory(), usage.max_rss)
+                self._record_throughput(usage.wall - usage.paused)
+            if aborted:
+                logging.warning('Aborted %s: %s' % (self, aborted))
+                return aborted
+            if returncode:
+                logging.error('Cannot run transcode, return code: %s' % returncode)
+                raise TranscodingFailure(subprocess.CalledProcessError(returncode, cmd))
+        return None
+
+    def _read_log_tail(self, size: int=8192) -> bytes:
+        path = self._get_stdout()
+        if not path:
+            return b''
+        try:
+            with open(path, 'rb') as inp:
+                inp.seek(max(0, os.path.getsize(path) - size))
+                return inp.read()
+        except (IOError, OSError):
+            return b''
+
+    def is_transient_failure(self, error) -> bool:
+        if isinstance(error, MemoryError):
+            return True
+        if isinstance(error, (IOError, OSError)):
+            return error.errno in self.TRANSIENT_ERRNOS
+        if isinstance(error, TranscodingFailure):
+            if error.err.returncode in (-signal.SIGKILL, 128 + signal.SIGKILL):
+                # most likely killed by OOM killer
+                return True
+            # tools report failed reads and writes the same way as broken input, tell them apart by the log
+            tail = self._read_log_tail()
+            return any(message in tail for message in self.TRANSIENT_MESSAGES)
+        return False
+
+    def __signal(self, signum) -> bool:
+        process = self.process
+        return process is not None and process.signal_group(signum)
+
+    def pause(self) -> bool:
+        return self.__signal(signal.SIGSTOP)
+
+    def resume(self):
+        self.__signal(signal.SIGCONT)
+
+    def stop(self):
+        if self.__signal(signal.SIGTERM):
+            self.__signal(signal.SIGCONT)
 
     def _make_command(self):
         raise NotImplementedError()
 
     def __call__(self):
+        started = time.time()
         cmd = self._make_command()
         if cmd:
             self._run_command(cmd)
+            self.encoder.timings[self.name] = time.time() - started
 
     def _gen_command(self) -> typing.List[str]:
         return [str(x) for x in self._make_command()]
@@ -126,14 +279,43 @@ class EncoderTask(IParallelTask):
     def produced_files(self) -> typing.List[str]:
         raise NotImplementedError()
 
+    @property
+    def consumed_files(self) -> typing.List[str]:
+        ''' Files made by other tasks of the batch which this task reads '''
+        return []
+
+    @property
+    def io_paths(self) -> typing.List[str]:
+        ''' Files the task reads or writes '''
+        return [self.encoder.src] + self.consumed_files + [self._get_scratch_path(path) for path in self.produced_files]
+
+    def abandon(self):
+        self.encoder.remove_tempfiles()
+
+    def release(self, batch_tasks: typing.Sequence):
+        ''' Removes temporary files this task read or made as soon as no unfinished task of the batch needs them '''
+        needed = set()
+        for task in batch_tasks:
+            if isinstance(task, EncoderTask):
+                needed.update(task.consumed_files)
+                needed.update(task.produced_files)
+        for path in self.consumed_files + self.produced_files:
+            if path not in needed and path in self.encoder.tempfiles:
+                self.encoder.remove_tempfile(path)
+
 class RemoveScriptTask(EncoderTask):
-    resource = Resource(kind=ResourceKind.IO, priority=0)
+    __slots__ = ()
+    resource = DeviceResource(priority=0)
     static_limit = 30
     BLOCKERS = ()
     @property
     def produced_files(self):
         return []
 
+    @property
+    def io_paths(self):
+        return []
+
     def __call__(self):
         pass
 
@@ -148,7 +330,8 @@ class RemoveScriptTask(EncoderTask):
 EncoderTask.BLOCKERS += (RemoveScriptTask._get_name(),)
 
 class RemuxTask(EncoderTask):
-    resource = Resource(kind=ResourceKind.IO, priority=0)
+    __slots__ = ('video_inputs', 'audio_inputs')
+    resource = DeviceResource(priority=0)
     static_limit = 1
     def __init__(self, encoder: AbstractEncoder, video_tasks: typing.List[EncoderTask], audio_tasks: typing.List[EncoderTask]):
         EncoderTask.__init__(self, encoder)
@@ -161,32 +344,53 @@ class RemuxTask(EncoderTask):
             self.audio_inputs.extend(task.produced_files)
         self.blockers.extend(task.name for task in (list(video_tasks) + list(audio_tasks)))
 
+    WEBM_VIDEO = ('VP8', 'VP9', 'AV1')
+
+    def _get_container(self) -> str:
+        if self.media.CONTAINER == 'webm' and self.video_inputs and self.encoder.is_video_passthrough():
+            codec = self.info.get_video_codec().upper()
+            if not any(name in codec for name in self.WEBM_VIDEO):
+                # source video cannot be put in webm as is
+                return 'mkv'
+        return None
+
+    def _get_video_inputs(self) -> typing.List[str]:
+        if self.video_inputs and self.encoder.is_video_passthrough():
+            return [self.encoder.src]
+        return self.video_inputs
+
     @property
     def produced_files(self):
-        return [self.media.get_target_video_path(self.dest, suffix=self.encoder.SUFFIX)]
+        return [self.media.get_target_video_path(self.dest, suffix=self.encoder.SUFFIX, container=self._get_container())]
+
+    @property
+    def consumed_files(self):
+        return self.video_inputs + self.audio_inputs
 
     def _make_command(self):
         cmd = [self.encoder.FFMPEG]
+        video_inputs = self._get_video_inputs()
 
-        for inp in (self.video_inputs + self.audio_inputs + [self.encoder.src]):
+        for inp in (video_inputs + self.audio_inputs + [self.encoder.src]):
             cmd.extend(['-i', inp])
 
         cmd.extend(['-movflags', '+faststart'])
-        for idx in range(len(self.video_inputs)):
+        for idx in range(len(video_inputs)):
             cmd.extend(['-map', '%d:v' % idx])
-        for idx in range(len(self.video_inputs), len(self.video_inputs) + len(self.audio_inputs)):
+        for idx in range(len(video_inputs), len(video_inputs) + len(self.audio_inputs)):
             cmd.extend(['-map', '%d:a' % idx])
 
-        idx = str(len(self.video_inputs) + len(self.audio_inputs))
+        idx = str(len(video_inputs) + len(self.audio_inputs))
         cmd.extend(['-map_chapters', idx, '-map_metadata', idx])
 
-        target = self.produced_files[0]
+        target = self._get_scratch_path(self.produced_files[0])
         ensuredir(os.path.dirname(target))
         cmd.extend(['-c', 'copy', '-y', target])
         return cmd
 
 class ExtractSubtitlesTask(EncoderTask):
-    resource = Resource(kind=ResourceKind.IO, priority=1)
+    __slots__ = ()
+    resource = DeviceResource(priority=1)
     static_limit = 2
     @property
     def produced_files(self):
@@ -200,40 +404,269 @@ class ExtractSubtitlesTask(EncoderTask):
         subtitles = self.info.get_subtitles()
         if subtitles:
             cmd = [self.encoder.MKVEXTRACT, 'tracks', self.media.src]
-            for sub, subpath in zip(subtitles, self.produced_files):
+            for sub, subpath in zip(subtitles, map(self._get_scratch_path, self.produced_files)):
                 ensuredir(os.path.dirname(subpath))
                 cmd.append('%s:%s' % (sub.track_id, subpath))
             return cmd
         return []
 
+class PublishTask(EncoderTask):
+    '''
+    Moves outputs which given tasks wrote to local scratch to the library, in a low priority IO lane
+    and at limited bandwidth, so it does not compete with encoders reading their sources
+    '''
+    __slots__ = ('sources',)
+    resource = DeviceResource(priority=2)
+    static_limit = 1
+    preemptible = False
+    def __init__(self, encoder: AbstractEncoder, sources: typing.List[EncoderTask]):
+        EncoderTask.__init__(self, encoder)
+        self.sources = list(sources)
+        self.blockers.extend(task.name for task in self.sources)
+
+    @property
+    def produced_files(self):
+        return [path for task in self.sources for path in task.produced_files]
+
+    @property
+    def io_paths(self):
+        return [path for move in self._get_moves() for path in move]
+
+    def _get_moves(self) -> typing.List[typing.Tuple[str, str]]:
+        return [(task._get_scratch_path(path), path) for task in self.sources for path in task.produced_files]
+
+    def __call__(self):
+        started = time.time()
+        for scratch, target in self._get_moves():
+            if not os.path.exists(scratch):
+                if not os.path.exists(target):
+                    logging.warning('%s: "%s" was not produced, nothing to publish' % (self, scratch))
+                continue
+            logging.info('Publishing "%s" to "%s"' % (scratch, target))
+            publish_file(scratch, target, self.encoder.publish)
+            os.unlink(scratch)
+        self.encoder.timings[self.name] = time.time() - started
+
+    def _gen_command(self):
+        moves = []
+        for scratch, target in self._get_moves():
+            part = get_part_path(target)
+            moves.append('cp %s && mv -f %s && rm -f %s' % (subprocess.list2cmdline([scratch, part]),
+                                                           subprocess.list2cmdline([part, target]),
+                                                           subprocess.list2cmdline([scratch])))
+        return ['sh', '-c', ' && '.join(moves)] if moves else []
+
 class CleanupTempfiles(EncoderTask):
-    resource = Resource(kind=ResourceKind.IO, priority=2)
+    __slots__ = ()
+    resource = DeviceResource(priority=2)
     static_limit = 10
-    def __init__(self, encoder: AbstractEncoder, remux_task: RemuxTask):
+    def __init__(self, encoder: AbstractEncoder, last_tasks: typing.List[EncoderTask]):
         EncoderTask.__init__(self, encoder)
-        self.blockers.append(remux_task.name)
+        self.blockers.extend(task.name for task in last_tasks)
 
     @property
     def produced_files(self):
         return []
 
+    @property
+    def io_paths(self):
+        return [self.tmpdir]
+
     def __call__(self):
-        files = list(self.encoder.tempfiles)
-        for pattern in self.encoder.patterns:
-            files.extend(glob.glob(pattern))
-        for fname in files:
-            try:
-                os.unlink(fname)
-            except OSError as err:
-                if err.errno != errno.ENOENT:
-                    raise
+        self.encoder.remove_tempfiles()
 
     def _gen_command(self):
         if not any((self.encoder.tempfiles, self.encoder.patterns)):
             return []
         return ['rm', '-f'] + self.encoder.tempfiles + self.encoder.patterns
 
+class RecordResultTask(EncoderTask):
+    ''' Records final outputs of the encoder in results catalog so the same source is never encoded twice '''
+    __slots__ = ('catalog_path', 'fingerprint', 'profile', 'output_tasks')
+    resource = DeviceResource(priority=2)
+    static_limit = 10
+    def __init__(self, encoder: AbstractEncoder, catalog_path: str, output_tasks: typing.List[EncoderTask]):
+        EncoderTask.__init__(self, encoder)
+        self.catalog_path = catalog_path
+        self.fingerprint = fingerprint(encoder.src)
+        self.profile = encoder.get_profile_key()
+        self.output_tasks = list(output_tasks)
+        self.blockers.extend(task.name for task in self.output_tasks)
+
+    def _get_compare_attrs(self):
+        return EncoderTask._get_compare_attrs(self) + [self.catalog_path, self.fingerprint]
+
+    @property
+    def key(self) -> str:
+        return ResultCatalog.make_key(self.fingerprint, self.profile)
+
+    @property
+    def outputs(self) -> typing.List[str]:
+        # remux output changes container when source video is kept, so these are known for sure only after it ran
+        return [path for task in self.output_tasks for path in task.produced_files]
+
+    @property
+    def produced_files(self):
+        return []
+
+    @property
+    def io_paths(self):
+        return [self.catalog_path]
+
+    def __call__(self):
+        outputs = [(path, os.path.getsize(path) if os.path.exists(path) else None) for path in self.outputs]
+        ResultCatalog(self.catalog_path).record(self.key, self.fingerprint, self.profile, self.media.src,
+                                                outputs, dict(self.encoder.timings))
+
+    def _gen_command(self):
+        return []
+
+    def reuse_known(self) -> bool:
+        '''
+        Looks up results of the same source encoded the same way in catalog and links them
+        to where this encoder would put its outputs, returns True if encoding is not needed
+        '''
+        entry = ResultCatalog(self.catalog_path).lookup(self.key)
+        if entry is None or len(entry.outputs) != len(self.outputs):
+            return False
+        # original encoding may have kept source video in another container
+        targets = [os.path.splitext(target)[0] + os.path.splitext(path)[1] for (path, _), target in zip(entry.outputs, self.outputs)]
+        for (path, size), target in zip(entry.outputs, targets):
+            if size is None:
+                # this output was not produced by original encoding
+                continue
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+            if os.path.exists(target) and os.path.getsize(target) != size:
+                return False
+        for (path, size), target in zip(entry.outputs, targets):
+            if size is None or os.path.exists(target):
+                continue
+            ensuredir(os.path.dirname(target))
+            try:
+                os.link(path, target)
+            except OSError:
+                os.symlink(path, target)
+            logging.info('Linked known result "%s" to "%s"' % (path, target))
+        return True
+
+class CopyVideoTask(EncoderTask):
+    ''' Stands for video encoding when source video is kept as is, remux takes it right from the source '''
+    __slots__ = ()
+    resource = DeviceResource(priority=2)
+    static_limit = 10
+
+    @property
+    def produced_files(self):
+        return [self.encoder.src]
+
+    def _make_command(self):
+        return []
+
 class VideoEncodeTask(EncoderTask):
+    __slots__ = ('sample',)
+    is_final = True # whether this task produces the video stream going to the target
+    MIN_PROGRESS = 60.0 # seconds of encoded video before projected output size is trusted
+    SPEED_OPTION = None # field of media options trading quality for speed, if the task has one
+    SPEED_CHOICES = () # its values from slowest (best quality) to fastest
+
+    def __init__(self, encoder: AbstractEncoder):
+        EncoderTask.__init__(self, encoder)
+        self.sample = None # (start, length) in seconds when encoding only a piece of source for prediction
+
+    def _get_input(self) -> list:
+        if self.sample is None:
+            return ['-i', self.media.src]
+        start, length = self.sample
+        return ['-ss', '%.3f' % start, '-t', '%.3f' % length, '-i', self.media.src]
+
+    @property
+    def estimated_time(self) -> float:
+        prediction = self.encoder.prediction
+        return prediction.encode_time if prediction else None
+
     def can_run(self, batch_tasks):
         all_transcodes = [t for t in batch_tasks if isinstance(t, VideoEncodeTask)]
         return all_transcodes[0] == self and EncoderTask.can_run(self, batch_tasks)
+
+    @property
+    def speed_setting(self):
+        return getattr(self.media.extra_options, self.SPEED_OPTION) if self.SPEED_OPTION else None
+
+    @property
+    def speed_parts(self) -> list:
+        ''' Tasks whose speed settings stand for this one when planning '''
+        return [self]
+
+    def get_work(self) -> float:
+        ''' Pixel-seconds of source the task encodes '''
+        try:
+            width, height = self.info.get_video_dimensions()
+        except ValueError:
+            return 0
+        return width * height * (self.sample[1] if self.sample is not None else self.info.get_duration())
+
+    def _record_throughput(self, seconds: float):
+        if self.SPEED_OPTION:
+            THROUGHPUT_HISTORY.record(self._get_name(), self.speed_setting, self.get_work(), seconds)
+
+    def _check_projected_size(self, projected: float, kind: str) -> str:
+        min_saving = getattr(self.media.extra_options, 'min_saving', 0)
+        if min_saving <= 0:
+            return None
+        limit = self.info.get_video_size() * (100 - min_saving) / 100.
+        if projected > limit:
+            return '%s video size %.1f MiB is not %d%% smaller than source video' % (kind, projected / 1048576., min_saving)
+        return None
+
+    def _read_progress(self) -> typing.Tuple[float, int]:
+        ''' Returns last (encoded seconds, output bytes) reported by ffmpeg -progress '''
+        try:
+            with open(self.encoder.get_progress_path(), 'rb') as inp:
+                inp.seek(max(0, os.fstat(inp.fileno()).st_size - 4096))
+                tail = inp.read().decode('utf8', 'replace')
+        except (IOError, OSError):
+            return 0, 0
+        values = {}
+        for line in tail.splitlines():
+            key, _, value = line.partition('=')
+            values[key.strip()] = value.strip()
+        try:
+            return int(values['out_time_us']) / 1e6, int(values['total_size'])
+        except (KeyError, ValueError):
+            return 0, 0
+
+    def _check_progress(self) -> str:
+        encoded, size = self._read_progress()
+        duration = self.info.get_duration()
+        if encoded < max(min(self.MIN_PROGRESS, duration / 2), duration * 0.05) or not size:
+            return None
+        return self._check_projected_size(size * duration / encoded, 'projected')
+
+    def _run_command(self, cmd: list) -> str:
+        if not self.is_final or self.sample is not None:
+            return EncoderTask._run_command(self, cmd)
+        progress = self.encoder.get_progress_path()
+        if os.path.exists(progress):
+            os.unlink(progress)
+        aborted = EncoderTask._run_command(self, cmd[:1] + ['-progress', progress] + cmd[1:])
+        if aborted:
+            self._keep_source(aborted)
+        return aborted
+
+    def _keep_source(self, reason: str):
+        logging.warning('Keeping source video of "%s" as is: %s' % (self.media.friendly_name, reason))
+        with open(self.encoder.get_passthrough_flag(), 'w') as out:
+            out.write(reason + '\n')
+
+    def __call__(self):
+        if self.sample is None:
+            if self.encoder.is_video_passthrough():
+                logging.info('Skipping %s, source video is kept as is' % self)
+                return
+            if self.encoder.prediction:
+                reason = self._check_projected_size(self.encoder.prediction.size, 'predicted')
+                if reason:
+                    self._keep_source(reason)
+                    return
+        EncoderTask.__call__(self)
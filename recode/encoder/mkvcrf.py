@@ -1,24 +1,20 @@
+import os
+import time
+import logging
 import collections
-import subprocess
-import sys
+import typing
 
-from .audio import NormalizeStereoTask, AudioEncodeTask, AudioCodecOptions, AudioBaseTask
+from ..capabilities import CAPABILITIES
+from ..tasks import Resource, ResourceKind
+from .audio import NormalizeStereoTask, LoudnormStereoTask, AudioEncodeTask, AudioCodecOptions, AudioBaseTask
 from .base_encoder import BaseEncoder
-from .base_tasks import VideoEncodeTask, RemuxTask
+from .base_tasks import EncoderTask, VideoEncodeTask, RemuxTask
 
-MkvCrfOptions = collections.namedtuple('MkvCrfOptions', 'crf preset audio_quality audio_profile scale_down')
+# min_saving: percent the video should be smaller than the source by, otherwise source video is kept (0 disables)
+MkvCrfOptions = collections.namedtuple('MkvCrfOptions', 'crf preset audio_quality audio_profile scale_down min_saving', defaults=(10,))
 
-_HAS_FDK = None
 def has_fdk(encoder: BaseEncoder) -> bool:
-    global _HAS_FDK
-    if _HAS_FDK is not None:
-        return _HAS_FDK
-    try:
-        out = subprocess.check_output([encoder.FFMPEG, '-encoders'], stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as err:
-        sys.exit('Cannot get ffmpeg encoders: %s' % err.output)
-    _HAS_FDK = 'libfdk_aac' in out.decode('utf8')
-    return _HAS_FDK
+    return CAPABILITIES.has_encoder('libfdk_aac')
 
 def _get_aac_options(task: AudioBaseTask):
     if has_fdk(task.encoder):
@@ -33,39 +29,191 @@ def _get_aac_options(task: AudioBaseTask):
     return AudioCodecOptions(name='libfdk_aac' if has_fdk(task.encoder) else 'aac', bitrate=bitrate, extra=extra)
 
 class AacNormalize(NormalizeStereoTask):
+    __slots__ = ()
+    _get_codec_options = _get_aac_options
+
+class AacLoudnorm(LoudnormStereoTask):
+    __slots__ = ()
     _get_codec_options = _get_aac_options
 
 class AacEncode(AudioEncodeTask):
+    __slots__ = ()
     _get_codec_options = _get_aac_options
 
 class HevcEncodeTask(VideoEncodeTask):
+    __slots__ = ()
+    resource = Resource(kind=ResourceKind.CPU, priority=0)
+    static_limit = 2
+    cores = 4
+    MEMORY_PER_PIXEL = 700 # rc-lookahead=120 and bframes=12 keep ~150 frames in flight, ~1.5 GiB for 1080p, ~5.6 GiB for 4K
+    SPEED_OPTION = 'preset'
+    SPEED_CHOICES = ('placebo', 'veryslow', 'slower', 'slow', 'medium', 'fast', 'faster', 'veryfast')
     @property
     def produced_files(self):
         return [self.encoder.make_tempfile('hevc-audio=no')]
 
-    def _get_scaling(self):
+    def _get_scale_filter(self) -> str:
         if not self.media.extra_options.scale_down:
-            return []
+            return None
         opts = [('force_original_aspect_ratio', 'decrease'),
                 ('force_divisible_by', 8),
                 ('height', self.media.extra_options.scale_down),
                 ('width', -1)]
-        return ['-vf', 'scale=' + ':'.join('%s=%s' % pair for pair in opts)]
+        return 'scale=' + ':'.join('%s=%s' % pair for pair in opts)
+
+    def _get_scaling(self):
+        scale = self._get_scale_filter()
+        return ['-vf', scale] if scale else []
+
+    def _get_codec_options(self):
+        return ['-c:v', 'libx265', '-an', '-crf', int(self.media.extra_options.crf),
+                '-x265-params', 'no-sao=1:rskip=1:keyint=120:min-keyint=24:rc-lookahead=120:bframes=12:aq-mode=3:no-strong-intra-smoothing=1:no-open-gop=1',
+                '-preset', self.media.extra_options.preset]
 
     def _make_command(self):
-        return [self.encoder.FFMPEG, '-i', self.media.src,
-               '-movflags', '+faststart', '-map', '0:v', '-c:v', 'libx265', '-an', '-crf', int(self.media.extra_options.crf),
-               '-x265-params', 'no-sao=1:rskip=1:keyint=120:min-keyint=24:rc-lookahead=120:bframes=12:aq-mode=3:no-strong-intra-smoothing=1:no-open-gop=1',
-               '-preset', self.media.extra_options.preset] + self._get_scaling() + ['-y'] + self.produced_files
+        return [self.encoder.FFMPEG] + self._get_input() + ['-movflags', '+faststart', '-map', '0:v'] + \
+               self._get_codec_options() + self._get_scaling() + ['-y'] + self.produced_files
+
+class HevcMultiEncodeTask(HevcEncodeTask):
+    '''
+    Stands for video encodes of several encoders having the same source: ffmpeg decodes the source once
+    and splits decoded frames to an x265 encoder per output, scaled as each encoder wants.
+    Holds cores and memory of all the encodes; no early abort on projected size is done,
+    as one output not being worth it does not make the others so.
+    '''
+    __slots__ = ('parts',)
+    static_limit = 1
+    def __init__(self, parts: typing.List[HevcEncodeTask]):
+        HevcEncodeTask.__init__(self, parts[0].encoder)
+        self.parts = list(parts)
+
+    def _get_compare_attrs(self):
+        return HevcEncodeTask._get_compare_attrs(self) + [[part.encoder for part in self.parts]]
+
+    @property
+    def cores(self):
+        return sum(part.cores for part in self.parts)
+
+    def _estimate_memory(self):
+        return sum(part._estimate_memory() for part in self.parts)
+
+    @property
+    def estimated_time(self):
+        times = [part.estimated_time for part in self.parts]
+        return sum(times) if all(times) else None
+
+    @property
+    def produced_files(self):
+        return [path for part in self.parts for path in part.produced_files]
+
+    @property
+    def speed_parts(self):
+        return list(self.parts)
+
+    @property
+    def encoders(self):
+        return [part.encoder for part in self.parts]
+
+    def _record_throughput(self, seconds: float):
+        # time is split between outputs by their work, parts left out of the run encoded nothing
+        parts = [part for part in self.parts if not part.encoder.is_video_passthrough()]
+        total = sum(part.get_work() for part in parts)
+        if total:
+            for part in parts:
+                part._record_throughput(seconds * part.get_work() / total)
+
+    def _make_command(self, parts: typing.List[HevcEncodeTask]=None):
+        parts = self.parts if parts is None else parts
+        graph = ['[0:v]split=%d%s' % (len(parts), ''.join('[v%d]' % idx for idx in range(len(parts))))]
+        outputs = []
+        for idx, part in enumerate(parts):
+            label, scale = '[v%d]' % idx, part._get_scale_filter()
+            if scale:
+                graph.append('%s%s[s%d]' % (label, scale, idx))
+                label = '[s%d]' % idx
+            outputs.extend(['-movflags', '+faststart', '-map', label] + part._get_codec_options() + ['-y'] + part.produced_files)
+        # the space makes generated scripts quote the graph, ffmpeg ignores it
+        return [self.encoder.FFMPEG] + self._get_input() + ['-filter_complex', '; '.join(graph)] + outputs
+
+    def _run_command(self, cmd: list, log: str=None) -> str:
+        return EncoderTask._run_command(self, cmd, log)
+
+    def __call__(self):
+        parts = []
+        for part in self.parts:
+            if part.encoder.is_video_passthrough():
+                logging.info('Skipping %s, source video is kept as is' % part)
+                continue
+            reason = part._check_projected_size(part.encoder.prediction.size, 'predicted') if part.encoder.prediction else None
+            if reason:
+                part._keep_source(reason)
+                continue
+            parts.append(part)
+        if not parts:
+            return
+        started = time.time()
+        self._run_command(self._make_command(parts))
+        for part in parts:
+            part.encoder.timings[part.name] = time.time() - started
+
+def merge_same_source(batches: typing.List[list]) -> typing.List[list]:
+    '''
+    Puts batches encoding video of the same source with x265 (like the ones "--target-quality both" makes)
+    together, with a single HevcMultiEncodeTask decoding the source once for all of them;
+    each encoder keeps the rest of its tasks, including its own remux
+    '''
+    groups, order = {}, []
+    for tasks in batches:
+        video = [task for task in tasks if isinstance(task, VideoEncodeTask)]
+        if len(video) == 1 and type(video[0]) is HevcEncodeTask:
+            key = os.path.realpath(video[0].encoder.src)
+            if key not in groups:
+                groups[key] = []
+                order.append((key, None))
+            groups[key].append(tasks)
+        else:
+            order.append((None, tasks))
+    return [_merge_batches(groups[key]) if key else tasks for key, tasks in order]
+
+def _merge_batches(batches: typing.List[list]) -> list:
+    if len(batches) == 1:
+        return batches[0]
+    parts = [task for tasks in batches for task in tasks if type(task) is HevcEncodeTask]
+    merged = HevcMultiEncodeTask(parts)
+    logging.info('Encoding video of %s in one pass over the source' % ', '.join('"%s"' % part.media.full_name for part in parts))
+    result = []
+    for tasks in batches:
+        for task in tasks:
+            if type(task) is HevcEncodeTask:
+                if task is parts[0]:
+                    result.append(merged)
+                continue
+            task.blockers = [merged.name if name == HevcEncodeTask._get_name() else name for name in task.blockers]
+            result.append(task)
+    return result
 
 class MKVCRFEncoder(BaseEncoder):
+    __slots__ = ()
     NormalizeStereo = AacNormalize
+    LoudnormStereo = AacLoudnorm
     AudioEncode = AacEncode
 
+    COPY_VIDEO_CODECS = ('HEVC',)
+    COPY_AUDIO_CODECS = ('AAC', 'Opus', 'Vorbis')
+    COPY_MAX_1080P_BITRATE = 5000000
+
     def _make_video_tasks(self):
         return [HevcEncodeTask(self)]
 
+    def _can_copy_video(self):
+        scale_down = self.media.extra_options.scale_down
+        if scale_down and self.info.get_video_dimensions()[1] > scale_down:
+            return False
+        return BaseEncoder._can_copy_video(self)
+
 class MKVCRFLowEncoder(MKVCRFEncoder):
+    __slots__ = ()
     AudioEncode = None # do not keep non-normalized audio tracks
     ExtractSubtitles = None
     SUFFIX = 'LQ'
+    COPY_MAX_1080P_BITRATE = 2000000
@@ -0,0 +1,66 @@
+import collections
+import copy
+import logging
+import os
+import time
+
+from .base_encoder import BaseEncoder
+from .base_tasks import VideoEncodeTask
+
+Prediction = collections.namedtuple('Prediction', 'bitrate size encode_time source_size')
+
+SAMPLE_COUNT = 3
+SAMPLE_LENGTH = 20.0
+
+def _get_sample_spots(duration: float, count: int, length: float) -> list:
+    if duration <= count * length:
+        return [(0.0, duration)]
+    step = duration / count
+    return [(step * idx + (step - length) / 2, length) for idx in range(count)]
+
+def predict_encode(encoder: BaseEncoder, count: int=SAMPLE_COUNT, length: float=SAMPLE_LENGTH) -> Prediction:
+    '''
+    Encodes a few short evenly spaced samples of the source with exactly the same settings
+    video tasks of the encoder would use, then extrapolates bitrate, output size and
+    encode time (as if the task was running alone) to the whole source.
+    Returns None if there is nothing to predict (e.g. video is dropped).
+    '''
+    if encoder.drop_video:
+        return None
+    duration = encoder.info.get_duration()
+    total_size, total_time, total_length = 0, 0., 0.
+    for idx, (start, sample_length) in enumerate(_get_sample_spots(duration, count, length)):
+        sample = copy.copy(encoder)
+        sample.tempfiles, sample.patterns, sample.timings = [], [], {}
+        sample.tmp_tag = 'sample%d' % idx
+        tasks = sample._plan_video_tasks()
+        if not tasks or not all(isinstance(task, VideoEncodeTask) for task in tasks):
+            # nothing is encoded
+            return None
+        try:
+            started = time.time()
+            for task in tasks:
+                task.sample = (start, sample_length)
+                task()
+            total_time += time.time() - started
+            output = tasks[-1].produced_files[0]
+            if not os.path.exists(output):
+                return None
+            total_size += os.path.getsize(output)
+            total_length += sample_length
+        finally:
+            sample.remove_tempfiles()
+
+    bitrate = total_size * 8 / total_length
+    result = Prediction(bitrate=int(bitrate), size=int(bitrate * duration / 8),
+                        encode_time=total_time * duration / total_length,
+                        source_size=os.path.getsize(encoder.src))
+    logging.info('Predicted for "%s": %s' % (encoder.media.full_name, describe_prediction(result)))
+    return result
+
+def describe_prediction(prediction: Prediction) -> str:
+    if prediction is None:
+        return 'no prediction'
+    return 'video %.0f kbit/s, %.1f MiB (%.0f%% of source), encode time %.1f h' % (
+        prediction.bitrate / 1000., prediction.size / 1048576.,
+        100. * prediction.size / max(prediction.source_size, 1), prediction.encode_time / 3600.)
@@ -1,22 +1,31 @@
 import collections
 import typing
 
-WebmCrfOptions = collections.namedtuple('WebmCrfOptions', 'target_1080_crf audio_quality speed_first speed_second')
+# min_saving: percent the video should be smaller than the source by, otherwise source video is kept (0 disables)
+WebmCrfOptions = collections.namedtuple('WebmCrfOptions', 'target_1080_crf audio_quality speed_first speed_second min_saving', defaults=(10,))
 
 from ..tasks import IParallelTask, Resource, ResourceKind
 from .base_tasks import EncoderTask, VideoEncodeTask
-from .audio import NormalizeStereoTask, AudioEncodeTask, AudioCodecOptions
+from .audio import NormalizeStereoTask, LoudnormStereoTask, AudioEncodeTask, AudioCodecOptions
 from .base_encoder import BaseEncoder
 
 class VorbisNormalize(NormalizeStereoTask):
+    __slots__ = ()
+    def _get_codec_options(self):
+        return AudioCodecOptions(name='libvorbis', bitrate=None, extra=('-aq', self.media.extra_options.audio_quality))
+
+class VorbisLoudnorm(LoudnormStereoTask):
+    __slots__ = ()
     def _get_codec_options(self):
         return AudioCodecOptions(name='libvorbis', bitrate=None, extra=('-aq', self.media.extra_options.audio_quality))
 
 class VorbisEncode(AudioEncodeTask):
+    __slots__ = ()
     def _get_codec_options(self):
         return AudioCodecOptions(name='libvorbis', bitrate=None, extra=('-aq', self.media.extra_options.audio_quality))
 
 class Vp9EncodeTask(VideoEncodeTask):
+    __slots__ = ('is_first_pass',)
     def __init__(self, encoder: BaseEncoder, is_first_pass: bool):
         VideoEncodeTask.__init__(self, encoder)
         self.is_first_pass = is_first_pass
@@ -24,9 +33,21 @@ class Vp9EncodeTask(VideoEncodeTask):
     def _get_compare_attrs(self):
         return EncoderTask._get_compare_attrs(self) + [self.is_first_pass]
 
+    @property
+    def is_final(self):
+        return not self.is_first_pass
+
     @property
     def produced_files(self):
-        return [self.encoder.make_tempfile('vp9-audio=no')]
+        # first pass output is of no use, it is removed as soon as the pass is done
+        return [self.encoder.make_tempfile('vp9-pass1' if self.is_first_pass else 'vp9-audio=no')]
+
+    @property
+    def consumed_files(self):
+        return [] if self.is_first_pass else [self._get_passlog()]
+
+    def _get_passlog(self) -> str:
+        return self.encoder.make_tempfile('ffmpeg2pass', 'log', '-*.log')
 
     def _make_command(self):
         crf = (self.encoder.CRF_PROP * self.info.get_video_diagonal() ** self.encoder.CRF_POW) * \
@@ -35,14 +56,18 @@ class Vp9EncodeTask(VideoEncodeTask):
         speed = self.media.extra_options.speed_first if self.is_first_pass else self.media.extra_options.speed_second
         passno = 1 if self.is_first_pass else 2
 
-        return [self.encoder.FFMPEG, '-i', self.media.src, '-g', 240,
+        return [self.encoder.FFMPEG] + self._get_input() + ['-g', 240,
                '-movflags', '+faststart', '-map', '0:v', '-c:v', 'libvpx-vp9', '-an', '-crf', int(crf),
                '-qmax', int(qmax), '-b:v', 0, '-quality', 'good', '-speed', speed, '-pass', passno,
-               '-passlogfile', self.encoder.make_tempfile('ffmpeg2pass', 'log', '-*.log'), '-y'] + self.produced_files
+               '-passlogfile', self._get_passlog(), '-y'] + self.produced_files
 
 class Vp9CrfEncode1PassTask(Vp9EncodeTask):
+    __slots__ = ()
     resource = Resource(kind=ResourceKind.CPU, priority=1)
     static_limit = 5
+    MEMORY_PER_PIXEL = 150
+    SPEED_OPTION = 'speed_first'
+    SPEED_CHOICES = (2, 3, 4, 5, 6, 7, 8)
     def __init__(self, encoder: BaseEncoder):
         Vp9EncodeTask.__init__(self, encoder, True)
     def get_limit(self, candidate_tasks, running_tasks):
@@ -51,8 +76,13 @@ class Vp9CrfEncode1PassTask(Vp9EncodeTask):
         return min(self.static_limit, Vp9CrfEncode2PassTask.static_limit + need_lookahead)
 
 class Vp9CrfEncode2PassTask(Vp9EncodeTask):
+    __slots__ = ()
     resource = Resource(kind=ResourceKind.CPU, priority=0)
     static_limit = 4
+    cores = 4
+    MEMORY_PER_PIXEL = 300 # about 25 lag-in-frames plus reference frames, ~0.8 GiB for 1080p, ~2.7 GiB for 4K
+    SPEED_OPTION = 'speed_second'
+    SPEED_CHOICES = (0, 1, 2, 3, 4, 5)
     def __init__(self, encoder: BaseEncoder):
         Vp9EncodeTask.__init__(self, encoder, False)
 
@@ -78,6 +108,7 @@ class VP9CRFEncoder(BaseEncoder):
     Burn subs in:
         $FFMPEG_PATH -i 60sec.mkv -max_muxing_queue_size 4000 -filter_complex '[0:v][0:s:0]overlay[v]' -map '[v]' -map 0:a -sn -c:v libx264 -crf 24 -c:a copy 60sec-subs-burned.mkv -y
     '''
+    __slots__ = ()
 
     # reverse-engineered VP9-recommended CRF-from-video-height
     CRF_PROP = 76.61285454891394
@@ -91,12 +122,19 @@ class VP9CRFEncoder(BaseEncoder):
     # QMAX = CRF * QMAX_COEFF
 
     NormalizeStereo = VorbisNormalize
+    LoudnormStereo = VorbisLoudnorm
     AudioEncode = VorbisEncode
 
+    COPY_VIDEO_CODECS = ('VP9',)
+    COPY_AUDIO_CODECS = ('Vorbis', 'Opus')
+    COPY_MAX_1080P_BITRATE = 6000000
+
     def _make_video_tasks(self):
         return [Vp9CrfEncode1PassTask(self), Vp9CrfEncode2PassTask(self)]
 
 class VP9CRFYTEncoder(VP9CRFEncoder):
+    __slots__ = ()
     AudioEncode = None # do not keep non-normalized audio tracks
     ExtractSubtitles = None
     SUFFIX = 'YT'
+    COPY_MAX_1080P_BITRATE = 3000000
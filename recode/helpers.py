@@ -1,6 +1,6 @@
 import types
 import copyreg
-from functools import reduce
+from functools import reduce, lru_cache
 import sys
 import os
 import errno
@@ -28,13 +28,95 @@ def _pickle_method(method):
 
 copyreg.pickle(types.MethodType, _pickle_method, _unpickle_method)
 
-def _get_numthreads() -> int:
+@lru_cache(maxsize=None)
+def get_num_threads() -> int:
     # not using multiprocessing.cpu_count() as it does not account well for LXC containers constrained by CPU cores
     try:
-        return open('/proc/cpuinfo').read().count('vendor_id')
+        with open('/proc/cpuinfo') as inp:
+            return inp.read().count('vendor_id') or 4
     except IOError:
         return 4
-NUM_THREADS = _get_numthreads()
+
+def _read_limit(path: str) -> int:
+    try:
+        with open(path) as inp:
+            value = inp.read().strip()
+    except (IOError, OSError):
+        return 0
+    # "max" in cgroup v2 and a huge number in v1 mean no limit
+    return int(value) if value.isdigit() and int(value) < 1 << 60 else 0
+
+def get_memory_limit() -> int:
+    ''' Memory this process may use: its cgroup limit if there is one, physical memory otherwise; 0 if unknown '''
+    try:
+        with open('/proc/self/cgroup') as inp:
+            for line in inp:
+                hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+                if hierarchy == '0':
+                    root, fname = '/sys/fs/cgroup', 'memory.max'
+                elif 'memory' in controllers.split(','):
+                    root, fname = '/sys/fs/cgroup/memory', 'memory.limit_in_bytes'
+                else:
+                    continue
+                # inside a container own cgroup is usually mounted as the root
+                for dname in (root + path.rstrip('/'), root):
+                    limit = _read_limit(os.path.join(dname, fname))
+                    if limit:
+                        return limit
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open('/proc/meminfo') as inp:
+            for line in inp:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+def _read_mount_sources() -> typing.Dict[str, str]:
+    ''' Returns what is mounted by "major:minor" device numbers as seen in /proc/self/mountinfo '''
+    result = {}
+    try:
+        with open('/proc/self/mountinfo') as inp:
+            for line in inp:
+                fields = line.split()
+                try:
+                    fstype, source = fields[fields.index('-') + 1:][:2]
+                except ValueError:
+                    continue
+                if not (source.startswith('/') or ':' in source):
+                    # tmpfs, overlay and such are all named alike, tell them apart by the number
+                    source = '%s-%s' % (fstype, fields[2])
+                result.setdefault(fields[2], source)
+    except (IOError, OSError):
+        pass
+    return result
+
+def get_device_name(path: str) -> str:
+    ''' Names the device (block device, network share or such) holding the path or its nearest existing parent '''
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    st_dev = os.stat(path).st_dev
+    if not hasattr(os, 'major'):
+        return 'dev%d' % st_dev
+    number = '%d:%d' % (os.major(st_dev), os.minor(st_dev))
+    return _read_mount_sources().get(number, number)
+
+SIZE_SUFFIXES = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(text: str) -> int:
+    ''' Parses sizes like "512M" or "24G" (binary multiples) into bytes '''
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    suffix = text[-1:] if text[-1:] in SIZE_SUFFIXES else ''
+    return int(float(text[:len(text) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+def __getattr__(name):
+    # NUM_THREADS is computed on first use, not on import
+    if name == 'NUM_THREADS':
+        return get_num_threads()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 if sys.platform == 'win32':
     def which(prog, env_name=None, optional=False) -> str:
@@ -167,3 +249,23 @@ def list_named_fields(named: typing.NamedTuple) -> typing.List[typing.Tuple[str,
         else:
             result.append((key, 'unsupported', value))
     return result
+
+def get_slots_state(obj, transient: typing.Iterable[str]=()) -> dict:
+    ''' Makes pickled state of a slotted object, leaving out unset slots and the transient ones '''
+    slots = set(name for cls in type(obj).__mro__ for name in cls.__dict__.get('__slots__', ())) - set(transient)
+    return {name: getattr(obj, name) for name in slots if hasattr(obj, name)}
+
+def set_slots_state(obj, state, defaults: dict):
+    '''
+    Restores pickled state of a slotted object, also accepting plain dict state of objects pickled
+    before their class got __slots__: entries which are not slots anymore are dropped
+    and slots missing in the state are set from given defaults
+    '''
+    if isinstance(state, tuple):
+        state = dict(state[0] or {}, **(state[1] or {}))
+    slots = set(name for cls in type(obj).__mro__ for name in cls.__dict__.get('__slots__', ()))
+    values = dict(defaults)
+    values.update(state)
+    for name, value in values.items():
+        if name in slots:
+            setattr(obj, name, value)
@@ -0,0 +1,83 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import typing
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+Event = collections.namedtuple('Event', 'wd mask cookie name')
+
+_EVENT_HEADER = struct.Struct('iIII')
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if sys.platform != 'linux':
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+class Inotify(object):
+    '''
+    Minimal ctypes-based inotify binding, raises OSError if inotify is not available
+    so callers can fall back to polling.
+    '''
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float=None) -> typing.List[Event]:
+        ''' Waits up to timeout seconds (forever if None) for events and returns them '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        result, pos = [], 0
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            result.append(Event(wd=wd, mask=mask, cookie=cookie, name=name))
+        return result
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
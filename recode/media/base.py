@@ -3,7 +3,7 @@ import collections
 import typing
 
 from .info import MediaInfo
-from ..helpers import input_numbers, confirm_yesno
+from ..helpers import input_numbers, confirm_yesno, set_slots_state
 
 ParameterDescription = collections.namedtuple('ParameterDescription', 'group key kind help')
 
@@ -15,6 +15,8 @@ class BadParameters(Exception):
         self.msg = msg
 
 class MediaEntry(object):
+    __slots__ = ('src', 'info', 'ignored_audio_tracks', 'extra_options')
+    EXTRA_OPTIONS = None
     LUFS_LEVEL = -14
     AUDIO_FREQ = 48000
     FORCE_NAME = None
@@ -24,7 +26,13 @@ class MediaEntry(object):
     def __init__(self, src: str):
         self.src = src
         self.info = MediaInfo.parse(src)
-        self.ignored_audio_tracks = set()
+        self.ignored_audio_tracks = frozenset()
+        self.extra_options = self.EXTRA_OPTIONS
+
+    def __setstate__(self, state):
+        # legacy pickled states keep default options on the class and ignored tracks in a set
+        set_slots_state(self, state, dict(extra_options=self.EXTRA_OPTIONS))
+        self.ignored_audio_tracks = frozenset(self.ignored_audio_tracks)
 
     def _get_target_path(self, dest, suffix, ext):
         raise NotImplementedError()
@@ -56,7 +64,7 @@ class MediaEntry(object):
     def comparing_key(self):
         raise NotImplementedError()
 
-    def make_encode_tasks(self, dest: str, logpath: str, drop_video: bool=False):
+    def make_encode_tasks(self, dest: str, logpath: str, drop_video: bool=False, catalog: str=None, publish: float=None, fuse_audio: bool=False):
         raise NotImplementedError()
 
     def __eq__(self, other):
@@ -105,4 +113,4 @@ class MediaEntry(object):
                 if confirm_yesno('Are tracks selected correctly?'):
                     break
         keep_ids = set(audio[idx - 1].track_id for idx in to_keep)
-        self.ignored_audio_tracks = set(ainfo.track_id for ainfo in audio) - keep_ids
+        self.ignored_audio_tracks = frozenset(ainfo.track_id for ainfo in audio) - keep_ids
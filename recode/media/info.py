@@ -1,23 +1,74 @@
 import collections
+import os
 import sys
 import subprocess
 import json
 import math
 import typing
 
-from ..helpers import which
+from ..helpers import which, set_slots_state
 
 SubtitleInfo = collections.namedtuple('SubtitleInfo', 'track_id name language')
-AudioInfo = collections.namedtuple('AudioInfo', 'track_id name language channels')
+AudioInfo = collections.namedtuple('AudioInfo', 'track_id name language channels codec bitrate')
+
+# bitrate (bits per second) is only known if muxer wrote statistics tags
+TrackInfo = collections.namedtuple('TrackInfo', 'track_id type codec language name channels pixel_dimensions bitrate', defaults=(None,))
 
 class MediaInfo:
-    def __init__(self, path: str, info: dict, tracks: list):
+    '''
+    Immutable slim descriptor of a media source holding only the fields the pipeline uses,
+    one instance is shared by everything referring to the same source.
+    Parsed sources are cached by path, size and modification time, so a replaced file is parsed again,
+    only CACHE_SIZE most recently used ones are kept.
+    '''
+    __slots__ = ('path', 'duration', 'tracks')
+    CACHE_SIZE = 256
+    _cache = collections.OrderedDict()
+
+    def __init__(self, path: str, duration: float, tracks: typing.Tuple[TrackInfo, ...]):
         self.path = path
-        self.info = info
+        self.duration = duration
         self.tracks = tracks
-    
+
+    def __setstate__(self, state):
+        if isinstance(state, dict) and 'info' in state:
+            # legacy pickled states hold whole mkvmerge output
+            info = state['info']
+            state = dict(path=state['path'], duration=self._get_duration(info), tracks=tuple(self._make_track(track) for track in info['tracks']))
+        set_slots_state(self, state, {})
+
+    @staticmethod
+    def _make_track(track: dict) -> TrackInfo:
+        props = track.get('properties', {})
+        channels = props.get('audio_channels')
+        try:
+            bitrate = int(props['tag_bps'])
+        except (KeyError, ValueError):
+            bitrate = None
+        return TrackInfo(track_id=int(track['id']), type=track.get('type', ''), codec=track.get('codec', ''),
+                         language=props.get('language'), name=props.get('track_name'),
+                         channels=int(channels) if channels is not None else None,
+                         pixel_dimensions=props.get('pixel_dimensions'), bitrate=bitrate)
+
+    @staticmethod
+    def _get_duration(info: dict) -> float:
+        try:
+            return int(info['container']['properties']['duration']) / 1e9
+        except (KeyError, ValueError):
+            return None
+
     @classmethod
     def parse(cls, path: str):
+        try:
+            stats = os.stat(path)
+            key = (path, stats.st_size, stats.st_mtime_ns)
+        except OSError:
+            key = (path, None, None)
+        try:
+            cls._cache.move_to_end(key)
+            return cls._cache[key]
+        except KeyError:
+            pass
         if sys.platform == 'win32':
             out = r'''{"errors": [], "container": {"supported": true, "type": "Matroska", "properties": {"writing_application": "Lavf57.56.101", "segment_uid": "942fb317ab2287c02b79c8008e699b40", "muxing_application": "Lavf57.56.101", "container_type": 17, "date_utc": "2001-01-01T00:00:00Z", "date_local": "2001-01-01T03:00:00+03:00", "is_providing_timecodes": true, "duration": 31141000000}, "recognized": true}, "attachments": [], "warnings": [], "file_name": "30sec.mkv", "identification_format_version": 6, "chapters": [], "global_tags": [{"num_entries": 1}], "track_tags": [], "tracks": [{"codec": "MPEG-4p10/AVC/h.264", "type": "video", "id": 0, "properties": {"packetizer": "mpeg4_p10_video", "forced_track": false, "uid": 1, "language": "eng", "number": 1, "enabled_track": true, "pixel_dimensions": "1920x1080", "display_dimensions": "1920x1080", "codec_id": "V_MPEG4/ISO/AVC", "codec_private_data": "01640028ffe1001a67640028acd940780227e5c04400000301f400005daa3c60c65801000668e938233c8f", "codec_private_length": 43, "default_track": true, "minimum_timestamp": 4948000000, "default_duration": 41708375}}, {"codec": "AC-3/E-AC-3", "type": "audio", "id": 1, "properties": {"audio_channels": 2, "uid": 2, "language": "rus", "track_name": "\u0434\u043e\u0440\u043e\u0436\u043a\u04301", "number": 2, "enabled_track": true, "forced_track": true, "codec_id": "A_AC3", "codec_private_length": 0, "audio_sampling_frequency": 48000, "default_track": true, "minimum_timestamp": 0}}, {"codec": "AC-3/E-AC-3", "type": "audio", "id": 2, "properties": {"audio_channels": 6, "uid": 3, "language": "rus", "track_name": "track2", "number": 3, "enabled_track": true, "forced_track": false, "codec_id": "A_AC3", "codec_private_length": 0, "audio_sampling_frequency": 48000, "default_track": false, "minimum_timestamp": 0}}, {"codec": "DTS", "type": "audio", "id": 3, "properties": {"audio_channels": 6, "uid": 4, "language": "eng", "number": 4, "enabled_track": true, "forced_track": false, "codec_id": "A_DTS", "codec_private_length": 0, "audio_sampling_frequency": 48000, "default_track": false, "minimum_timestamp": 10000000}}, {"codec": "HDMV PGS", "type": "subtitles", "id": 4, "properties": {"forced_track": false, "uid": 5, "language": "rus", "number": 5, "enabled_track": true, "track_name": "subs1", "codec_id": "S_HDMV/PGS", "codec_private_length": 0, "default_track": false, "minimum_timestamp": 235000000}}, {"codec": "SubRip/SRT", "type": "subtitles", "id": 5, "properties": {"forced_track": false, "uid": 6, "language": "eng", "number": 6, "enabled_track": true, "text_subtitles": true, "codec_id": "S_TEXT/UTF8", "codec_private_length": 0, "default_track": false, "minimum_timestamp": 485000000}}]}'''
         else:
@@ -27,11 +78,13 @@ class MediaInfo:
                 raise ValueError('Cannot get MKV info for "%s": "%s"\n%s' % (path, err, err.output.decode('utf8')))
         info = json.loads(out)
         try:
-            tracks = info['tracks']
+            tracks = tuple(cls._make_track(track) for track in info['tracks'])
         except KeyError:
             raise ValueError('Missing required entry in movie info for "%s"' % path)
-
-        return cls(path, info, tracks)
+        result = cls._cache[key] = cls(path, cls._get_duration(info), tracks)
+        while len(cls._cache) > cls.CACHE_SIZE:
+            cls._cache.popitem(last=False)
+        return result
 
     @staticmethod
     def __get_unique_name(name, seen):
@@ -47,12 +100,12 @@ class MediaInfo:
         result = []
         seen_names, seen_langs = set(), set()
         for track in self.tracks:
-            if track['codec'] == 'SubRip/SRT':
-                lang = track['properties']['language']
-                name = track['properties'].get('track_name', lang)
+            if track.codec == 'SubRip/SRT':
+                lang = track.language
+                name = track.name or lang
                 lang = self.__get_unique_name(lang, seen_langs)
                 name = self.__get_unique_name(name, seen_names)
-                result.append(SubtitleInfo(track_id=track['id'],
+                result.append(SubtitleInfo(track_id=track.track_id,
                                            name=name, language=lang))
         return result
 
@@ -62,31 +115,72 @@ class MediaInfo:
         '''
         result = {}
         for track in self.tracks:
-            if int(track.get('properties', {}).get('audio_channels', -1)) != -1:
-                result[int(track['id'])] = int(track['properties']['audio_channels'])
+            if track.channels is not None:
+                result[track.track_id] = track.channels
         return result
 
     def get_audio_tracks(self) -> typing.List[AudioInfo]:
         result = []
         for track in self.tracks:
-            if int(track.get('properties', {}).get('audio_channels', -1)) != -1:
-                #AudioInfo = collections.namedtuple('AudioInfo', 'track_id name language channels')
-                result.append(AudioInfo(track_id=int(track['id']),
-                                        name=track['properties'].get('track_name', 'unnamed'),
-                                        language=track['properties'].get('language', 'unknown'),
-                                        channels=int(track['properties']['audio_channels'])))
+            if track.channels is not None:
+                result.append(AudioInfo(track_id=track.track_id,
+                                        name=track.name or 'unnamed',
+                                        language=track.language or 'unknown',
+                                        channels=track.channels,
+                                        codec=track.codec,
+                                        bitrate=track.bitrate))
         return result
 
     def get_video_dimensions(self) -> typing.Tuple[int, int]:
         for track in self.tracks:
-            if 'pixel_dimensions' in track.get('properties'):
+            if track.pixel_dimensions:
                 try:
-                    width, height = [int(x) for x in track['properties']['pixel_dimensions'].split('x')]
+                    width, height = [int(x) for x in track.pixel_dimensions.split('x')]
                 except ValueError:
                     continue
                 return width, height
         raise ValueError('Bad media "%s" - cannot get video dimensions' % self.path)
 
+    def get_video_track(self) -> TrackInfo:
+        for track in self.tracks:
+            if track.type == 'video':
+                return track
+        return None
+
+    def get_video_codec(self) -> str:
+        track = self.get_video_track()
+        return track.codec if track else ''
+
+    def get_video_size(self) -> float:
+        '''
+        Returns size of the video stream in bytes, from its bitrate statistics if the muxer wrote them,
+        otherwise the file size less audio tracks with known bitrates
+        '''
+        size = os.path.getsize(self.path)
+        try:
+            duration = self.get_duration()
+        except ValueError:
+            return size
+        track = self.get_video_track()
+        if track is not None and track.bitrate:
+            return track.bitrate * duration / 8
+        audio = sum(track.bitrate * duration / 8 for track in self.tracks if track.type == 'audio' and track.bitrate)
+        return size - audio if audio < size else size
+
+    def get_overall_bitrate(self) -> float:
+        '''
+        Returns average bitrate of the whole source in bits per second, an upper bound for any of its tracks
+        '''
+        return os.path.getsize(self.path) * 8 / self.get_duration()
+
     def get_video_diagonal(self) -> float:
         width, height = self.get_video_dimensions()
         return math.hypot(width, height)
+
+    def get_duration(self) -> float:
+        '''
+        Returns container duration in seconds
+        '''
+        if self.duration is None:
+            raise ValueError('Bad media "%s" - cannot get duration' % self.path)
+        return self.duration
@@ -6,9 +6,10 @@ from .base import MediaEntry, UnknownFile, BadParameters, ParameterDescription
 from ..helpers import override_fields, list_named_fields
 from ..encoder.vp9crf import WebmCrfOptions, VP9CRFEncoder, VP9CRFYTEncoder
 from ..encoder.mkvcrf import MkvCrfOptions, MKVCRFEncoder, MKVCRFLowEncoder
+from ..encoder.av1crf import Av1CrfOptions, AV1CRFEncoder
 
 class BaseMovie(MediaEntry):
-    extra_options = None
+    __slots__ = ('name', 'prefix')
     FORCE_NAME = 'basemovie'
     CONTAINER = 'nothing'
     ENCODER = None
@@ -34,8 +35,8 @@ class BaseMovie(MediaEntry):
     def comparing_key(self):
         return self.name.lower()
 
-    def make_encode_tasks(self, dest, logpath, drop_video):
-        return self.ENCODER(self, dest, logpath, drop_video).make_tasks() #pylint: disable=not-callable
+    def make_encode_tasks(self, dest, logpath, drop_video, catalog=None, publish=None, fuse_audio=False):
+        return self.ENCODER(self, dest, logpath, drop_video, catalog, publish, fuse_audio).make_tasks() #pylint: disable=not-callable
 
     def _get_target_path(self, dest, suffix, ext):
         return os.path.join(dest, '%s%s.%s' % (self.friendly_name, suffix, ext))
@@ -48,14 +49,14 @@ class BaseMovie(MediaEntry):
     def parse_forced(cls, fname: str, fpath: str, params: typing.Dict[str, str]) -> MediaEntry:
         res = cls(fpath, params.get('name', fname))
         try:
-            res.extra_options = override_fields(cls.extra_options, params)
+            res.extra_options = override_fields(cls.EXTRA_OPTIONS, params)
         except ValueError:
             raise BadParameters('Got not an integer value trying to override int parameter')
         return res
 
     @classmethod
     def describe_parameters(cls):
-        res = [ParameterDescription(group=cls.CONTAINER, key=key, kind=kind, help='(default: %s)' % value) for (key, kind, value) in list_named_fields(cls.extra_options)]
+        res = [ParameterDescription(group=cls.CONTAINER, key=key, kind=kind, help='(default: %s)' % value) for (key, kind, value) in list_named_fields(cls.EXTRA_OPTIONS)]
         res.append(ParameterDescription(group='', key='name', kind='string', help='Movie name'))
         return res
 
@@ -67,25 +68,36 @@ class BaseMovie(MediaEntry):
         return params
 
 class SingleMovie(BaseMovie):
-    extra_options = WebmCrfOptions(target_1080_crf=21, audio_quality=5, speed_first=4, speed_second=1)
+    __slots__ = ()
+    EXTRA_OPTIONS = WebmCrfOptions(target_1080_crf=21, audio_quality=5, speed_first=4, speed_second=1)
     FORCE_NAME = 'movie'
     CONTAINER = 'webm'
     ENCODER = VP9CRFEncoder
 
 class HQMovie(BaseMovie):
-    extra_options = MkvCrfOptions(crf=20, preset='slower', scale_down=0, audio_quality=5, audio_profile='')
+    __slots__ = ()
+    EXTRA_OPTIONS = MkvCrfOptions(crf=20, preset='slower', scale_down=0, audio_quality=5, audio_profile='')
     FORCE_NAME = 'hqmovie'
     CONTAINER = 'mkv'
     ENCODER = MKVCRFEncoder
 
 class LQMovie(BaseMovie):
-    extra_options = MkvCrfOptions(crf=30, preset='slow', scale_down=720, audio_quality=2, audio_profile='aac_he_v2')
+    __slots__ = ()
+    EXTRA_OPTIONS = MkvCrfOptions(crf=30, preset='slow', scale_down=720, audio_quality=2, audio_profile='aac_he_v2')
     FORCE_NAME = 'lqmovie'
     CONTAINER = 'mp4'
     ENCODER = MKVCRFLowEncoder
 
 class YTLike(BaseMovie):
-    extra_options = WebmCrfOptions(target_1080_crf=32, audio_quality=4, speed_first=5, speed_second=2)
+    __slots__ = ()
+    EXTRA_OPTIONS = WebmCrfOptions(target_1080_crf=32, audio_quality=4, speed_first=5, speed_second=2)
     FORCE_NAME = 'ytlike'
     CONTAINER = 'webm'
     ENCODER = VP9CRFYTEncoder
+
+class AV1Movie(BaseMovie):
+    __slots__ = ()
+    EXTRA_OPTIONS = Av1CrfOptions(target_1080_crf=32, preset=6, audio_bitrate=64)
+    FORCE_NAME = 'av1movie'
+    CONTAINER = 'webm'
+    ENCODER = AV1CRFEncoder
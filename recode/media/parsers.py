@@ -1,8 +1,8 @@
 from .series import SeriesEpisode
-from .movie import SingleMovie, HQMovie, LQMovie, YTLike
+from .movie import SingleMovie, HQMovie, LQMovie, YTLike, AV1Movie
 
 PARSERS = [SeriesEpisode, SingleMovie]
-ALL_PARSERS = [SeriesEpisode, SingleMovie, HQMovie, LQMovie, YTLike]
+ALL_PARSERS = [SeriesEpisode, SingleMovie, HQMovie, LQMovie, YTLike, AV1Movie]
 
 UPCAST = {
     SingleMovie.FORCE_NAME: {
@@ -11,5 +11,6 @@ UPCAST = {
         'hq': [HQMovie],
         'both': [LQMovie, HQMovie],
         'yt': [YTLike],
+        'av1': [AV1Movie],
     }
 }
\ No newline at end of file
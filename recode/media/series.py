@@ -9,7 +9,8 @@ from ..helpers import override_fields, list_named_fields
 from ..encoder.vp9crf import VP9CRFEncoder, WebmCrfOptions
 
 class SeriesEpisode(MediaEntry):
-    extra_options = WebmCrfOptions(target_1080_crf=24, audio_quality=4, speed_first=5, speed_second=2)
+    __slots__ = ('series', 'season', 'episode', 'name', 'prefix')
+    EXTRA_OPTIONS = WebmCrfOptions(target_1080_crf=24, audio_quality=4, speed_first=5, speed_second=2)
     FORCE_NAME = 'series'
     CONTAINER = 'webm'
     STRIP_SUFFIX = True
@@ -38,8 +39,8 @@ class SeriesEpisode(MediaEntry):
     def comparing_key(self):
         return (self.series, self.season, self.episode)
 
-    def make_encode_tasks(self, dest, logpath, drop_video):
-        return VP9CRFEncoder(self, dest, logpath, drop_video).make_tasks()
+    def make_encode_tasks(self, dest, logpath, drop_video, catalog=None, publish=None, fuse_audio=False):
+        return VP9CRFEncoder(self, dest, logpath, drop_video, catalog, publish, fuse_audio).make_tasks()
 
     def _get_target_path(self, dest, suffix, ext):
         return os.path.join(dest, self.series, 'S%02d' % self.season, '%s%s.%s' % (self.friendly_name, suffix, ext))
@@ -68,13 +69,13 @@ class SeriesEpisode(MediaEntry):
         series = params.get('name', series)
         res = cls(fpath, series, season, episode, name)
         try:
-            res.extra_options = override_fields(cls.extra_options, params)
+            res.extra_options = override_fields(cls.EXTRA_OPTIONS, params)
         except ValueError:
             raise BadParameters('Got not an integer value trying to override int parameter')
         return res
 
     @classmethod
     def describe_parameters(cls):
-        res = [ParameterDescription(group=cls.CONTAINER, key=key, kind=kind, help='(default: %s)' % value) for (key, kind, value) in list_named_fields(cls.extra_options)]
+        res = [ParameterDescription(group=cls.CONTAINER, key=key, kind=kind, help='(default: %s)' % value) for (key, kind, value) in list_named_fields(cls.EXTRA_OPTIONS)]
         res.append(ParameterDescription(group='', key='name', kind='string', help='Series name'))
         return res
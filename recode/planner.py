@@ -0,0 +1,142 @@
+import time
+import logging
+import typing
+
+from .accounting import THROUGHPUT_HISTORY
+
+class SpeedPlanner(object):
+    '''
+    Picks speed settings (libvpx -speed, x265 and SVT-AV1 presets) of queued batches so that
+    batches with deadlines are done in time while keeping the slowest (best quality) settings possible.
+    Batches never go slower than their profile says, and are sped up one step at a time,
+    each time picking the step saving the most time among the late batch and ones queued before it.
+
+    Time of encoding at a setting comes from measured throughput of past encodes (see ThroughputHistory),
+    settings never measured are extrapolated from measured ones assuming every step is SPEED_STEP times faster,
+    and when nothing was measured for a task kind the sample encode prediction is used if there is one.
+    A task encoding for several encoders at once (see VideoEncodeTask.speed_parts) is planned as its parts,
+    each getting the same step on its own profile.
+    '''
+    SPEED_STEP = 1.5
+
+    def __init__(self):
+        self.profiles = {} # id(media) -> (media, extra options it was queued with)
+        self.steps = {} # id(media) -> chosen step
+        self.warned = set() # id(media) of batches known to be late anyway
+
+    def __get_profile(self, media):
+        known = self.profiles.get(id(media))
+        if known is None or known[0] is not media:
+            known = self.profiles[id(media)] = (media, media.extra_options)
+        return known[1]
+
+    @staticmethod
+    def __get_index(task, value) -> int:
+        try:
+            return task.SPEED_CHOICES.index(value)
+        except ValueError:
+            # not in the list, use the nearest slower choice
+            return max([idx for idx, choice in enumerate(task.SPEED_CHOICES) if choice <= value] or [0])
+
+    def __get_setting(self, task, profile, step: int):
+        choices = task.SPEED_CHOICES
+        return choices[min(len(choices) - 1, self.__get_index(task, getattr(profile, task.SPEED_OPTION)) + step)]
+
+    def __estimate_task(self, task, setting, rates: dict) -> typing.Optional[float]:
+        if not rates:
+            return None
+        index = self.__get_index(task, setting)
+        # nearest measured setting
+        known_idx, rate = min(((self.__get_index(task, type(setting)(value)), rate) for value, rate in rates.items()),
+                              key=lambda item: abs(item[0] - index))
+        return task.get_work() / (rate * self.SPEED_STEP ** (index - known_idx))
+
+    def estimate(self, tasks: list, step: int) -> typing.Optional[float]:
+        ''' Seconds of encoding left for video tasks of a batch at given step, None if it cannot be told '''
+        total, guessed = 0, False
+        for task in tasks:
+            estimate = self.__estimate_task(task, self.__get_setting(task, self.__get_profile(task.media), step),
+                                            THROUGHPUT_HISTORY.get(task._get_name()))
+            if estimate is None:
+                guessed = True
+            else:
+                total += estimate
+        if guessed:
+            encoders = []
+            for task in tasks:
+                if not any(task.encoder is known for known in encoders):
+                    encoders.append(task.encoder)
+            if not all(encoder.prediction and encoder.prediction.encode_time for encoder in encoders):
+                return None
+            return sum(encoder.prediction.encode_time for encoder in encoders) / self.SPEED_STEP ** step
+        return total
+
+    def __get_max_step(self, tasks: list) -> int:
+        return max(len(task.SPEED_CHOICES) - 1 - self.__get_index(task, getattr(self.__get_profile(task.media), task.SPEED_OPTION))
+                   for task in tasks)
+
+    def plan(self, batches: typing.List[typing.Tuple[float, list, list]]):
+        '''
+        Gets batches as (deadline, unstarted tasks, unfinished tasks) tuples in the order executor runs them,
+        changes speed settings of batches which have video encodes not started yet
+        '''
+        entries = []
+        for deadline, queued, unfinished in batches:
+            runnable = [task for task in unfinished if getattr(task, 'SPEED_OPTION', None)]
+            if not runnable:
+                continue
+            tasks = [part for task in runnable for part in task.speed_parts]
+            tunable = [part for task in runnable if any(task is other for other in queued) for part in task.speed_parts]
+            media = tasks[0].media
+            # several encodes of the kind run at once, so each takes only a share of the queue time
+            entries.append(dict(media=media, deadline=deadline, tasks=tasks, step=0, tunable=tunable,
+                                share=1.0 / min(task.static_limit for task in runnable),
+                                max_step=self.__get_max_step(tunable) if tunable else 0,
+                                time=self.estimate(tasks, 0 if tunable else self.steps.get(id(media), 0))))
+        now = time.time()
+        while True:
+            total, late = now, None
+            for idx, entry in enumerate(entries):
+                total += (entry['time'] or 0) * entry['share']
+                if total > entry['deadline'] and entry['time'] is not None:
+                    late = idx
+                    break
+            if late is None:
+                break
+            best, best_saving = None, 0
+            for entry in entries[:late + 1]:
+                if entry['step'] < entry['max_step'] and entry['time'] is not None:
+                    saving = (entry['time'] - self.estimate(entry['tasks'], entry['step'] + 1)) * entry['share']
+                    if saving > best_saving:
+                        best, best_saving = entry, saving
+            if best is None:
+                if id(entries[late]['media']) not in self.warned:
+                    self.warned.add(id(entries[late]['media']))
+                    logging.warning('Cannot finish "%s" by its deadline even at fastest settings' % entries[late]['media'].friendly_name)
+                break
+            best['step'] += 1
+            best['time'] = self.estimate(best['tasks'], best['step'])
+        for entry in entries:
+            if entry['tunable']:
+                self.__apply(entry['tunable'], entry['step'])
+        # forget finished batches
+        known = set(id(task.media) for entry in entries for task in entry['tasks'])
+        self.profiles = {key: value for key, value in self.profiles.items() if key in known}
+        self.steps = {key: value for key, value in self.steps.items() if key in known}
+        self.warned &= known
+
+    def __apply(self, tasks: list, step: int):
+        medias = []
+        for task in tasks:
+            if not any(task.media is known for known in medias):
+                medias.append(task.media)
+        for media in medias:
+            profile = self.__get_profile(media)
+            options = media.extra_options._replace(**{task.SPEED_OPTION: self.__get_setting(task, profile, step)
+                                                      for task in tasks if task.media is media})
+            if options != media.extra_options:
+                changes = ', '.join('%s=%s' % (field, getattr(options, field)) for field in options._fields
+                                    if getattr(options, field) != getattr(media.extra_options, field))
+                logging.info('Planned speed of "%s": %s' % (media.friendly_name, changes))
+                media.extra_options = options
+            self.steps[id(media)] = step
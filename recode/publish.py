@@ -0,0 +1,87 @@
+import os
+import time
+import errno
+import hashlib
+import logging
+
+from .helpers import ensuredir
+
+CHUNK_SIZE = 1 << 20
+
+class Throttle(object):
+    ''' Keeps average transfer rate under given amount of bytes per second, 0 means no limit '''
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.started = time.time()
+        self.done = 0
+
+    def consume(self, amount: int):
+        self.done += amount
+        if self.rate:
+            delay = self.started + self.done / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+def get_part_path(dest: str) -> str:
+    ''' Hidden name in the target directory, so library scanners do not pick incomplete files up '''
+    dirname, fname = os.path.split(dest)
+    return os.path.join(dirname, '.%s.part' % fname)
+
+def _feed(checksum, path: str, throttle: Throttle, limit: int=None):
+    with open(path, 'rb') as inp:
+        left = limit
+        while left is None or left > 0:
+            chunk = inp.read(CHUNK_SIZE if left is None else min(CHUNK_SIZE, left))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            throttle.consume(len(chunk))
+            if left is not None:
+                left -= len(chunk)
+    return checksum
+
+def _copy(src: str, part: str, throttle: Throttle) -> str:
+    ''' Copies src to part continuing a previous copy if part holds the beginning of src, returns checksum of src '''
+    checksum, offset = hashlib.sha256(), 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        if offset > os.path.getsize(src) or \
+                _feed(hashlib.sha256(), part, throttle).hexdigest() != _feed(checksum, src, Throttle(0), offset).hexdigest():
+            checksum, offset = hashlib.sha256(), 0
+        elif offset:
+            logging.info('Continuing interrupted copy of "%s" from %d bytes' % (src, offset))
+    with open(src, 'rb') as inp, open(part, 'ab' if offset else 'wb') as out:
+        inp.seek(offset)
+        while True:
+            chunk = inp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            checksum.update(chunk)
+            throttle.consume(len(chunk))
+        out.flush()
+        os.fsync(out.fileno())
+    return checksum.hexdigest()
+
+def publish_file(src: str, dest: str, bwlimit: float=0, attempts: int=3, retry_delay: float=10):
+    '''
+    Copies src to dest at no more than bwlimit bytes per second. Data goes to a hidden partial file
+    which is read back and checked against size and checksum of src before it is atomically
+    renamed to dest, failed copies are retried continuing from what was already copied.
+    '''
+    ensuredir(os.path.dirname(dest))
+    part = get_part_path(dest)
+    for attempt in range(1, attempts + 1):
+        throttle = Throttle(bwlimit)
+        try:
+            expected = _copy(src, part, throttle)
+            if os.path.getsize(part) != os.path.getsize(src) or _feed(hashlib.sha256(), part, throttle).hexdigest() != expected:
+                os.unlink(part)
+                raise IOError(errno.EIO, 'Copy of "%s" at "%s" does not match the source' % (src, part))
+            os.replace(part, dest)
+            return
+        except (IOError, OSError) as err:
+            if attempt == attempts:
+                raise
+            logging.warning('Cannot publish "%s" to "%s" (attempt %d of %d): %s' % (src, dest, attempt, attempts, err))
+            time.sleep(retry_delay)
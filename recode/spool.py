@@ -0,0 +1,93 @@
+import os
+import time
+import errno
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging
+import typing
+
+from .helpers import ensuredir
+from .inotify import Inotify, IN_MOVED_TO, IN_CLOSE_WRITE
+from .task_store import NewBatch
+
+class Spool(object):
+    '''
+    Directory where planners drop self-contained batch files for a running executor to pick up,
+    so enqueueing does not need to touch the state at all. Files are written under a hidden
+    temporary name and renamed into place, and claimed by renaming before loading, so any amount
+    of planners and executors can use the same spool concurrently.
+    Files which cannot be loaded or consumed are renamed to *.failed and left for the user,
+    removing the suffix requeues them.
+    '''
+    SUFFIX = '.batch'
+    CLAIMED = '.claimed'
+    FAILED = '.failed'
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def put(self, batches: typing.Sequence[NewBatch]) -> str:
+        ensuredir(self.path)
+        name = '%017.6f-%d%s' % (time.time(), os.getpid(), self.SUFFIX)
+        tmp_path = os.path.join(self.path, '.%s.tmp' % name)
+        with open(tmp_path, 'wb') as out:
+            out.write(pickle.dumps(list(batches), pickle.HIGHEST_PROTOCOL))
+            out.flush()
+            os.fsync(out.fileno())
+        target = os.path.join(self.path, name)
+        os.rename(tmp_path, target)
+        return target
+
+    def __list(self) -> typing.List[str]:
+        try:
+            names = os.listdir(self.path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return []
+        return sorted(name for name in names if name.endswith(self.SUFFIX) and not name.startswith('.'))
+
+    def pending_count(self) -> int:
+        return len(self.__list())
+
+    def take(self, consume: typing.Callable[[typing.List[NewBatch]], None]) -> int:
+        '''
+        Claims all batch files present in spool, passes their batches to consume()
+        and removes the files once consume() succeeds, returns amount of batches taken
+        '''
+        count = 0
+        for name in self.__list():
+            path = os.path.join(self.path, name)
+            claimed = path + self.CLAIMED
+            try:
+                os.rename(path, claimed)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                # somebody else claimed it first
+                continue
+            try:
+                with open(claimed, 'rb') as inp:
+                    batches = pickle.loads(inp.read())
+                consume(batches)
+            except Exception:
+                logging.exception('Cannot take spool file "%s", it is kept as "%s"' % (name, name + self.FAILED))
+                os.rename(claimed, path + self.FAILED)
+                continue
+            os.unlink(claimed)
+            logging.debug('Took %d batches from spool file "%s"' % (len(batches), name))
+            count += len(batches)
+        return count
+
+    def watch(self) -> typing.Optional[Inotify]:
+        ''' Returns inotify instance watching for new batch files or None if not supported '''
+        ensuredir(self.path)
+        try:
+            watcher = Inotify()
+        except OSError as err:
+            logging.debug('Cannot use inotify for spool "%s", falling back to polling: %s' % (self.path, err))
+            return None
+        watcher.add_watch(self.path, IN_MOVED_TO | IN_CLOSE_WRITE)
+        return watcher
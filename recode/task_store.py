@@ -0,0 +1,250 @@
+import os
+import sqlite3
+import collections
+import contextlib
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging
+import typing
+
+from .flock import FLock
+from .helpers import ensuredir
+
+# priority: bigger goes first; deadline: unix time or None; estimate: expected encoding time in seconds or None
+NewBatch = collections.namedtuple('NewBatch', 'tasks title note priority deadline estimate', defaults=(0, None, None))
+PendingBatch = collections.namedtuple('PendingBatch', 'batch_id tasks priority deadline')
+BatchStatus = collections.namedtuple('BatchStatus', 'batch_id title note created pending_tasks priority deadline estimate status error')
+
+class LegacyStateError(Exception):
+    pass
+
+class TaskStatus:
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed' # batch is quarantined after one of its tasks has failed for good
+
+class TaskStore(object):
+    '''
+    Transactional task storage backed by SQLite in WAL mode, safe to be used by several processes at once.
+    Every batch is stored as a row holding serialized tasks (so that tasks of a batch keep sharing
+    their encoder) and every task has its own status row, so enqueueing, marking tasks done and querying
+    status do not need to deserialize anything.
+    '''
+    SQLITE_HEADER = b'SQLite format 3\x00'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL,
+            title TEXT NOT NULL DEFAULT '',
+            note TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL,
+            remaining INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            deadline REAL,
+            estimate REAL,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS batches_status ON batches (status, id);
+        CREATE TABLE IF NOT EXISTS tasks (
+            batch_id INTEGER NOT NULL REFERENCES batches (id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            PRIMARY KEY (batch_id, idx)
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, batch_id);
+    '''
+    # columns added after the first release of the schema
+    UPGRADES = (
+        ('priority', 'ALTER TABLE batches ADD COLUMN priority INTEGER NOT NULL DEFAULT 0'),
+        ('deadline', 'ALTER TABLE batches ADD COLUMN deadline REAL'),
+        ('estimate', 'ALTER TABLE batches ADD COLUMN estimate REAL'),
+        ('error', 'ALTER TABLE batches ADD COLUMN error TEXT'),
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_wait = 0.0 # total seconds spent waiting for write lock on the state
+        ensuredir(os.path.dirname(path))
+        legacy = None
+        if os.path.exists(path) and not self.__is_sqlite(path):
+            legacy = read_legacy_state(path)
+            logging.info('Converting legacy state "%s" to SQLite, old state is kept at "%s"' % (path, path + LEGACY_SUFFIX))
+            os.rename(path, path + LEGACY_SUFFIX)
+        conn = self._connect()
+        try:
+            conn.executescript(self.SCHEMA)
+            columns = set(row[1] for row in conn.execute('PRAGMA table_info(batches)'))
+            for column, statement in self.UPGRADES:
+                if column not in columns:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+        if legacy:
+            self.add_batches(legacy)
+
+    @classmethod
+    def __is_sqlite(cls, path: str) -> bool:
+        with open(path, 'rb') as inp:
+            return inp.read(len(cls.SQLITE_HEADER)) == cls.SQLITE_HEADER
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=300, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self._connect()
+        try:
+            started = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            self.lock_wait += time.time() - started
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _get_task_name(task) -> str:
+        return getattr(task, 'name', None) or str(task)
+
+    def add_batches(self, batches: typing.Sequence[NewBatch]) -> typing.List[int]:
+        result = []
+        with self.transaction() as conn:
+            for batch in batches:
+                tasks = list(batch.tasks)
+                cursor = conn.execute('INSERT INTO batches (created, title, note, status, remaining, payload, priority, deadline, estimate) '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (time.time(), batch.title or '', batch.note or '', TaskStatus.PENDING, len(tasks),
+                                       sqlite3.Binary(pickle.dumps(tasks, pickle.HIGHEST_PROTOCOL)),
+                                       batch.priority or 0, batch.deadline, batch.estimate))
+                batch_id = cursor.lastrowid
+                conn.executemany('INSERT INTO tasks (batch_id, idx, name, status) VALUES (?, ?, ?, ?)',
+                                 [(batch_id, idx, self._get_task_name(task), TaskStatus.PENDING) for idx, task in enumerate(tasks)])
+                result.append(batch_id)
+        return result
+
+    def read_pending(self, after_id: int=0) -> typing.List[PendingBatch]:
+        '''
+        Loads batches having unfinished tasks added after given batch id,
+        finished tasks are replaced by None.
+        '''
+        conn = self._connect()
+        try:
+            batches = conn.execute('SELECT id, payload, priority, deadline FROM batches WHERE status = ? AND id > ? ORDER BY id',
+                                   (TaskStatus.PENDING, after_id)).fetchall()
+            result = []
+            for batch_id, payload, priority, deadline in batches:
+                tasks = pickle.loads(payload)
+                for (idx,) in conn.execute('SELECT idx FROM tasks WHERE batch_id = ? AND status != ?', (batch_id, TaskStatus.PENDING)):
+                    tasks[idx] = None
+                result.append(PendingBatch(batch_id=batch_id, tasks=tasks, priority=priority, deadline=deadline))
+            return result
+        finally:
+            conn.close()
+
+    def mark_done(self, batch_id: int, idx: int):
+        with self.transaction() as conn:
+            cursor = conn.execute('UPDATE tasks SET status = ? WHERE batch_id = ? AND idx = ? AND status = ?',
+                                  (TaskStatus.DONE, batch_id, idx, TaskStatus.PENDING))
+            if cursor.rowcount:
+                conn.execute('UPDATE batches SET remaining = remaining - 1 WHERE id = ?', (batch_id,))
+                conn.execute('UPDATE batches SET status = ? WHERE id = ? AND remaining <= 0 AND status = ?',
+                             (TaskStatus.DONE, batch_id, TaskStatus.PENDING))
+
+    def has_pending(self) -> bool:
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT 1 FROM batches WHERE status = ? LIMIT 1', (TaskStatus.PENDING,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def get_status(self) -> typing.List[BatchStatus]:
+        conn = self._connect()
+        try:
+            result = []
+            for batch_id, title, note, created, priority, deadline, estimate, status, error in conn.execute(
+                    'SELECT id, title, note, created, priority, deadline, estimate, status, error FROM batches WHERE status IN (?, ?) ORDER BY id',
+                    (TaskStatus.PENDING, TaskStatus.FAILED)).fetchall():
+                names = [name for (name,) in conn.execute('SELECT name FROM tasks WHERE batch_id = ? AND status = ? ORDER BY idx',
+                                                          (batch_id, TaskStatus.PENDING))]
+                result.append(BatchStatus(batch_id=batch_id, title=title, note=note, created=created, pending_tasks=names,
+                                          priority=priority, deadline=deadline, estimate=estimate, status=status, error=error))
+            return result
+        finally:
+            conn.close()
+
+    def quarantine(self, batch_id: int, error: str):
+        ''' Takes a batch out of the queue keeping its state, so it can be requeued later '''
+        with self.transaction() as conn:
+            conn.execute('UPDATE batches SET status = ?, error = ? WHERE id = ? AND status = ?',
+                         (TaskStatus.FAILED, error, batch_id, TaskStatus.PENDING))
+
+    def requeue_failed(self) -> int:
+        '''
+        Puts quarantined batches back to the queue as new batches (so running executors notice them),
+        tasks which were already done stay done
+        '''
+        with self.transaction() as conn:
+            failed = conn.execute('SELECT id FROM batches WHERE status = ? ORDER BY id', (TaskStatus.FAILED,)).fetchall()
+            for (batch_id,) in failed:
+                cursor = conn.execute('INSERT INTO batches (created, title, note, status, remaining, payload, priority, deadline, estimate) '
+                                      'SELECT created, title, note, ?, remaining, payload, priority, deadline, estimate FROM batches WHERE id = ?',
+                                      (TaskStatus.PENDING, batch_id))
+                conn.execute('INSERT INTO tasks (batch_id, idx, name, status) SELECT ?, idx, name, status FROM tasks WHERE batch_id = ?',
+                             (cursor.lastrowid, batch_id))
+                conn.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+        return len(failed)
+
+    def set_urgency(self, batch_id: int, priority: int, deadline: float):
+        with self.transaction() as conn:
+            conn.execute('UPDATE batches SET priority = ?, deadline = ? WHERE id = ?', (priority, deadline, batch_id))
+
+    def remove_batch(self, batch_id: int):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+
+    def purge_finished(self):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM batches WHERE status = ?', (TaskStatus.DONE,))
+
+    def import_legacy(self, legacy_path: str):
+        ''' Moves unfinished tasks of a legacy pickled state to this store, old state is renamed to keep it around '''
+        batches = read_legacy_state(legacy_path)
+        logging.info('Importing legacy state "%s", old state is kept at "%s"' % (legacy_path, legacy_path + LEGACY_SUFFIX))
+        self.add_batches(batches)
+        os.rename(legacy_path, legacy_path + LEGACY_SUFFIX)
+
+LEGACY_SUFFIX = '.legacy'
+
+def read_legacy_state(path: str) -> typing.List[NewBatch]:
+    '''
+    Loads unfinished tasks from a state pickled by versions before SQLite storage,
+    it holds a list of task lists with finished tasks replaced by None.
+    Slotted classes of the tasks accept their old dict state in __setstate__.
+    '''
+    dirname, fname = os.path.split(path)
+    try:
+        with FLock(os.path.join(dirname, '.%s.lock' % fname)):
+            with open(path, 'rb') as inp:
+                tasklists = pickle.load(inp)
+    except Exception as err:
+        raise LegacyStateError('Cannot load legacy state "%s", it was left untouched: %s' % (path, err))
+    batches = []
+    for tasklist in tasklists:
+        tasks = [task for task in tasklist if task]
+        if tasks:
+            batches.append(NewBatch(tasks=tasks, title=str(tasks[0]), note=''))
+    return batches
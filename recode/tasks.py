@@ -2,15 +2,14 @@ import collections
 import copy
 import threading
 import os
+import signal
 import time
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 import logging
 import typing
 
-from .locked_state import LockedState
+from .task_store import PendingBatch
+from .control import ControlServer, ControlError
+from .helpers import chop_tail
 
 class ResourceKind:
     CPU = 'cpu'
@@ -18,9 +17,31 @@ class ResourceKind:
 
 Resource = collections.namedtuple('Resource', 'kind priority')
 
+def make_io_kind(devices: typing.Iterable[str]) -> str:
+    ''' IO resource kind of a task using given devices, the task takes a slot of each device (see get_pools) '''
+    devices = sorted(set(devices))
+    return '%s:%s' % (ResourceKind.IO, '+'.join(devices)) if devices else ResourceKind.IO
+
+def get_kind_devices(kind: str) -> typing.List[str]:
+    base, _, devices = kind.partition(':')
+    return devices.split('+') if base == ResourceKind.IO and devices else []
+
+def get_base_kind(kind: str) -> str:
+    return kind.partition(':')[0]
+
+def get_pools(kind: str) -> typing.List[str]:
+    ''' Slot pools a task of given resource kind is counted in: one per device for IO, the kind itself otherwise '''
+    devices = get_kind_devices(kind)
+    return [make_io_kind([device]) for device in devices] if devices else [kind]
+
 class IParallelTask(object):
+    __slots__ = ()
     resource = None
     do_script = True
+    estimated_time = None # seconds, if known; longer tasks are started first among same resource ones
+    preemptible = False # whether pause() can be used to free the slot for higher priority work
+    cores = 1 # how many cores the task is expected to keep busy
+    memory = 0 # expected peak RSS in bytes
     def get_limit(self, candidate_tasks, running_tasks) -> int:
         raise NotImplementedError()
     def __call__(self):
@@ -31,6 +52,21 @@ class IParallelTask(object):
         raise NotImplementedError()
     def scriptize(self):
         raise NotImplementedError()
+    def pause(self) -> bool:
+        return False
+    def resume(self):
+        pass
+    def stop(self):
+        pass
+    def is_transient_failure(self, error) -> bool:
+        ''' Whether running the task again later has a chance to succeed after it failed with given error '''
+        return False
+    def release(self, batch_tasks):
+        ''' Called after the task completed with unfinished tasks of its batch, frees what none of them needs anymore '''
+        pass
+    def abandon(self):
+        ''' Called for unfinished tasks of a cancelled batch once none of them runs, removes what they left behind '''
+        pass
     def __eq__(self, other):
         raise NotImplementedError()
     def __ne__(self, other):
@@ -38,164 +74,594 @@ class IParallelTask(object):
 
 class Executor:
     UPDATE_DELAY = 20
-    def __init__(self, state, scriptize=False):
-        self.state = state
-        with self.state:
-            self.tasklists = self.state.read()
-            self.state_updated = time.time()
+    PURGE_PERIOD = 3600 # how often a persistent executor removes finished batches from the state
+    SPOOL_POLL = 0.5
+    MAX_RETRIES = 3 # attempts after transient failures before batch is quarantined
+    RETRY_DELAY = 60 # seconds before the first retry, doubled for each next one
+    DEVICE_LIMIT = 4 # IO tasks using a device at once, unless overridden per device
+    def __init__(self, store, scriptize=False, spool=None, persistent=False, max_preempt=0, arbiter=None, tracer=None, memory_budget=0,
+                 control_path=None, planner=None, device_limits=None):
+        self.store = store
+        self.memory_budget = 0 if scriptize else memory_budget # bytes, 0 for no limit
+        self.cpu_budget = 0 # cores all running CPU tasks may use, 0 for no limit
+        self.limits = {} # task kind -> limit overriding the one task reports
+        self.device_limits = dict(device_limits or {}) # device -> how many IO tasks may use it at once
+        self.admitting, self.draining = True, False
+        self.cancelled = set() # indices of batches cancelled via control socket
+        self.stopping = False # set once running tasks are stopped on exit, their failures are not failures of batches
+        self.control = None if scriptize or not control_path else ControlServer(control_path, self.handle_control)
+        self.tracer = None if scriptize else tracer
+        self.planner = None if scriptize else planner
+        self.ready_count, self.lock_wait_seen = 0, store.lock_wait
+        self.traced_priorities = collections.defaultdict(set)
+        self.arbiter = None if scriptize else arbiter
+        self.leases = {} # id(task) -> arbiter lease held while task is running
+        self.preempted = [] # tasks paused while picking the task being started now
+        self.persistent = persistent
+        self.max_preempt = 0 if scriptize else max_preempt
+        self.paused = [] # (task, limit) pairs
+        self.attempts, self.retry_at = {}, {} # (list_idx, task_idx) -> failed attempts, time when task may be retried
+        self.spool = spool
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event() # set when a task ends or a command arrives, so the loop does not sleep out SPOOL_POLL
+        self.batch_ids, self.tasklists, self.unfinished, self.urgency = [], [], [], []
+        self.known_ids, self.last_read_id = set(), 0
+        self.watcher = self.spool.watch() if self.spool else None
+        self.__take_spool()
+        self.__add_batches(self.__read_store())
+        self.state_updated = time.time()
+        self.purged = time.time()
 
         nonempty = sum(1 if any(tl) else 0 for tl in self.tasklists)
         logging.info('Amount of batches: %d' % nonempty)
-        self.unfinished = copy.deepcopy(self.tasklists)
-        self.lock = threading.RLock()
         self.running = []
         self.scriptize = scriptize
 
+    def __read_store(self):
+        batches = self.store.read_pending(after_id=self.last_read_id)
+        if batches:
+            self.last_read_id = max(self.last_read_id, batches[-1].batch_id)
+        return batches
+
+    def __add_batches(self, batches):
+        for batch in batches:
+            if batch.batch_id in self.known_ids:
+                continue
+            self.known_ids.add(batch.batch_id)
+            self.batch_ids.append(batch.batch_id)
+            self.tasklists.append(batch.tasks)
+            self.unfinished.append(list(batch.tasks))
+            # smaller goes first: bigger priority, then earlier deadline
+            self.urgency.append((-(batch.priority or 0), batch.deadline or float('inf')))
+
+    def __find_resource(self, resource_slots, resource_uses, waiting, preempt):
+        for pool, slots in resource_slots.items():
+            for running_prio, running_users in resource_uses[pool].items():
+                if running_prio not in slots:
+                    slots[running_prio] = running_users
+        for resource in sorted(waiting):
+            # a task using several devices needs a slot of each of them
+            pools = get_pools(resource.kind)
+            if all(self.__fits(resource_slots[pool], resource_uses[pool], resource.priority) for pool in pools) or \
+                    (preempt and len(pools) == 1 and self.__preempt(resource, pools[0], resource_slots[pools[0]], resource_uses)):
+                return resource
+        return None
+
+    def __lease(self, task) -> bool:
+        if self.arbiter is None:
+            return True
+        kind = get_base_kind(task.resource.kind)
+        lease = self.arbiter.acquire(kind, task.cores if kind == ResourceKind.CPU else 1)
+        if lease is None:
+            self.denied_kinds.add(kind)
+            return False
+        self.leases[id(task)] = lease
+        return True
+
+    def __release(self, task):
+        lease = self.leases.pop(id(task), None)
+        if lease is not None:
+            self.arbiter.release(lease)
+
     def __pop_next_task(self):
         with self.lock:
-            candidates = []
-            all_tasks = []
-            for list_idx, tasklist in enumerate(self.tasklists):
-                not_done = self.unfinished[list_idx]
-                for task_idx, task in enumerate(tasklist):
-                    if task and task.can_run(not_done):
-                        candidates.append((task.resource, list_idx, task_idx, task))
-                        all_tasks.append(task)
-            candidates.sort()
-
-            candidates_limit = []
-            resource_slots = collections.defaultdict(lambda: collections.defaultdict(int))
-            for resource, list_idx, task_idx, task in candidates:
+            self.denied_kinds = set()
+            try:
+                return self.__pick_next_task()
+            finally:
+                if self.arbiter is not None:
+                    for kind in set(self.arbiter.capacity) - self.denied_kinds:
+                        self.arbiter.mark_waiting(kind, False)
+
+    def __pick_next_task(self):
+        candidates = []
+        all_tasks = []
+        now = time.time()
+        for list_idx, tasklist in enumerate(self.tasklists):
+            not_done = self.unfinished[list_idx]
+            for task_idx, task in enumerate(tasklist):
+                if task and task.can_run(not_done) and self.retry_at.get((list_idx, task_idx), 0) <= now:
+                    candidates.append((self.urgency[list_idx], task.resource, -(task.estimated_time or 0), list_idx, task_idx, task))
+                    all_tasks.append(task)
+        candidates.sort(key=lambda candidate: candidate[:5])
+        self.ready_count = len(candidates)
+
+        candidates_limit = []
+        resource_slots = collections.defaultdict(lambda: collections.defaultdict(int))
+        for urgency, resource, _, list_idx, task_idx, task in candidates:
+            limit = self.limits.get(self.__get_kind(task))
+            if limit is None:
                 limit = task.get_limit(all_tasks, self.running)
-                candidates_limit.append((limit, resource, list_idx, task_idx, task))
-                resource_slots[resource.kind][resource.priority] = max(resource_slots[resource.kind][resource.priority], limit)
-
-            resource_uses = collections.defaultdict(lambda: collections.defaultdict(int))
-            for task in self.running:
-                resource_uses[task.resource.kind][task.resource.priority] += 1
-            
-            found_resource = None
-            for resource_kind, slots in sorted(resource_slots.items()):
-                for running_prio, running_users in resource_uses[resource_kind].items():
-                    if running_prio not in slots:
-                        slots[running_prio] = running_users
-                for resource_priority in sorted(slots.keys()):
-                    # check if taking one more task of given priority fits
-                    potential = copy.deepcopy(resource_uses[resource_kind])
-                    potential[resource_priority] += 1
-                    for priority in (set(potential.keys()) | set(slots.keys())):
-                        total = 0
-                        for potential_prio, users in potential.items():
-                            if potential_prio <= priority:
-                                total += users
-                        if total > slots[priority]:
-                            # violates one of slot constraints :(
-                            break
-                    else:
-                        # all priorities are fine, we found what we sought!
-                        found_resource = Resource(kind=resource_kind, priority=resource_priority)
-                        break
-                if found_resource is not None:
-                    break
+            candidates_limit.append((urgency, limit, resource, list_idx, task_idx, task))
+            for pool in get_pools(resource.kind):
+                resource_slots[pool][resource.priority] = max(resource_slots[pool][resource.priority], limit)
 
-            if found_resource is not None:
-                for limit, resource, list_idx, task_idx, task in candidates_limit:
-                    if resource == found_resource:
-                        self.tasklists[list_idx][task_idx] = None
+        for task, limit in self.paused:
+            for pool in get_pools(task.resource.kind):
+                resource_slots[pool][task.resource.priority] = max(resource_slots[pool][task.resource.priority], limit)
+
+        resource_uses = collections.defaultdict(lambda: collections.defaultdict(int))
+        for task in self.running:
+            for pool in get_pools(task.resource.kind):
+                resource_uses[pool][task.resource.priority] += 1
+
+        # paused tasks are considered running ones, so they are continued before anything new is started
+        found_resource = self.__find_resource(resource_slots, resource_uses, set(task.resource for task, _ in self.paused), preempt=False)
+        if found_resource is not None:
+            # resume in the order tasks were paused
+            for idx, (task, _) in enumerate(self.paused):
+                if task.resource == found_resource:
+                    if self.__lease(task):
+                        del self.paused[idx]
+                        task.resume()
                         self.running.append(task)
-                        dbg_items = []
-                        for name, slots in sorted(resource_uses.items()):
-                            for priority, users in sorted(slots.items()):
-                                dbg_items.append('%s-%s=%s' % (name, priority, users))
-                        logging.debug('Pre-task resource usage: %s' % ('|'.join(dbg_items)))
-                        logging.info('Starting %s' % task)
-                        logging.debug('Task resource: kind=%s, prio=%s, limit=%s' % (resource.kind, resource.priority, limit))
-                        return list_idx, task_idx, task, limit
+                        self.__trace_begin(task, resumed=True)
+                        logging.info('Resuming %s' % task)
+                        return None, None, None, None
+                    break
+
+        if not self.admitting or self.draining:
+            return None, None, None, None
+
+        # then go from most urgent batches to least urgent ones
+        for urgency in sorted(set(candidate[0] for candidate in candidates_limit)):
+            # tasks not fitting in budgets are not considered, so nothing is preempted for them
+            fitting = [candidate for candidate in candidates_limit if candidate[0] == urgency and self.__fits_budgets(candidate[5])]
+            waiting = set(resource for _, _, resource, _, _, _ in fitting)
+            while waiting:
+                self.preempted = []
+                found_resource = self.__find_resource(resource_slots, resource_uses, waiting, preempt=True)
+                if found_resource is None:
+                    break
+                other, limit, resource, list_idx, task_idx, task = [candidate for candidate in fitting if candidate[2] == found_resource][0]
+                if not self.__lease(task):
+                    # host-wide arbiter has no tokens of this kind for us now, so pausing others was for nothing
+                    self.__undo_preempt(resource_uses)
+                    waiting = set(resource for resource in waiting if get_base_kind(resource.kind) != get_base_kind(found_resource.kind))
+                    continue
+                self.tasklists[list_idx][task_idx] = None
+                self.retry_at.pop((list_idx, task_idx), None)
+                self.running.append(task)
+                dbg_items = []
+                for name, slots in sorted(resource_uses.items()):
+                    for priority, users in sorted(slots.items()):
+                        dbg_items.append('%s-%s=%s' % (name, priority, users))
+                logging.debug('Pre-task resource usage: %s' % ('|'.join(dbg_items)))
+                logging.info('Starting %s' % task)
+                self.__trace_begin(task, limit=limit)
+                logging.debug('Task resource: kind=%s, prio=%s, limit=%s' % (resource.kind, resource.priority, limit))
+                return list_idx, task_idx, task, limit
         return None, None, None, None
 
+    @staticmethod
+    def __fits(slots, uses, priority) -> bool:
+        '''checks if taking one more task of given priority fits'''
+        potential = copy.deepcopy(uses)
+        potential[priority] += 1
+        for level in (set(potential.keys()) | set(slots.keys())):
+            total = 0
+            for potential_prio, users in potential.items():
+                if potential_prio <= level:
+                    total += users
+            if total > slots[level]:
+                # violates one of slot constraints :(
+                return False
+        # all priorities are fine, we found what we sought!
+        return True
+
+    def __get_reserved_memory(self) -> int:
+        # paused tasks keep their memory
+        return sum(task.memory for task in self.running) + sum(task.memory for task, _ in self.paused)
+
+    def __fits_budgets(self, task) -> bool:
+        # a task bigger than a budget still runs when it is alone
+        if self.memory_budget and (self.running or self.paused) and \
+                self.__get_reserved_memory() + task.memory > self.memory_budget:
+            return False
+        if self.cpu_budget and task.resource.kind == ResourceKind.CPU:
+            used = sum(other.cores for other in self.running if other.resource.kind == ResourceKind.CPU)
+            if used and used + task.cores > self.cpu_budget:
+                return False
+        for device in get_kind_devices(task.resource.kind):
+            limit = self.device_limits.get(device, self.DEVICE_LIMIT)
+            if limit and sum(1 for other in self.running if device in get_kind_devices(other.resource.kind)) >= limit:
+                return False
+        return True
+
+    def __preempt(self, resource, pool, slots, resource_uses) -> bool:
+        '''pauses lower priority tasks of the same slot pool until one more task of given resource fits'''
+        victims = [task for task in reversed(self.running) if task.preemptible and
+                   pool in get_pools(task.resource.kind) and task.resource.priority > resource.priority]
+        victims.sort(key=lambda task: -task.resource.priority)
+        potential = copy.deepcopy(resource_uses[pool])
+        paused, fits = [], False
+        for task in victims:
+            if len(self.paused) + len(paused) >= self.max_preempt:
+                break
+            if not task.pause():
+                continue
+            paused.append(task)
+            potential[task.resource.priority] -= 1
+            fits = self.__fits(slots, potential, resource.priority)
+            if fits:
+                break
+        if not fits:
+            # could not make enough room, let them continue
+            for task in paused:
+                task.resume()
+            return False
+        for task in paused:
+            self.__release(task)
+            self.running.remove(task)
+            for victim_pool in get_pools(task.resource.kind):
+                resource_uses[victim_pool][task.resource.priority] -= 1
+            self.paused.append((task, slots[task.resource.priority]))
+            self.__trace_end(task, 'paused')
+            logging.info('Paused %s to make room for %s-%s task' % (task, resource.kind, resource.priority))
+        self.preempted.extend(paused)
+        return True
+
+    def __undo_preempt(self, resource_uses):
+        '''continues tasks paused for a task which could not be started after all'''
+        for task in self.preempted:
+            if not self.__lease(task):
+                # stays paused and is resumed as usual once tokens are back
+                continue
+            self.paused = [(other, limit) for other, limit in self.paused if other is not task]
+            task.resume()
+            self.running.append(task)
+            for pool in get_pools(task.resource.kind):
+                resource_uses[pool][task.resource.priority] += 1
+            self.__trace_begin(task, resumed=True)
+            logging.info('Resuming %s, task it was paused for cannot be started' % task)
+        self.preempted = []
+
+    def __get_batch_id(self, task) -> int:
+        for batch_id, tasks in zip(self.batch_ids, self.unfinished):
+            if any(other is task for other in tasks):
+                return batch_id
+        return None
+
+    def __trace_begin(self, task, **args):
+        if self.tracer is None:
+            return
+        self.tracer.begin(id(task), task.resource.kind, str(task), batch=self.__get_batch_id(task),
+                          resource='%s-%s' % (task.resource.kind, task.resource.priority), cores=task.cores, **args)
+
+    def __trace_end(self, task, outcome):
+        if self.tracer is not None:
+            self.tracer.end(id(task), outcome=outcome)
+
+    def __trace_counters(self):
+        if self.tracer is None:
+            return
+        uses = collections.defaultdict(lambda: collections.defaultdict(int))
+        for task in self.running:
+            for pool in get_pools(task.resource.kind):
+                uses[pool][task.resource.priority] += 1
+                self.traced_priorities[pool].add(task.resource.priority)
+        for kind, priorities in self.traced_priorities.items():
+            self.tracer.counter('%s slots used' % kind, {'priority %s' % prio: uses[kind][prio] for prio in priorities})
+        if self.memory_budget:
+            self.tracer.counter('memory reserved, MiB', {'reserved': self.__get_reserved_memory() // 1048576, 'budget': self.memory_budget // 1048576})
+        self.tracer.counter('queue', {'ready': self.ready_count, 'paused': len(self.paused), 'waiting for retry': len(self.retry_at)})
+        lock_wait = self.store.lock_wait
+        self.tracer.counter('state lock wait, ms', {'wait': round((lock_wait - self.lock_wait_seen) * 1000, 1)})
+        self.lock_wait_seen = lock_wait
+
     def __update_state(self):
         if self.state_updated + self.UPDATE_DELAY > time.time():
             # do not update too frequently
             return
-        with self.lock, self.state:
-            self.state_updated = time.time()
-            tasklists = self.state.read()
-            logging.debug('Refreshing executor state, read %d batches' % len(tasklists))
-            new_tasks = tasklists[len(self.unfinished):]
-            if new_tasks:
-                logging.info('Adding %d more batches' % len(new_tasks))
-                self.tasklists.extend(new_tasks)
-                self.unfinished.extend(copy.deepcopy(new_tasks))
+        self.state_updated = time.time()
+        if self.persistent and not self.scriptize and self.purged + self.PURGE_PERIOD < time.time():
+            # persistent executor never gets to the purge on exit
+            self.purged = time.time()
+            self.store.purge_finished()
+        new_batches = self.__read_store()
+        logging.debug('Refreshing executor state, read %d new batches' % len(new_batches))
+        if new_batches:
+            logging.info('Adding %d more batches' % len(new_batches))
+            with self.lock:
+                self.__add_batches(new_batches)
+        self.__replan()
+
+    def __replan(self):
+        if self.planner is None:
+            return
+        with self.lock:
+            order = sorted((urgency, list_idx) for list_idx, urgency in enumerate(self.urgency)
+                           if list_idx not in self.cancelled and any(self.unfinished[list_idx]))
+            batches = [(urgency[1], [task for task in self.tasklists[list_idx] if task],
+                        [task for task in self.unfinished[list_idx] if task]) for urgency, list_idx in order]
+            try:
+                self.planner.plan(batches)
+            except Exception:
+                logging.exception('Cannot plan speed of queued batches')
+
+    def __store_spooled(self, batches):
+        batch_ids = self.store.add_batches(batches)
+        logging.info('Adding %d more batches from spool' % len(batch_ids))
+        with self.lock:
+            self.__add_batches([PendingBatch(batch_id=batch_id, tasks=list(batch.tasks), priority=batch.priority, deadline=batch.deadline)
+                                for batch_id, batch in zip(batch_ids, batches)])
+
+    def __take_spool(self):
+        if self.spool:
+            self.spool.take(self.__store_spooled)
+
+    def __wait(self):
+        # spooled batches are picked up within SPOOL_POLL, ended tasks and commands wake the loop at once
+        self.wakeup.wait(self.SPOOL_POLL)
+        self.wakeup.clear()
+        if not self.watcher or self.watcher.read_events(0):
+            self.__take_spool()
 
     def __mark_finished(self, list_idx, task_idx, task):
         with self.lock:
             assert self.unfinished[list_idx][task_idx] == task
             self.unfinished[list_idx][task_idx] = None
-            if not self.scriptize:
-                with self.state:
-                    tasklists = self.state.read()
-                    for li, row in enumerate(self.unfinished):
-                        for ti, task in enumerate(row):
-                            if task is None:
-                                tasklists[li][ti] = None
-                    # read new tasklists
-                    self.tasklists.extend(tasklists[len(self.unfinished):])
-                    # now update unfinished stuff
-                    self.unfinished = tasklists
-                    self.state.write(self.unfinished)
+        if not self.scriptize:
+            self.store.mark_done(self.batch_ids[list_idx], task_idx)
+
+    def __release_files(self, list_idx, task):
+        with self.lock:
+            batch_tasks = [other for other in self.unfinished[list_idx] if other]
+        try:
+            task.release(batch_tasks)
+        except Exception:
+            # leftovers are removed by cleanup at the end of the batch anyway
+            logging.exception('Cannot release what %s used' % task)
+
+    def __handle_failure(self, list_idx, task_idx, task, error):
+        key = (list_idx, task_idx)
+        with self.lock:
+            attempts = self.attempts[key] = self.attempts.get(key, 0) + 1
+            if not self.scriptize and attempts <= self.MAX_RETRIES and task.is_transient_failure(error):
+                delay = self.RETRY_DELAY * 2 ** (attempts - 1)
+                logging.warning('Will retry %s in %d seconds (attempt %d of %d)' % (task, delay, attempts + 1, self.MAX_RETRIES + 1))
+                self.retry_at[key] = time.time() + delay
+                self.tasklists[list_idx][task_idx] = task
+                return
+            # drop the rest of the batch, other batches keep going
+            self.tasklists[list_idx] = [None] * len(self.tasklists[list_idx])
+            self.retry_at = {other: when for other, when in self.retry_at.items() if other[0] != list_idx}
+        reason = '%s failed%s: %s' % (task, ' %d times' % attempts if attempts > 1 else '', error or type(error).__name__)
+        logging.error('Quarantining batch %s: %s' % (self.batch_ids[list_idx], reason))
+        if not self.scriptize:
+            self.store.quarantine(self.batch_ids[list_idx], reason)
 
     def __run_task(self, list_idx, task_idx, task, limit):
+        outcome = 'interrupted'
         try:
             try:
                 if not self.scriptize:
                     task()
                 if task.do_script:
                     task.scriptize()
-            except:
-                logging.exception('Error in %s' % task)
+            except Exception as err:
+                outcome = 'failed'
+                if list_idx in self.cancelled:
+                    logging.info('Stopped %s of cancelled batch' % task)
+                elif self.stopping:
+                    logging.info('Stopped %s on exit, it will be run again on resume' % task)
+                else:
+                    logging.exception('Error in %s' % task)
+                    self.__handle_failure(list_idx, task_idx, task, err)
             else:
+                outcome = 'completed'
                 logging.info('Completed %s' % task)
                 self.__mark_finished(list_idx, task_idx, task)
+                if not self.scriptize:
+                    self.__release_files(list_idx, task)
             finally:
                 with self.lock:
-                    self.running.remove(task)
+                    self.__trace_end(task, outcome)
+                    self.__release(task)
+                    if task in self.running:
+                        self.running.remove(task)
+                    else:
+                        self.paused = [(other, limit) for other, limit in self.paused if other is not task]
+                if list_idx in self.cancelled:
+                    self.__abandon(list_idx)
+                self.wakeup.set()
         except:
             logging.exception('Unhandled error while running task %s' % task)
             raise
     
     def _execute(self):
         threads = []
+        if self.control:
+            self.control.start()
+        self.__replan()
         while True:
+            started = False
             with self.lock:
-                remaining = sum(1 if any(tl) else 0 for tl in self.tasklists)
-                if remaining == 0:
-                    break
-
-                list_idx, task_idx, task, limit = self.__pop_next_task()
-                if task:
-                    th = threading.Thread(target=self.__run_task, args=(list_idx, task_idx, task, limit))
-                    th.start()
-                    threads.append(th)
-                elif not self.running:
-                    logging.warning('Exiting due to empty running queue while some tasks still remain, this is probably a bug')
+                if self.draining and not self.running and not self.paused:
+                    logging.info('Drained, exiting with unstarted tasks left in the state')
                     break
+                remaining = sum(1 if any(tl) else 0 for tl in self.tasklists)
+                if remaining == 0 and not self.paused:
+                    if not self.persistent:
+                        break
+                else:
+                    list_idx, task_idx, task, limit = self.__pop_next_task()
+                    if task:
+                        th = threading.Thread(target=self.__run_task, args=(list_idx, task_idx, task, limit))
+                        th.start()
+                        threads = [t for t in threads if t.is_alive()] + [th]
+                        started = True
+                    elif not self.running and not self.paused and not self.retry_at and self.admitting and not self.persistent:
+                        logging.warning('Exiting due to empty running queue while some tasks still remain, this is probably a bug')
+                        break
+                self.__trace_counters()
             self.__update_state()
-            time.sleep(0.5)
+            if not started:
+                # another task may fit right away
+                self.__wait()
         for th in threads:
             th.join()
-        if not self.scriptize and not self.unfinished:
-            with self.state:
-                # check that state is really empty before removing it
-                tasklists = self.state.read()
-                remaining = []
-                for tl in tasklists:
-                    remaining.extend(t for t in tl if t)
-                if not remaining:
-                    self.state.remove()
+        if self.watcher:
+            self.watcher.close()
+        if self.arbiter:
+            self.arbiter.close()
+        if self.tracer:
+            self.tracer.close()
+        if self.control:
+            self.control.close()
+        if not self.scriptize:
+            self.store.purge_finished()
+
+    @staticmethod
+    def __get_kind(task) -> str:
+        return chop_tail(type(task).__name__, 'Task')
+
+    def __describe_task(self, task) -> dict:
+        return {'task': str(task), 'kind': self.__get_kind(task), 'batch': self.__get_batch_id(task),
+                'resource': '%s-%s' % (task.resource.kind, task.resource.priority), 'cores': task.cores, 'memory': task.memory}
+
+    def __get_list_idx(self, batch_id: int) -> int:
+        try:
+            list_idx = self.batch_ids.index(batch_id)
+        except ValueError:
+            raise ControlError('Unknown batch %s' % batch_id)
+        if not any(self.unfinished[list_idx]) or list_idx in self.cancelled:
+            raise ControlError('Batch %s is finished or cancelled' % batch_id)
+        return list_idx
+
+    def handle_control(self, request: dict):
+        ''' Serves commands sent to control socket '''
+        command = request['command']
+        with self.lock:
+            if command == 'status':
+                batches = []
+                for list_idx, (batch_id, tasklist, unfinished, urgency) in enumerate(zip(self.batch_ids, self.tasklists, self.unfinished, self.urgency)):
+                    if any(unfinished) and list_idx not in self.cancelled:
+                        batches.append({'batch': batch_id, 'priority': -urgency[0],
+                                        'deadline': urgency[1] if urgency[1] != float('inf') else None,
+                                        'queued': sum(1 for task in tasklist if task), 'unfinished': sum(1 for task in unfinished if task)})
+                return {'admitting': self.admitting, 'draining': self.draining, 'limits': self.limits, 'device_limits': self.device_limits,
+                        'cpu_budget': self.cpu_budget, 'memory_budget': self.memory_budget, 'memory_reserved': self.__get_reserved_memory(),
+                        'running': [self.__describe_task(task) for task in self.running],
+                        'paused': [self.__describe_task(task) for task, _ in self.paused],
+                        'waiting_for_retry': len(self.retry_at), 'batches': batches}
+            if command in ('pause', 'resume'):
+                self.admitting = command == 'resume'
+                logging.info('%s starting new tasks' % ('Resumed' if self.admitting else 'Paused'))
+            elif command == 'drain':
+                self.draining = True
+                logging.info('Draining: no new tasks are started, exiting when running ones finish')
+            elif command == 'limit':
+                kind, limit = request['kind'], request.get('limit')
+                if limit is None:
+                    self.limits.pop(kind, None)
+                else:
+                    self.limits[kind] = max(0, int(limit))
+            elif command == 'io-limit':
+                device, limit = request['device'], request.get('limit')
+                if limit is None:
+                    self.device_limits.pop(device, None)
+                else:
+                    self.device_limits[device] = max(0, int(limit))
+            elif command == 'budget':
+                if request.get('cpu') is not None:
+                    self.cpu_budget = max(0, int(request['cpu']))
+                if request.get('memory') is not None:
+                    self.memory_budget = max(0, int(request['memory']))
+            elif command == 'priority':
+                batch_id = int(request['batch'])
+                list_idx = self.__get_list_idx(batch_id)
+                priority = int(request['priority'])
+                deadline = request['deadline'] if 'deadline' in request else self.urgency[list_idx][1]
+                deadline = None if deadline in (None, float('inf')) else float(deadline)
+                self.urgency[list_idx] = (-priority, deadline or float('inf'))
+                self.store.set_urgency(batch_id, priority, deadline)
+            elif command == 'cancel':
+                batch_id = int(request['batch'])
+                list_idx = self.__get_list_idx(batch_id)
+                self.tasklists[list_idx] = [None] * len(self.tasklists[list_idx])
+                self.retry_at = {key: when for key, when in self.retry_at.items() if key[0] != list_idx}
+                self.cancelled.add(list_idx)
+                self.store.remove_batch(batch_id)
+                victims = [task for task in self.running if self.__get_batch_id(task) == batch_id] + \
+                          [task for task, _ in self.paused if self.__get_batch_id(task) == batch_id]
+                for task in victims:
+                    task.stop()
+                logging.info('Cancelled batch %s, stopped %d task(s)' % (batch_id, len(victims)))
+                if not victims:
+                    self.__abandon(list_idx)
+            else:
+                raise ControlError('Unknown command "%s"' % command)
+            self.wakeup.set()
+            return None
+
+    def __abandon(self, list_idx):
+        ''' Lets tasks of a cancelled batch clean up once all its stopped tasks have exited '''
+        with self.lock:
+            active = list(self.running) + [task for task, _ in self.paused]
+            tasks = [task for task in self.unfinished[list_idx] if task]
+            if any(task is other for task in tasks for other in active):
+                return
+            self.unfinished[list_idx] = [None] * len(self.unfinished[list_idx])
+        for task in tasks:
+            try:
+                task.abandon()
+            except Exception:
+                logging.exception('Cannot clean up after %s of cancelled batch' % task)
+
+    def stop_all(self):
+        ''' Stops running and paused tasks, leaving them unfinished in the state '''
+        with self.lock:
+            self.stopping = True
+            tasks = list(self.running) + [task for task, _ in self.paused]
+        for task in tasks:
+            task.stop()
+
+    @staticmethod
+    def __exit_on_signal(signum, frame):
+        logging.warning('Got signal %d, stopping running tasks' % signum)
+        raise SystemExit(128 + signum)
+
+    @classmethod
+    def install_signal_handlers(cls):
+        '''
+        Children live in their own process groups, so they do not get terminal signals,
+        make the signals exit via SystemExit so whoever runs the executor stops them on the way out.
+        Works only when called from the main thread.
+        '''
+        for name in ('SIGTERM', 'SIGHUP', 'SIGINT'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), cls.__exit_on_signal)
 
     def execute(self):
+        if threading.current_thread() is threading.main_thread():
+            self.install_signal_handlers()
         try:
             return self._execute()
+        except SystemExit:
+            self.stop_all()
+            raise
         except:
             logging.exception('Unhandled error while executing tasks')
+            self.stop_all()
             raise
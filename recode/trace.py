@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import threading
+import typing
+
+from .helpers import ensuredir
+
+class TraceWriter(object):
+    '''
+    Writes executor activity in Trace Event Format (loads in chrome://tracing and Perfetto).
+    Events are appended as they happen using the array form whose closing bracket is optional,
+    so the file is usable while the executor is still running or after it was killed.
+    Spans are put in lanes, a lane per slot of a group (resource kind) which is free at span start.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        ensuredir(os.path.dirname(os.path.abspath(path)))
+        self.out = open(path, 'w')
+        self.out.write('[')
+        self.separator = '\n'
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.lanes = {} # group -> list of keys of spans occupying lanes, None for a free lane
+        self.lane_ids = {} # (group, index) -> tid
+        self.spans = {} # key -> (group, index, name, args, started)
+        self.counters = {}
+        self.__write(dict(ph='M', name='process_name', pid=self.pid, args=dict(name='vp9ify executor')))
+
+    def __now(self) -> int:
+        return int((time.time() - self.started) * 1e6)
+
+    def __write(self, event: dict):
+        self.out.write(self.separator + json.dumps(event, sort_keys=True))
+        self.separator = ',\n'
+        self.out.flush()
+
+    def __take_lane(self, group: str, key) -> int:
+        lanes = self.lanes.setdefault(group, [])
+        try:
+            index = lanes.index(None)
+            lanes[index] = key
+        except ValueError:
+            index = len(lanes)
+            lanes.append(key)
+        if (group, index) not in self.lane_ids:
+            tid = self.lane_ids[(group, index)] = len(self.lane_ids) + 1
+            self.__write(dict(ph='M', name='thread_name', pid=self.pid, tid=tid, args=dict(name='%s slot %d' % (group, index + 1))))
+            self.__write(dict(ph='M', name='thread_sort_index', pid=self.pid, tid=tid, args=dict(sort_index=tid)))
+        return index
+
+    def begin(self, key, group: str, name: str, **args):
+        with self.lock:
+            if self.out is None or key in self.spans:
+                return
+            index = self.__take_lane(group, key)
+            self.spans[key] = (group, index, name, args, self.__now())
+
+    def end(self, key, **args):
+        with self.lock:
+            span = self.spans.pop(key, None)
+            if self.out is None or span is None:
+                return
+            group, index, name, begin_args, started = span
+            self.lanes[group][index] = None
+            self.__write(dict(ph='X', name=name, cat=group, pid=self.pid, tid=self.lane_ids[(group, index)],
+                              ts=started, dur=self.__now() - started, args=dict(begin_args, **args)))
+
+    def counter(self, name: str, values: typing.Dict[str, float]):
+        ''' Records counter values, nothing is written unless they changed since last time '''
+        with self.lock:
+            if self.out is None or self.counters.get(name) == values:
+                return
+            self.counters[name] = dict(values)
+            self.__write(dict(ph='C', name=name, pid=self.pid, ts=self.__now(), args=values))
+
+    def close(self):
+        for key in list(self.spans):
+            self.end(key, unfinished=True)
+        with self.lock:
+            if self.out is not None:
+                self.out.write('\n]\n')
+                self.out.close()
+                self.out = None
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import errno
+import logging
+import typing
+
+from .helpers import ensuredir
+from .inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_MODIFY, IN_DELETE, IN_MOVED_FROM, \
+                     IN_DELETE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR, IN_ONLYDIR
+
+class LibraryWatcher(object):
+    '''
+    Watches library roots recursively for new or changed media files.
+
+    Directory listings, seen files and files waiting to settle are kept in an index file, so a rescan
+    only lists directories whose mtime changed since the previous scan (media files of other directories
+    are only stat'ed, as rewriting a file in place does not change its directory). While running, changes are picked up via inotify
+    (with periodic rescans as a safety net, or as the only source when inotify is not available).
+    A file is reported only after its size and mtime did not change for settle_time seconds.
+    '''
+    EXTENSIONS = ('.mkv',)
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR
+    RESCAN_PERIOD = 3600
+    RETRY_DELAY = 600
+
+    def __init__(self, roots: typing.List[str], index_path: str, exclude: typing.List[str]=(), settle_time: float=60):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.exclude = [os.path.abspath(path) for path in exclude]
+        self.index_path = index_path
+        self.settle_time = settle_time
+        self.dirs, self.files = {}, {}
+        self.pending = {}
+        self.watches, self.watched = {}, set()
+        self.last_scan = 0
+        self.__load()
+        try:
+            self.inotify = Inotify()
+        except OSError as err:
+            logging.warning('Cannot use inotify, falling back to rescanning every %d seconds: %s' % (self.RESCAN_PERIOD, err))
+            self.inotify = None
+
+    def __load(self):
+        try:
+            with open(self.index_path) as inp:
+                index = json.load(inp)
+        except (IOError, OSError, ValueError):
+            return
+        self.dirs = index.get('dirs', {})
+        self.files = index.get('files', {})
+        self.pending = {path: (stamp, since) for path, (stamp, since) in index.get('pending', {}).items()}
+
+    def save(self):
+        ensuredir(os.path.dirname(self.index_path))
+        tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        with open(tmp_path, 'w') as out:
+            json.dump({'dirs': self.dirs, 'files': self.files, 'pending': self.pending}, out)
+        os.rename(tmp_path, self.index_path)
+
+    @property
+    def is_initialized(self) -> bool:
+        return bool(self.dirs)
+
+    def __is_excluded(self, path: str) -> bool:
+        return any(path == excl or path.startswith(excl + os.sep) for excl in self.exclude)
+
+    def __is_media(self, name: str) -> bool:
+        return not name.startswith('.') and os.path.splitext(name)[1].lower() in self.EXTENSIONS
+
+    def __watch(self, path: str):
+        if self.inotify is None or path in self.watched:
+            return
+        try:
+            wd = self.inotify.add_watch(path, self.WATCH_MASK)
+        except OSError as err:
+            if err.errno == errno.ENOSPC:
+                logging.warning('Out of inotify watches at "%s", relying on periodic rescans (raise fs.inotify.max_user_watches)' % path)
+                self.inotify.close()
+                self.inotify, self.watches, self.watched = None, {}, set()
+            elif err.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return
+        self.watches[wd] = path
+        self.watched.add(path)
+
+    def __scan_dir(self, path: str, force: bool=False):
+        ''' Rescans directory tree, listing only directories which changed since last scan '''
+        stack = [path]
+        while stack:
+            dname = stack.pop()
+            if self.__is_excluded(dname):
+                continue
+            try:
+                mtime = os.stat(dname).st_mtime
+            except OSError:
+                self.__forget_dir(dname)
+                continue
+            self.__watch(dname)
+            entry = self.dirs.get(dname)
+            if entry is None or entry['mtime'] != mtime or force:
+                try:
+                    names = os.listdir(dname)
+                except OSError:
+                    self.__forget_dir(dname)
+                    continue
+                subdirs, media = [], []
+                for name in names:
+                    full = os.path.join(dname, name)
+                    if os.path.isdir(full) and not os.path.islink(full):
+                        subdirs.append(name)
+                    elif self.__is_media(name):
+                        media.append(name)
+                if entry is not None:
+                    for name in set(entry['subdirs']) - set(subdirs):
+                        self.__forget_dir(os.path.join(dname, name))
+                entry = self.dirs[dname] = {'mtime': mtime, 'subdirs': sorted(subdirs), 'media': sorted(media)}
+            for name in entry['media']:
+                self.__check_file(os.path.join(dname, name))
+            stack.extend(os.path.join(dname, name) for name in entry['subdirs'])
+
+    def __forget_dir(self, dname: str):
+        prefix = dname + os.sep
+        for key in [key for key in self.dirs if key == dname or key.startswith(prefix)]:
+            del self.dirs[key]
+
+    def __check_file(self, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        stamp = [stat.st_size, stat.st_mtime]
+        if self.files.get(path) == stamp:
+            # already handled
+            self.pending.pop(path, None)
+            return
+        previous = self.pending.get(path)
+        if previous is None or previous[0] != stamp:
+            self.pending[path] = (stamp, time.time())
+
+    def scan(self, mark_seen: bool=False):
+        for root in self.roots:
+            self.__scan_dir(root)
+        if mark_seen:
+            for path, (stamp, _) in self.pending.items():
+                self.files[path] = stamp
+            self.pending = {}
+        self.last_scan = time.time()
+        self.save()
+
+    def __handle_events(self, timeout: float):
+        for event in self.inotify.read_events(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                logging.warning('Inotify queue overflow, rescanning library')
+                self.last_scan = 0
+                continue
+            if event.mask & IN_IGNORED:
+                self.watched.discard(self.watches.pop(event.wd, None))
+                continue
+            dname = self.watches.get(event.wd)
+            if dname is None:
+                continue
+            path = os.path.join(dname, event.name) if event.name else dname
+            if event.mask & IN_ISDIR:
+                entry = self.dirs.get(dname)
+                if event.mask & (IN_CREATE | IN_MOVED_TO):
+                    if entry and event.name not in entry['subdirs']:
+                        entry['subdirs'] = sorted(entry['subdirs'] + [event.name])
+                    self.__scan_dir(path, force=True)
+                elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+                    if entry and event.name in entry['subdirs']:
+                        entry['subdirs'].remove(event.name)
+                    self.__forget_dir(path)
+            elif event.name and self.__is_media(event.name):
+                entry = self.dirs.get(dname)
+                if event.mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.pending.pop(path, None)
+                    if entry and event.name in entry['media']:
+                        entry['media'].remove(event.name)
+                else:
+                    if entry and event.name not in entry['media']:
+                        entry['media'] = sorted(entry['media'] + [event.name])
+                    self.__check_file(path)
+
+    def poll(self, timeout: float=1) -> typing.List[str]:
+        ''' Waits up to timeout seconds for changes, returns paths of files which settled down '''
+        if self.inotify is not None:
+            self.__handle_events(timeout)
+        else:
+            time.sleep(timeout)
+        if self.last_scan + self.RESCAN_PERIOD < time.time():
+            self.scan()
+
+        ready, now = [], time.time()
+        for path, (stamp, since) in list(self.pending.items()):
+            self.__check_file(path)
+            current = self.pending.get(path)
+            if current is not None and current[1] + self.settle_time <= now:
+                ready.append(path)
+        return sorted(ready)
+
+    def mark_done(self, path: str):
+        stamp = self.pending.pop(path, None)
+        if stamp is not None:
+            self.files[path] = stamp[0]
+            self.save()
+
+    def postpone(self, path: str, delay: float):
+        ''' Reports the file again after delay seconds (or once it settles down if it changes) '''
+        pending = self.pending.get(path)
+        if pending is not None:
+            self.pending[path] = (pending[0], time.time() + delay - self.settle_time)
+            self.save()
+
+    def get_siblings(self, path: str) -> typing.List[str]:
+        dname = os.path.dirname(path)
+        entry = self.dirs.get(dname)
+        names = entry['media'] if entry else [os.path.basename(path)]
+        return [os.path.join(dname, name) for name in names]
@@ -0,0 +1,225 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+from recode.tasks import Executor, Resource, ResourceKind
+from recode.task_store import TaskStore, NewBatch, TaskStatus
+from recode.benchmark import FakeTask
+
+class PausableTask(FakeTask):
+    __slots__ = ()
+    preemptible = True
+    EVENTS = []
+
+    def pause(self) -> bool:
+        self.EVENTS.append(('pause', self.name))
+        return True
+
+    def resume(self):
+        self.EVENTS.append(('resume', self.name))
+
+class FailingTask(FakeTask):
+    ''' Fails with the error set for its name until the set amount of failures is used up '''
+    __slots__ = ()
+    FAILURES = {} # name -> (error, how many times)
+    RUNS = []
+
+    def __call__(self):
+        self.RUNS.append(self.name)
+        error, times = self.FAILURES.get(self.name, (None, 0))
+        if times:
+            self.FAILURES[self.name] = (error, times - 1)
+            raise error
+
+    def is_transient_failure(self, error) -> bool:
+        return isinstance(error, IOError)
+
+def cpu_task(batch: int, name: str, priority: int, limit: int=1, cls=PausableTask) -> FakeTask:
+    return cls(batch, name, Resource(ResourceKind.CPU, priority), limit)
+
+class ScriptedArbiter(object):
+    ''' Stands for the host-wide arbiter, denies as many lease requests as told '''
+    capacity = {ResourceKind.CPU: 1}
+    def __init__(self):
+        self.denials = 0
+        self.held = []
+
+    def acquire(self, kind: str, amount: int):
+        if self.denials:
+            self.denials -= 1
+            return None
+        lease = object()
+        self.held.append(lease)
+        return lease
+
+    def release(self, lease):
+        self.held.remove(lease)
+
+    def mark_waiting(self, kind: str, waiting: bool):
+        pass
+
+class ExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vp9ify-test-')
+        self.store = TaskStore(os.path.join(self.workdir, 'state.sqlite'))
+        PausableTask.EVENTS[:] = []
+        FailingTask.FAILURES.clear()
+        FailingTask.RUNS[:] = []
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def enqueue(self, tasks, priority=0):
+        batch_id, = self.store.add_batches([NewBatch(tasks=tasks, title=str(tasks[0]), note='', priority=priority)])
+        return batch_id
+
+    def pop(self, executor):
+        ''' Makes one scheduling decision, returns the task started or None '''
+        return executor._Executor__pop_next_task()[2]
+
+    def refresh(self, executor):
+        executor._Executor__add_batches(self.store.read_pending(after_id=max(executor.batch_ids)))
+
+    def finish(self, executor, task):
+        executor.running.remove(task)
+        for tasks in executor.unfinished:
+            for idx, other in enumerate(tasks):
+                if other is task:
+                    tasks[idx] = None
+
+    def names(self, tasks):
+        return [task.name for task in tasks]
+
+class PreemptionTest(ExecutorTestCase):
+    def test_urgent_task_pauses_background_one(self):
+        self.enqueue([cpu_task(0, 'background', 5)])
+        executor = Executor(self.store, max_preempt=1)
+        self.assertEqual(self.pop(executor).name, 'background')
+
+        self.enqueue([cpu_task(1, 'urgent', 0)], priority=10)
+        self.refresh(executor)
+        urgent = self.pop(executor)
+        self.assertEqual(urgent.name, 'urgent')
+        self.assertEqual(PausableTask.EVENTS, [('pause', 'background')])
+        self.assertEqual(self.names(executor.running), ['urgent'])
+        self.assertEqual(self.names(task for task, _ in executor.paused), ['background'])
+
+        # nothing new starts while the paused task waits for its slot
+        self.assertIsNone(self.pop(executor))
+        self.finish(executor, urgent)
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS[-1], ('resume', 'background'))
+        self.assertEqual(self.names(executor.running), ['background'])
+        self.assertEqual(executor.paused, [])
+
+    def test_no_preemption_by_default(self):
+        self.enqueue([cpu_task(0, 'background', 5)])
+        executor = Executor(self.store)
+        self.pop(executor)
+        self.enqueue([cpu_task(1, 'urgent', 0)], priority=10)
+        self.refresh(executor)
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS, [])
+
+    def test_non_preemptible_keeps_running(self):
+        self.enqueue([cpu_task(0, 'background', 5, cls=FakeTask)])
+        executor = Executor(self.store, max_preempt=1)
+        self.pop(executor)
+        self.enqueue([cpu_task(1, 'urgent', 0)], priority=10)
+        self.refresh(executor)
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(self.names(executor.running), ['background'])
+
+    def test_same_priority_is_not_preempted(self):
+        self.enqueue([cpu_task(0, 'background', 0)])
+        executor = Executor(self.store, max_preempt=1)
+        self.pop(executor)
+        self.enqueue([cpu_task(1, 'urgent', 0)], priority=10)
+        self.refresh(executor)
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS, [])
+
+class LeaseDenialTest(ExecutorTestCase):
+    def start_background(self):
+        self.enqueue([cpu_task(0, 'background', 5)])
+        executor = Executor(self.store, max_preempt=1, arbiter=ScriptedArbiter())
+        self.pop(executor)
+        self.enqueue([cpu_task(1, 'urgent', 0)], priority=10)
+        self.refresh(executor)
+        return executor
+
+    def test_paused_task_resumes_when_urgent_gets_no_lease(self):
+        executor = self.start_background()
+        executor.arbiter.denials = 1
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS, [('pause', 'background'), ('resume', 'background')])
+        self.assertEqual(self.names(executor.running), ['background'])
+        self.assertEqual(executor.paused, [])
+        self.assertEqual(len(executor.arbiter.held), 1)
+
+    def test_paused_task_without_lease_stays_paused(self):
+        executor = self.start_background()
+        executor.arbiter.denials = 2
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS, [('pause', 'background')])
+        self.assertEqual(executor.running, [])
+        self.assertEqual(self.names(task for task, _ in executor.paused), ['background'])
+        self.assertEqual(executor.arbiter.held, [])
+        # resumed as usual once tokens are back
+        self.assertIsNone(self.pop(executor))
+        self.assertEqual(PausableTask.EVENTS[-1], ('resume', 'background'))
+        self.assertEqual(self.names(executor.running), ['background'])
+
+class FailureTest(ExecutorTestCase):
+    def make_batch(self, batch: int) -> list:
+        first = FailingTask(batch, 'first-%d' % batch, Resource(ResourceKind.CPU, 0), 1)
+        return [first, FailingTask(batch, 'second-%d' % batch, Resource(ResourceKind.IO, 0), 1, [first.name])]
+
+    def run_executor(self, max_retries=Executor.MAX_RETRIES):
+        executor = Executor(self.store)
+        executor.RETRY_DELAY, executor.MAX_RETRIES = 0, max_retries
+        executor._execute()
+        return executor
+
+    def get_failed(self):
+        return [(status.batch_id, status.error) for status in self.store.get_status() if status.status == TaskStatus.FAILED]
+
+    def test_transient_failure_is_retried(self):
+        self.enqueue(self.make_batch(0))
+        FailingTask.FAILURES['first-0'] = (IOError(errno.EIO, 'Input/output error'), 2)
+        self.run_executor()
+        self.assertEqual(FailingTask.RUNS, ['first-0'] * 3 + ['second-0'])
+        self.assertFalse(self.store.has_pending())
+        self.assertEqual(self.get_failed(), [])
+
+    def test_retries_run_out(self):
+        batch_id = self.enqueue(self.make_batch(0))
+        FailingTask.FAILURES['first-0'] = (IOError(errno.EIO, 'Input/output error'), 5)
+        self.run_executor(max_retries=1)
+        self.assertEqual(FailingTask.RUNS, ['first-0'] * 2)
+        (failed_id, error), = self.get_failed()
+        self.assertEqual(failed_id, batch_id)
+        self.assertIn('failed 2 times', error)
+
+    def test_failure_isolates_batch(self):
+        failing = self.enqueue(self.make_batch(0))
+        self.enqueue(self.make_batch(1))
+        FailingTask.FAILURES['first-0'] = (ValueError('bad source'), 1)
+        self.run_executor()
+        self.assertEqual(sorted(FailingTask.RUNS), ['first-0', 'first-1', 'second-1'])
+        (failed_id, error), = self.get_failed()
+        self.assertEqual(failed_id, failing)
+        self.assertIn('bad source', error)
+        self.assertFalse(self.store.has_pending())
+
+        # requeued batch continues with the failed task
+        self.store.requeue_failed()
+        FailingTask.RUNS[:] = []
+        self.run_executor()
+        self.assertEqual(FailingTask.RUNS, ['first-0', 'second-0'])
+        self.assertEqual(self.get_failed(), [])
+
+if __name__ == '__main__':
+    unittest.main()
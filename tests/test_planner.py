@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from recode.planner import SpeedPlanner
+from recode.encoder.mkvcrf import MkvCrfOptions, HevcEncodeTask
+from recode.encoder.predict import Prediction
+
+class FakeMedia(object):
+    def __init__(self, name: str, preset: str):
+        self.friendly_name = name
+        self.extra_options = MkvCrfOptions(crf=20, preset=preset, scale_down=0, audio_quality=5, audio_profile='')
+
+class FakeEncoder(object):
+    def __init__(self, media: FakeMedia, encode_time: float):
+        self.media = media
+        self.prediction = Prediction(bitrate=0, size=0, encode_time=encode_time, source_size=0)
+
+class FakeVideoTask(object):
+    ''' Video encode with x265 presets, its time comes from the sample encode prediction only '''
+    SPEED_OPTION = HevcEncodeTask.SPEED_OPTION
+    SPEED_CHOICES = HevcEncodeTask.SPEED_CHOICES
+    static_limit = 1
+
+    def __init__(self, name: str, encode_time: float, preset: str='slower'):
+        self.media = FakeMedia(name, preset)
+        self.encoder = FakeEncoder(self.media, encode_time)
+
+    @property
+    def speed_parts(self):
+        return [self]
+
+    @classmethod
+    def _get_name(cls):
+        return 'FakeVideo'
+
+    def get_work(self):
+        return 1.0
+
+def make_batch(task: FakeVideoTask, deadline: float, started: bool=False):
+    return (deadline, [] if started else [task], [task])
+
+class SpeedPlannerTest(unittest.TestCase):
+    def test_no_deadline_keeps_profile(self):
+        task = FakeVideoTask('a', 1000)
+        SpeedPlanner().plan([make_batch(task, float('inf'))])
+        self.assertEqual(task.media.extra_options.preset, 'slower')
+
+    def test_steps_up_until_in_time(self):
+        # 1000s at the profile, 667s one step faster, 444s two steps faster
+        task = FakeVideoTask('a', 1000)
+        SpeedPlanner().plan([make_batch(task, time.time() + 600)])
+        self.assertEqual(task.media.extra_options.preset, 'medium')
+
+    def test_slows_back_down_when_deadline_moves(self):
+        task = FakeVideoTask('a', 1000)
+        planner = SpeedPlanner()
+        planner.plan([make_batch(task, time.time() + 600)])
+        planner.plan([make_batch(task, time.time() + 2000)])
+        self.assertEqual(task.media.extra_options.preset, 'slower')
+
+    def test_earlier_batch_is_sped_up_for_later_deadline(self):
+        first, second = FakeVideoTask('a', 1000), FakeVideoTask('b', 100)
+        SpeedPlanner().plan([make_batch(first, float('inf')), make_batch(second, time.time() + 900)])
+        # speeding up the long first batch saves the most
+        self.assertEqual(first.media.extra_options.preset, 'slow')
+        self.assertEqual(second.media.extra_options.preset, 'slower')
+
+    def test_late_anyway_goes_fastest(self):
+        task = FakeVideoTask('a', 1000)
+        with self.assertLogs(level='WARNING'):
+            SpeedPlanner().plan([make_batch(task, time.time() + 1)])
+        self.assertEqual(task.media.extra_options.preset, HevcEncodeTask.SPEED_CHOICES[-1])
+
+    def test_started_encode_is_not_changed(self):
+        task = FakeVideoTask('a', 1000)
+        SpeedPlanner().plan([make_batch(task, time.time() + 600, started=True)])
+        self.assertEqual(task.media.extra_options.preset, 'slower')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from recode import publish
+from recode.publish import publish_file, get_part_path, Throttle
+
+class PublishFileTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vp9ify-test-')
+        self.src = os.path.join(self.workdir, 'scratch', 'movie.mkv')
+        self.dest = os.path.join(self.workdir, 'library', 'Movie', 'movie.mkv')
+        self.data = os.urandom(3 * publish.CHUNK_SIZE + 12345)
+        os.makedirs(os.path.dirname(self.src))
+        with open(self.src, 'wb') as out:
+            out.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def read(self, path):
+        with open(path, 'rb') as inp:
+            return inp.read()
+
+    def write_part(self, data):
+        part = get_part_path(self.dest)
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        with open(part, 'wb') as out:
+            out.write(data)
+        return part
+
+    def test_copy(self):
+        publish_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), self.data)
+        self.assertEqual(os.listdir(os.path.dirname(self.dest)), ['movie.mkv'])
+        self.assertTrue(os.path.exists(self.src))
+
+    def test_part_is_hidden(self):
+        self.assertEqual(get_part_path('/lib/Movie/movie.mkv'), '/lib/Movie/.movie.mkv.part')
+
+    def test_resume(self):
+        self.write_part(self.data[:publish.CHUNK_SIZE + 100])
+        with self.assertLogs(level='INFO') as logs:
+            publish_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), self.data)
+        self.assertIn('from %d bytes' % (publish.CHUNK_SIZE + 100), '\n'.join(logs.output))
+
+    def test_mismatching_part_restarts(self):
+        part = self.write_part(b'\0' * 1000)
+        publish_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), self.data)
+        self.assertFalse(os.path.exists(part))
+
+    def test_longer_part_restarts(self):
+        self.write_part(self.data + b'tail')
+        publish_file(self.src, self.dest)
+        self.assertEqual(self.read(self.dest), self.data)
+
+    def corrupting_copy(self, times):
+        copy = publish._copy
+        left = [times]
+        def corrupt(src, part, throttle):
+            result = copy(src, part, throttle)
+            if left[0]:
+                left[0] -= 1
+                with open(part, 'r+b') as out:
+                    out.seek(10)
+                    out.write(b'broken')
+            return result
+        return corrupt
+
+    def test_verify_failure_is_retried(self):
+        with mock.patch.object(publish, '_copy', self.corrupting_copy(1)):
+            publish_file(self.src, self.dest, attempts=2, retry_delay=0)
+        self.assertEqual(self.read(self.dest), self.data)
+
+    def test_verify_failure_gives_up(self):
+        with mock.patch.object(publish, '_copy', self.corrupting_copy(2)):
+            with self.assertRaises(IOError):
+                publish_file(self.src, self.dest, attempts=2, retry_delay=0)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(get_part_path(self.dest)))
+
+class ThrottleTest(unittest.TestCase):
+    def test_rate(self):
+        throttle = Throttle(1000000)
+        started = time.time()
+        for _ in range(4):
+            throttle.consume(50000)
+        self.assertGreaterEqual(time.time() - started, 0.18)
+
+    def test_unlimited(self):
+        throttle = Throttle(0)
+        started = time.time()
+        throttle.consume(1 << 30)
+        self.assertLess(time.time() - started, 0.1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import copyreg
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from recode.task_store import TaskStore, NewBatch, TaskStatus, LegacyStateError
+from recode.benchmark import make_batch_tasks
+from recode.media.info import MediaInfo
+from recode.media.movie import HQMovie
+from recode.encoder.mkvcrf import MKVCRFEncoder, HevcEncodeTask
+
+class TaskStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vp9ify-test-')
+        self.path = os.path.join(self.workdir, 'state.sqlite')
+        self.store = TaskStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def add(self, *indices, **kw):
+        return self.store.add_batches([NewBatch(tasks=make_batch_tasks(idx), title='fake %d' % idx, note='', **kw) for idx in indices])
+
+    def test_round_trip(self):
+        batch_ids = self.add(0, 1, priority=5, deadline=1000.0)
+        pending = TaskStore(self.path).read_pending()
+        self.assertEqual([batch.batch_id for batch in pending], batch_ids)
+        self.assertEqual(pending[0].tasks, make_batch_tasks(0))
+        self.assertEqual(pending[1].tasks, make_batch_tasks(1))
+        self.assertEqual((pending[0].priority, pending[0].deadline), (5, 1000.0))
+
+    def test_read_after_id(self):
+        first, second = self.add(0, 1)
+        self.assertEqual([batch.batch_id for batch in self.store.read_pending(after_id=first)], [second])
+        self.assertEqual(self.store.read_pending(after_id=second), [])
+
+    def test_done_tasks_are_none(self):
+        batch_id, = self.add(0)
+        self.store.mark_done(batch_id, 1)
+        self.store.mark_done(batch_id, 1) # second mark is ignored
+        tasks = self.store.read_pending()[0].tasks
+        self.assertIsNone(tasks[1])
+        self.assertEqual(sum(1 for task in tasks if task), len(make_batch_tasks(0)) - 1)
+
+    def test_finished_batch(self):
+        batch_id, = self.add(0)
+        for idx in range(len(make_batch_tasks(0))):
+            self.store.mark_done(batch_id, idx)
+        self.assertFalse(self.store.has_pending())
+        self.assertEqual(self.store.read_pending(), [])
+        self.assertEqual(self.store.get_status(), [])
+        self.store.purge_finished()
+        self.assertEqual(self.store.requeue_failed(), 0)
+
+    def test_status_lists_pending_names(self):
+        batch_id, = self.add(0)
+        self.store.mark_done(batch_id, 0)
+        status, = self.store.get_status()
+        self.assertEqual(status.status, TaskStatus.PENDING)
+        self.assertEqual(status.pending_tasks, [task.name for task in make_batch_tasks(0)[1:]])
+
+    def test_quarantine_and_requeue(self):
+        batch_id, other_id = self.add(0, 1)
+        self.store.mark_done(batch_id, 0)
+        self.store.quarantine(batch_id, 'Pass1 failed')
+        self.assertEqual([batch.batch_id for batch in self.store.read_pending()], [other_id])
+        failed = [status for status in self.store.get_status() if status.status == TaskStatus.FAILED]
+        self.assertEqual([(status.batch_id, status.error) for status in failed], [(batch_id, 'Pass1 failed')])
+
+        self.assertEqual(self.store.requeue_failed(), 1)
+        requeued = self.store.read_pending(after_id=other_id)
+        self.assertEqual(len(requeued), 1)
+        self.assertGreater(requeued[0].batch_id, other_id)
+        self.assertIsNone(requeued[0].tasks[0])
+        self.assertEqual(requeued[0].tasks[1:], make_batch_tasks(0)[1:])
+
+    def test_urgency_and_removal(self):
+        batch_id, other_id = self.add(0, 1)
+        self.store.set_urgency(batch_id, 10, None)
+        self.store.remove_batch(other_id)
+        pending, = self.store.read_pending()
+        self.assertEqual((pending.batch_id, pending.priority, pending.deadline), (batch_id, 10, None))
+
+class Legacy(object):
+    ''' Pickles like an instance of given class made before it got __slots__ '''
+    def __init__(self, cls, **state):
+        self.cls, self.state = cls, state
+
+    def __reduce__(self):
+        return copyreg._reconstructor, (self.cls, object, None), self.state
+
+MKVMERGE_INFO = {'container': {'properties': {'duration': 31141000000}},
+                 'tracks': [{'codec': 'HEVC/H.265/MPEG-H', 'type': 'video', 'id': 0, 'properties': {'pixel_dimensions': '1920x1080'}},
+                            {'codec': 'AC-3/E-AC-3', 'type': 'audio', 'id': 1, 'properties': {'audio_channels': 6, 'language': 'eng'}}]}
+
+def make_legacy_tasks(src: str, dest: str) -> list:
+    info = Legacy(MediaInfo, path=src, info=MKVMERGE_INFO, tracks=MKVMERGE_INFO['tracks'])
+    media = Legacy(HQMovie, src=src, info=info, ignored_audio_tracks={2}, name='Movie', prefix='abcd')
+    encoder = Legacy(MKVCRFEncoder, media=media, src=src, info=info, tempfiles=[], patterns=[], dest=dest, stdout=None, drop_video=False)
+    task = Legacy(HevcEncodeTask, encoder=encoder, blockers=['RemoveScript'], media=media, info=info, stdout=None, tmpdir='/tmp', dest=dest)
+    return [[None, task]]
+
+class LegacyStateTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vp9ify-test-')
+        self.legacy = os.path.join(self.workdir, 'tasks.pickle')
+        with open(self.legacy, 'wb') as out:
+            pickle.dump(make_legacy_tasks('/src/Movie.mkv', self.workdir), out)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def check_imported(self, store):
+        pending, = store.read_pending()
+        task, = pending.tasks
+        self.assertIsInstance(task, HevcEncodeTask)
+        self.assertEqual(task.blockers, ['RemoveScript'])
+        self.assertIsNone(task.process)
+        self.assertIsNone(task.sample)
+        self.assertEqual(task.dest, self.workdir)
+        self.assertEqual(task.encoder.timings, {})
+        self.assertIsNone(task.encoder.prediction)
+        media = task.media
+        self.assertEqual(media.extra_options, HQMovie.EXTRA_OPTIONS)
+        self.assertEqual(media.ignored_audio_tracks, frozenset([2]))
+        self.assertEqual(media.info.get_duration(), 31.141)
+        self.assertEqual(media.info.get_video_dimensions(), (1920, 1080))
+        self.assertEqual(media.info.get_audio_channels(), {1: 6})
+
+    def test_import(self):
+        store = TaskStore(os.path.join(self.workdir, 'tasks.sqlite'))
+        store.import_legacy(self.legacy)
+        self.check_imported(store)
+        self.assertFalse(os.path.exists(self.legacy))
+        self.assertTrue(os.path.exists(self.legacy + '.legacy'))
+
+    def test_convert_in_place(self):
+        self.check_imported(TaskStore(self.legacy))
+        self.assertTrue(os.path.exists(self.legacy + '.legacy'))
+
+    def test_unreadable_is_kept(self):
+        with open(self.legacy, 'wb') as out:
+            out.write(b'garbage')
+        with self.assertRaises(LegacyStateError):
+            TaskStore(self.legacy)
+        with open(self.legacy, 'rb') as inp:
+            self.assertEqual(inp.read(), b'garbage')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from recode.watcher import LibraryWatcher
+
+class LibraryWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='vp9ify-test-')
+        self.root = os.path.join(self.workdir, 'library')
+        os.makedirs(os.path.join(self.root, 'show'))
+        self.index = os.path.join(self.workdir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def make_watcher(self, settle_time=0):
+        watcher = LibraryWatcher([self.root], self.index, settle_time=settle_time)
+        if watcher.inotify is not None:
+            # changes are found by scans only, so tests do not depend on event timing
+            watcher.inotify.close()
+            watcher.inotify = None
+        return watcher
+
+    def write(self, name, data=b'x'):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as out:
+            out.write(data)
+        return path
+
+    def test_first_scan_marks_existing_seen(self):
+        self.write('show/old.mkv')
+        watcher = self.make_watcher()
+        self.assertFalse(watcher.is_initialized)
+        watcher.scan(mark_seen=True)
+        self.assertEqual(watcher.poll(0), [])
+        new = self.write('show/new.mkv')
+        self.write('show/notes.txt')
+        self.write('show/.hidden.mkv')
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [new])
+
+    def test_settle(self):
+        watcher = self.make_watcher(settle_time=60)
+        path = self.write('show/ep1.mkv')
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [])
+        stamp, since = watcher.pending[path]
+        watcher.pending[path] = (stamp, since - 61)
+        self.assertEqual(watcher.poll(0), [path])
+        # a change restarts the wait
+        self.write('show/ep1.mkv', b'longer')
+        self.assertEqual(watcher.poll(0), [])
+
+    def test_mark_done(self):
+        watcher = self.make_watcher()
+        path = self.write('show/ep1.mkv')
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [path])
+        watcher.mark_done(path)
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [])
+        self.assertEqual(self.make_watcher().poll(0), [])
+
+    def test_postpone_survives_restart(self):
+        watcher = self.make_watcher()
+        path = self.write('show/ep1.mkv')
+        watcher.scan()
+        watcher.postpone(path, 600)
+        self.assertEqual(watcher.poll(0), [])
+        restarted = self.make_watcher()
+        self.assertIn(path, restarted.pending)
+        self.assertEqual(restarted.poll(0), [])
+
+    def test_rewrite_in_unchanged_directory(self):
+        path = self.write('show/ep1.mkv')
+        watcher = self.make_watcher()
+        watcher.scan(mark_seen=True)
+        dname = os.path.dirname(path)
+        mtime = os.stat(dname).st_mtime
+        self.write('show/ep1.mkv', b'rewritten')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        os.utime(dname, (mtime, mtime))
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [path])
+
+    def test_removed_directory(self):
+        watcher = self.make_watcher()
+        path = self.write('show/ep1.mkv')
+        watcher.scan()
+        shutil.rmtree(os.path.join(self.root, 'show'))
+        watcher.scan()
+        self.assertEqual(watcher.poll(0), [])
+        self.assertNotIn(os.path.join(self.root, 'show'), watcher.dirs)
+        self.assertNotIn(path, watcher.pending)
+
+    def test_siblings(self):
+        watcher = self.make_watcher()
+        first, second = self.write('show/ep1.mkv'), self.write('show/ep2.mkv')
+        watcher.scan()
+        self.assertEqual(watcher.get_siblings(first), [first, second])
+
+if __name__ == '__main__':
+    unittest.main()